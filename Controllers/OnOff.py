@@ -1,7 +1,10 @@
+import numpy as np
+
 from controller import Controller
 
 
 class OnOff(Controller):
+    history = 1
 
     def __init__(self, ts=0.1):
         Controller.__init__(self, ts)
@@ -11,4 +14,8 @@ class OnOff(Controller):
         if readings[-1] > control_point:
             return 0
         else:
-            return 1
\ No newline at end of file
+            return 1
+
+    @staticmethod
+    def calculate_action_batch(readings, time, control_point, lanes=slice(None)):
+        return np.where(readings[-1] > control_point, 0.0, 1.0)
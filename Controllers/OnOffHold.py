@@ -1,7 +1,10 @@
+import numpy as np
+
 from controller import Controller
 
 
 class OnOffHold(Controller):
+    history = 1
 
     def __init__(self, ts=0.1, r=0.1):
         Controller.__init__(self, ts)
@@ -21,4 +24,14 @@ class OnOffHold(Controller):
                 return 0
             else:
                 self._parity = 0
-                return 1
\ No newline at end of file
+                return 1
+
+    def calculate_action_batch(self, readings, time, control_point, lanes=slice(None)):
+        reading = readings[-1]
+        parity = self._parity[lanes]
+        r = self.r[lanes]
+        turn_off = (parity == 0) & (reading > control_point*(1+r))
+        turn_on = (parity == 1) & (reading < control_point*(1-r))
+        parity = np.where(turn_off, 1.0, np.where(turn_on, 0.0, parity))
+        self._parity[lanes] = parity
+        return np.where(parity == 0, 1.0, 0.0)
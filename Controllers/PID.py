@@ -1,7 +1,10 @@
+import numpy as np
+
 from controller import Controller
 
 
 class PID(Controller):
+    history = 1
 
     def __init__(self, ts=0.1, Kp=8, Ki=0, Kv=0):
         Controller.__init__(self, ts)
@@ -19,3 +22,15 @@ class PID(Controller):
         error_derivative = (self._error - last_error) / self.ts
         control_action = max(self.Kp * self._error + error_derivative * self.Kv + self._integral_error * self.Ki, 0)
         return min(1, control_action)
+
+    def calculate_action_batch(self, readings, time, control_point, lanes=slice(None)):
+        reading = readings[-1]
+        ts = self.ts[lanes]
+        last_error = self._error[lanes]
+        error = control_point - reading
+        integral_error = self._integral_error[lanes] + error * ts
+        self._error[lanes] = error
+        self._integral_error[lanes] = integral_error
+        error_derivative = (error - last_error) / ts
+        control_action = self.Kp[lanes] * error + error_derivative * self.Kv[lanes] + integral_error * self.Ki[lanes]
+        return np.clip(control_action, 0, 1)
@@ -0,0 +1,229 @@
+import cProfile
+import io
+import pstats
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pygame
+import pygame.freetype
+
+from buffers import HistoryWindow
+
+
+# Performance overlay of the Application, shown and hidden with F3.
+# Every frame records its duration and the part of it the application spent working (the rest is Clock.tick waiting
+# for the target frame rate), the time of named sections (event handling, simulation, each Window's drawing) and the
+# drawing time of every widget, which Window.show reports when given the overlay. Timings are smoothed over frames.
+# The overlay draws a frame-time graph against the target frame time, the section breakdown, the slowest widgets and
+# the steps/s of the simulation running in the background. F4 profiles the next capture_frames frames with cProfile
+# and writes the capture (a .prof file for pstats or snakeviz, and a text summary) to capture_directory.
+class PerformanceOverlay:
+    toggle_key = pygame.K_F3
+    capture_key = pygame.K_F4
+
+    def __init__(self, target_fps=60, history=180, capture_frames=300, capture_directory='.', position=(5, 5),
+                 redraw_every=6):
+        self.enabled = False
+        self.target_fps = target_fps
+        self.capture_frames = capture_frames
+        self.capture_directory = Path(capture_directory)
+        self.position = position
+        self.redraw_every = redraw_every
+        self.frame_times = HistoryWindow(history)
+        self.work_times = HistoryWindow(history)
+        self.font = pygame.freetype.SysFont('Courier New', 12)
+
+        self._sections = {}
+        self._widgets = {}
+        self._section_times = {}
+        self._widget_times = {}
+        self._smoothing = 0.05
+
+        # Steps are counted from any thread; the rate is refreshed twice a second. Runs read back from the simulation
+        # cache take no steps and are counted apart.
+        self.cache_hits = 0
+        self._steps = 0
+        self._steps_start = perf_counter()
+        self.steps_per_s = 0.0
+
+        self._profile = None
+        self._captured = []
+        self.last_capture = None
+
+        # The overlay is rendered to a surface every redraw_every frames and blitted in between, so that it costs
+        # little on the machines it is meant to diagnose.
+        self._surface = None
+        self._frames_since_redraw = 0
+
+    @property
+    def profiling(self):
+        """True when timings are being collected: while the overlay is shown, or during a capture."""
+        return self.enabled or self._profile is not None
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self._surface = None
+
+    def handle_event(self, event):
+        """Handles the overlay's hotkeys. Returns True when the event was one of them."""
+        if event.type != pygame.KEYDOWN:
+            return False
+        if event.key == self.toggle_key:
+            self.toggle()
+            return True
+        if event.key == self.capture_key:
+            self.start_capture()
+            return True
+        return False
+
+    @contextmanager
+    def section(self, name):
+        """Times the body of a with statement as the section `name` of the current frame."""
+        if not self.profiling:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self._sections[name] = self._sections.get(name, 0.0) + perf_counter() - start
+
+    def record_widget(self, name, seconds):
+        self._widgets[name] = self._widgets.get(name, 0.0) + seconds
+
+    def count_steps(self, steps):
+        self._steps += steps
+
+    def count_cache_hit(self):
+        self.cache_hits += 1
+
+    def end_frame(self, frame_ms, work_ms):
+        """Closes the frame. frame_ms and work_ms are Clock.tick's return value and Clock.get_rawtime()."""
+        self.frame_times.append(frame_ms)
+        self.work_times.append(work_ms)
+
+        now = perf_counter()
+        if now - self._steps_start >= 0.5:
+            self.steps_per_s = self._steps / (now - self._steps_start)
+            self._steps = 0
+            self._steps_start = now
+
+        if not self.profiling:
+            return
+        self._smooth(self._section_times, self._sections)
+        self._smooth(self._widget_times, self._widgets)
+        if self._profile is not None:
+            self._captured.append((frame_ms, work_ms, self._sections, self._widgets))
+            if len(self._captured) >= self.capture_frames:
+                self.finish_capture()
+        self._sections = {}
+        self._widgets = {}
+
+    def _smooth(self, averages, frame):
+        # Names missing from this frame count as 0 ms, so sections that stopped running fade out.
+        for name in set(averages) | set(frame):
+            milliseconds = 1000 * frame.get(name, 0.0)
+            average = averages.get(name, milliseconds)
+            averages[name] = average + self._smoothing * (milliseconds - average)
+
+    def start_capture(self):
+        if self._profile is not None:
+            return
+        self._captured = []
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def finish_capture(self):
+        """Stops the capture and writes it. Returns the path of the .prof file."""
+        profile, self._profile = self._profile, None
+        profile.disable()
+        self.capture_directory.mkdir(parents=True, exist_ok=True)
+        path = self.capture_directory / f'profile-{datetime.now():%Y%m%d-%H%M%S}.prof'
+        profile.dump_stats(path)
+        path.with_suffix('.txt').write_text(self._capture_summary(profile))
+        self.last_capture = path
+        return path
+
+    def _capture_summary(self, profile):
+        frames = np.array([frame[0] for frame in self._captured], dtype=float)
+        work = np.array([frame[1] for frame in self._captured], dtype=float)
+        budget = 1000 / self.target_fps
+        lines = [
+            f'{len(frames)} frames, target {self.target_fps} FPS ({budget:.1f} ms)',
+            f'frame time: mean {frames.mean():.2f} ms, p95 {np.percentile(frames, 95):.2f} ms, '
+            f'max {frames.max():.2f} ms, {int(np.sum(frames > 1.05 * budget))} frames over budget',
+            f'work time: mean {work.mean():.2f} ms, p95 {np.percentile(work, 95):.2f} ms, max {work.max():.2f} ms',
+            '',
+        ]
+        for title, index in (('sections', 2), ('widgets', 3)):
+            totals = {}
+            for frame in self._captured:
+                for name, seconds in frame[index].items():
+                    totals[name] = totals.get(name, 0.0) + seconds
+            lines.append(f'{title} (mean ms per frame):')
+            for name, seconds in sorted(totals.items(), key=lambda item: -item[1]):
+                lines.append(f'    {name:<40}{1000 * seconds / len(frames):>10.3f}')
+            lines.append('')
+
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(40)
+        return '\n'.join(lines) + stream.getvalue()
+
+    def draw(self, window):
+        if not self.enabled:
+            return
+        if self._surface is None or self._frames_since_redraw >= self.redraw_every:
+            self._surface = self._render()
+            self._frames_since_redraw = 0
+        self._frames_since_redraw += 1
+        window.blit(self._surface, self.position)
+
+    def _render(self):
+        budget = 1000 / self.target_fps
+        frames = self.frame_times.view()
+        work = self.work_times.view()
+        mean_frame = float(np.mean(frames)) if len(frames) else 0.0
+        lines = [
+            f'{1000 / mean_frame if mean_frame else 0:5.1f} FPS (target {self.target_fps})',
+            f'frame {mean_frame:5.1f} ms  work {float(np.mean(work)) if len(work) else 0:5.1f} ms',
+            f'{int(np.sum(frames > 1.05 * budget))}/{len(frames)} frames over {budget:.1f} ms',
+            f'simulation {self.steps_per_s:,.0f} steps/s, {self.cache_hits} cached',
+            '',
+        ]
+        for name, milliseconds in sorted(self._section_times.items(), key=lambda item: -item[1]):
+            lines.append(f'{name:<24}{milliseconds:7.2f} ms')
+        lines.append('')
+        for name, milliseconds in sorted(self._widget_times.items(), key=lambda item: -item[1])[:6]:
+            name = name if len(name) <= 24 else '...' + name[-21:]
+            lines.append(f'{name:<24}{milliseconds:7.2f} ms')
+        if self._profile is not None:
+            lines.append(f'capturing {len(self._captured)}/{self.capture_frames} frames')
+        elif self.last_capture is not None:
+            lines.append(f'saved {self.last_capture.name}')
+        else:
+            lines.append('F4: capture a profile')
+
+        width, graph_height, line_height = 250, 60, 14
+        surface = pygame.Surface((width, graph_height + 12 + line_height * len(lines)), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 180))
+
+        # Frame-time graph: the whole frame in green (red when over budget), the work part of it darker. The line is
+        # the target frame time, at half the graph's height.
+        scale = graph_height / (2 * budget)
+        bar_width = width / self.frame_times.size
+        for index, (frame, frame_work) in enumerate(zip(frames, work)):
+            x = index * bar_width
+            height = min(frame * scale, graph_height)
+            color = (80, 220, 80) if frame <= 1.05 * budget else (230, 70, 70)
+            pygame.draw.rect(surface, color, pygame.Rect(x, 4 + graph_height - height, max(bar_width, 1), height))
+            height = min(frame_work * scale, graph_height)
+            pygame.draw.rect(surface, (30, 110, 30), pygame.Rect(x, 4 + graph_height - height, max(bar_width, 1),
+                                                                 height))
+        pygame.draw.line(surface, (255, 255, 255), (0, 4 + graph_height / 2), (width, 4 + graph_height / 2))
+
+        for index, line in enumerate(lines):
+            self.font.render_to(surface, (4, graph_height + 10 + index * line_height), line, (255, 255, 255))
+        return surface
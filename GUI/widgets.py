@@ -1,6 +1,7 @@
 import pygame
 import pygame.freetype
 from string import ascii_letters
+from time import perf_counter
 
 pygame.freetype.init()
 
@@ -518,24 +519,44 @@ class DropdownMenu(Widget):
     def on_item_hover(self, id):
         pass
 
+    def select_item(self, id):
+        """Shows item `id` as the selected one, without calling on_item_select."""
+        self.selected_item_id = id
+        self.selected_item = self.items[id]
+        self.selecting_item = False
+        ordering = [id]
+        for i in range(0, self.number_of_items):
+            if i != id:
+                ordering.append(i)
+        for index, order in enumerate(ordering):
+            if index > 0:
+                self.items[order].enable_hover_event()
+                self.items[order].disable()
+            else:
+                self.items[order].disable_hover_event()
+                self.items[order].enable()
+            self.items[order].position = self.positions[index]
+            self.items[order].global_position = [self.positions[index][0], self.positions[index][1]]
+
+    def remove_item(self, id):
+        """Removes item `id`. The items after it move up one id; the first item is selected if `id` was."""
+        names = [item.hint_text.txt for index, item in enumerate(self.items) if index != id]
+        selected = self.selected_item_id
+        selected = 0 if selected == id else selected - (id < selected)
+        self.items = []
+        self.positions = []
+        self.number_of_items = 0
+        self.max_size = []
+        for name in names:
+            self.add_item(name)
+        self.selected_item = None
+        self.selected_item_id = 0
+        if self.items:
+            self.select_item(selected)
+
     def on_item_click(self, id):
         if self.selecting_item:
-            self.selected_item_id = id
-            self.selected_item = self.items[id]
-            self.selecting_item = False
-            ordering = [id]
-            for i in range(0, self.number_of_items):
-                if i != id:
-                    ordering.append(i)
-            for index, order in enumerate(ordering):
-                if index > 0:
-                    self.items[order].enable_hover_event()
-                    self.items[order].disable()
-                else:
-                    self.items[order].disable_hover_event()
-                    self.items[order].enable()
-                self.items[order].position = self.positions[index]
-                self.items[order].global_position = [self.positions[index][0], self.positions[index][1]]
+            self.select_item(id)
             if self.on_item_select:
                 if self.on_item_select_args:
                     self.on_item_select(self.selected_item.hint_text.txt, self.selected_item_id, self.on_item_select_args)
@@ -547,7 +568,7 @@ class DropdownMenu(Widget):
                 item.enable()
 
     def show(self, window):
-        if self.enabled:
+        if self.enabled and self.items:
             self.items[self.selected_item_id].show(window)
             if self.selecting_item:
                 for i in range(self.number_of_items):
@@ -574,7 +595,8 @@ class DropdownMenu(Widget):
 
 class Window:
 
-    def __init__(self, buttons, panels, text_edits, progress_bars, dropdown_menus, customs=None):
+    def __init__(self, buttons, panels, text_edits, progress_bars, dropdown_menus, customs=None, name='window'):
+        self.name = name
         self.text_edits = text_edits
         self.buttons = buttons
         self.panels = panels
@@ -609,8 +631,15 @@ class Window:
                 for custom in self.customs.values():
                     custom.event_handler(mouse_pos, event.type)
     
-    def show(self, window, mouse_pos):
-        if self.active:
+    def show(self, window, mouse_pos, profiler=None):
+        if self.active and profiler is not None and profiler.profiling:
+            # Same drawing, timing each widget for the performance overlay.
+            with profiler.section(f'{self.name} view'):
+                for name, widget, args in self._drawing_order(window, mouse_pos):
+                    start = perf_counter()
+                    widget.show(*args)
+                    profiler.record_widget(f'{self.name}.{name}', perf_counter() - start)
+        elif self.active:
             for button in self.buttons.values():
                 button.show(window)
             for panel in self.panels.values():
@@ -624,10 +653,20 @@ class Window:
             if self.customs:
                 for custom in self.customs.values():
                     custom.show(window, mouse_pos)
+        if self.active:
             if not self.wait_complete:
                 self.frame_counter += 1
                 if self.frame_counter == 3:
                     self.wait_complete = True
+
+    def _drawing_order(self, window, mouse_pos):
+        """Yields the name, the widget and the show() arguments of every widget, in the order show() draws them."""
+        for group in (self.buttons, self.panels, self.text_edits, self.progress_bars, self.dropdown_menus):
+            for name, widget in group.items():
+                yield name, widget, (window,)
+        if self.customs:
+            for name, custom in self.customs.items():
+                yield name, custom, (window, mouse_pos)
             
 
 
@@ -2,19 +2,23 @@
 from os import path  # Biblioteca para direcionamento do endereço dos arquiv
 from bisect import bisect_left
 import threading
+from time import perf_counter
 
-from openpyxl import Workbook
-from openpyxl.chart import Reference, ScatterChart, Series
+import numpy as np
 
 import pygame  # Biblioteca para a janela do jogo e evento de mouse.
 import pygame.freetype  # Sub biblioteca para a fonte.
 
 # Meu código
 from GUI import widgets as gui
+from GUI.overlay import PerformanceOverlay
 
 # Classe do manager do Jogo.
-from simulator import WaterTank
-from controller import get_custom_controllers, Controller
+from simulator import WaterTank, SimulationResults
+from cache import SimulationCache
+from controller import ControllerWatcher, Controller
+from export import save_xlsx
+from tuning import GAINS, tune_pid
 
 
 class WaterTankWidget(gui.Widget):
@@ -77,6 +81,27 @@ class Application:
 
         self.elapsed_time = 0
         self.elapsed_time_s = 0.0
+        self.simulation_steps = 0
+        self.simulation_progress = 0
+        self.simulation_cache_hits = 0
+
+        # Live mode integrates in lockstep with the display: every frame advances the simulation by the frame time
+        # times the speed ratio (None runs as fast as the budget allows), spending at most frame_budget seconds of CPU.
+        self.live_run = None
+        self.live_chunks = []
+        self.live_target = 0.0
+        self.live_ratios = [1, 10, 100, None]
+        self.live_ratio_index = 0
+        self.frame_budget = 0.004
+
+        # The Tune button searches the gains of the selected controller in the background, see tuning.tune_pid.
+        self.tuning = False
+
+        # Runs repeated with the same tank, controller and set point are read back from the cache instead of simulated.
+        self.simulation_cache = SimulationCache(directory=path.join(".cache", "simulations"))
+
+        # F3 shows frame times and where they go, F4 writes a profile capture of the next frames.
+        self.overlay = PerformanceOverlay(target_fps=60)
 
         sprites = {
             'arrow_left': pygame.image.load(
@@ -104,6 +129,10 @@ class Application:
             'restart_idle': pygame.image.load(path.join("Assets/button_yellow", "button_reload.png")).convert_alpha(),
             'restart_pressed': pygame.image.load(
                 path.join("Assets/button_hover", "button_reload_hover.png")).convert_alpha(),
+            'live_idle': pygame.image.load(
+                path.join("Assets/button_yellow", "button_arrow_right.png")).convert_alpha(),
+            'live_pressed': pygame.image.load(
+                path.join("Assets/button_hover", "button_arrow_right_hover.png")).convert_alpha(),
             'ok_idle': pygame.image.load(
                 path.join("Assets/button_yellow", "button_yes.png")).convert_alpha(),
             'ok_pressed': pygame.image.load(
@@ -119,6 +148,11 @@ class Application:
             'restart': gui.PushButton([195+110, 100-45-10], [45, 45], [sprites['restart_idle'], sprites['restart_pressed']]),
             'pause': gui.PushButton([195+55, 100-45-10], [45, 45], [sprites['stop_idle'], sprites['stop_pressed']]),
             'save_data': gui.PushButton([195+165, 100-45-10], [45, 45], [sprites['save_idle'], sprites['save_pressed']]),
+            'live': gui.PushButton([195+220, 100-45-10], [45, 45], [sprites['live_idle'], sprites['live_pressed']]),
+            'speed': gui.PushButton([195+275, 100-45-10], [60, 45], [sprites['menu_item_idle'], sprites['menu_item_hover']],
+                                    hint_text=gui.Text('1x', 16, gui.Color.BLACK)),
+            'tune': gui.PushButton([195+340, 100-45-10], [60, 45], [sprites['menu_item_idle'], sprites['menu_item_hover']],
+                                   hint_text=gui.Text('Tune', 16, gui.Color.BLACK)),
         }
         buttons['settings'].connect_function(self.open_settings)
         buttons['run_simulation'].connect_function(self.start_simulation)
@@ -126,11 +160,15 @@ class Application:
         buttons['pause'].connect_function(self.pause_simulation)
         buttons['restart'].connect_function(self.reset)
         buttons['save_data'].connect_function(self.save_simulation_results)
+        buttons['live'].connect_function(self.start_live_simulation)
+        buttons['speed'].connect_function(self.change_live_speed)
+        buttons['tune'].connect_function(self.tune_controller)
 
         buttons['pause'].disable()
 
         panels = {
             'time_panel': gui.Panel([10, 10], [80, 30], sprites['panel'], border=gui.Border(1, gui.Color.BLACK), text=gui.Text('00:000', 16, gui.Color.BLACK)),
+            'live_status': gui.Panel([10, 50], [165, 30], sprites['panel'], border=gui.Border(1, gui.Color.BLACK), text=gui.Text('None', 16, gui.Color.BLACK)),
             'controller_select': gui.Panel([10, 100], [165, 30], sprites['panel'], border=gui.Border(1, gui.Color.BLACK), text=gui.Text('Escolha o controlador', 16, gui.Color.BLACK))
         }
 
@@ -144,24 +182,18 @@ class Application:
 
         text_edits = {}
 
-        self.custom_controllers = get_custom_controllers()
+        # Plugins edited, added or removed while the application runs are picked up by reload_controllers.
+        self.controller_watcher = ControllerWatcher(interval=1.0)
+        self.custom_controllers = list(self.controller_watcher.entries)
+        self.panel_image = sprites['panel']
 
         self.custom_controller_id = 0
         for controller in self.custom_controllers:
             dropdown_menu['controller_select'].add_item(controller['name'])
-            current_y = 100
-            for name in controller['variables']:
-                default_value = str(controller['variables'][name])
-                new_panel = gui.Panel([450, current_y], [35, 30], sprites['panel'], border=gui.Border(1, gui.Color.BLACK),text=gui.Text(name.capitalize(), 16, gui.Color.BLACK))
-                new_edit = gui.TextEdit([495, current_y], [60, 30], sprites['panel'], border=gui.Border(1, gui.Color.BLACK), text=gui.Text(default_value, 16, gui.Color.BLACK))
-                if current_y > 100:
-                    new_panel.disable()
-                    new_edit.disable()
-                panels[name.capitalize()+controller['name']] = new_panel
-                text_edits[name.capitalize()+controller['name']] = new_edit
-                current_y += 45
+            self.add_controller_widgets(controller, panels, text_edits)
 
         dropdown_menu['controller_select'].connect_on_item_select(self.change_custom_controller)
+        panels['live_status'].disable()
 
         self.tankWidget = WaterTankWidget([0, 0, 0])
 
@@ -169,7 +201,8 @@ class Application:
             'tank': self.tankWidget
         }
 
-        self.simulation_view = gui.Window(buttons, panels, text_edits, progress_bars, dropdown_menu, customs)
+        self.simulation_view = gui.Window(buttons, panels, text_edits, progress_bars, dropdown_menu, customs,
+                                          name='simulation')
         self.simulation_view.enable()
 
 
@@ -201,26 +234,37 @@ class Application:
         }
         buttons['go-back'].connect_function(self.return_to_simulation)
 
-        self.configuration_view = gui.Window(buttons, panels, text_edits, {}, {})
+        self.configuration_view = gui.Window(buttons, panels, text_edits, {}, {}, name='configuration')
 
     def run(self):
         timer = pygame.time.Clock()
+        overlay = self.overlay
         while self.running:
             pygame.draw.rect(self.window, (100, 200, 80), pygame.Rect(0, 0, self.width, self.height))
-            self.event_handler()
-            dt = timer.tick(60)
-
-            if self.simulation_finished:
-                if self.simulation_displaying:
-                    self.set_time_text(get_elapsed_time_string(self.elapsed_time))
-                    self.current_simulation_index = get_closest_index(self.simulation_results.time, self.elapsed_time_s)
-                    self.tankWidget.tank_level = self.simulation_results.height[self.current_simulation_index]
-                    self.elapsed_time += dt
-                    self.elapsed_time_s += dt / 1000
-            self.simulation_view.show(self.window, pygame.mouse.get_pos())
-            self.configuration_view.show(self.window, pygame.mouse.get_pos())
-
-            pygame.display.update()
+            with overlay.section('events'):
+                self.event_handler()
+            with overlay.section('plugins'):
+                self.reload_controllers()
+            dt = timer.tick(overlay.target_fps)
+
+            with overlay.section('simulation'):
+                if self.live_run is not None:
+                    self.advance_live_simulation(dt / 1000)
+                elif self.simulation_finished:
+                    if self.simulation_displaying:
+                        self.set_time_text(get_elapsed_time_string(self.elapsed_time))
+                        self.current_simulation_index = get_closest_index(self.simulation_results.time, self.elapsed_time_s)
+                        self.tankWidget.tank_level = self.simulation_results.height[self.current_simulation_index]
+                        self.elapsed_time += dt
+                        self.elapsed_time_s += dt / 1000
+            self.simulation_view.show(self.window, pygame.mouse.get_pos(), overlay)
+            self.configuration_view.show(self.window, pygame.mouse.get_pos(), overlay)
+            with overlay.section('overlay'):
+                overlay.draw(self.window)
+
+            with overlay.section('display'):
+                pygame.display.update()
+            overlay.end_frame(dt, timer.get_rawtime())
 
     def open_settings(self):
         self.simulation_view.disable()
@@ -230,19 +274,34 @@ class Application:
         self.simulation_view.enable()
         self.configuration_view.disable()
 
-    def start_simulation(self):
-        if not self.simulation_running:
-            args = {}
-            for name in self.custom_controllers[self.custom_controller_id]['variables']:
-                key = name.capitalize()+self.custom_controllers[self.custom_controller_id]['name']
-                value = self.simulation_view.text_edits[key].get_text_as_float()
-                args[name] = value
-
-            self.controller = self.custom_controllers[self.custom_controller_id]['class'](**args)
+    def create_controller(self):
+        if not self.custom_controllers:
+            return False
+        args = {}
+        for name in self.custom_controllers[self.custom_controller_id]['variables']:
+            key = name.capitalize()+self.custom_controllers[self.custom_controller_id]['name']
+            value = self.simulation_view.text_edits[key].get_text_as_float()
+            args[name] = value
+
+        # Plugins are only imported here, the first time their controller is used.
+        try:
+            controller_class = self.custom_controllers[self.custom_controller_id]['class']
+        except ImportError:
+            self.simulation_view.panels['live_status'].set_text('Controller failed to load')
+            self.simulation_view.panels['live_status'].enable()
+            return False
+        self.controller = controller_class(**args)
+        return True
 
-            simulation_thread = threading.Thread(target=self.tankWidget.tank.simulate, args=(10, 0.001, 0, self.controller, self.tankWidget.control_point,
+    def start_simulation(self):
+        if not self.simulation_running and self.create_controller():
+            total_time, dt = 10, 0.001
+            self.simulation_steps = int(round(total_time / dt))
+            self.simulation_progress = 0
+            self.simulation_cache_hits = self.simulation_cache.stats.hits
+            simulation_thread = threading.Thread(target=self.simulation_cache.simulate, args=(self.tankWidget.tank, total_time, dt, 0, self.controller, self.tankWidget.control_point,
                      self.on_simulation_finished, None,
-                     self.update_progress_bar, None,
+                     self.on_simulation_progress, None,
                      False,))
             simulation_thread.start()
             self.simulation_finished = False
@@ -250,6 +309,90 @@ class Application:
             self.simulation_view.buttons['play'].enable()
             self.simulation_view.buttons['pause'].disable()
 
+    def start_live_simulation(self):
+        if not self.simulation_running and self.create_controller():
+            self.live_run = self.tankWidget.tank.start_run(10, 0.001, 0, self.controller, self.tankWidget.control_point)
+            self.live_chunks = []
+            self.live_target = 0.0
+            self.simulation_finished = False
+            self.simulation_displaying = False
+            self.simulation_running = True
+            self.simulation_view.buttons['play'].enable()
+            self.simulation_view.buttons['pause'].disable()
+
+    def change_live_speed(self):
+        self.live_ratio_index = (self.live_ratio_index + 1) % len(self.live_ratios)
+        ratio = self.live_ratios[self.live_ratio_index]
+        self.simulation_view.buttons['speed'].hint_text.txt = 'max' if ratio is None else f'{ratio}x'
+
+    def advance_live_simulation(self, frame_time):
+        run = self.live_run
+        ratio = self.live_ratios[self.live_ratio_index]
+        start_time = run.time
+        if ratio is None:
+            self.live_target = run.total_time
+        else:
+            self.live_target = min(self.live_target + ratio * frame_time, run.total_time)
+        self.overlay.count_steps(run.advance(until=self.live_target, deadline=perf_counter() + self.frame_budget))
+
+        if len(run.results):
+            self.live_chunks.append(run.make_results(run.results.take(len(run.results))))
+        self.tankWidget.tank_level = run.x
+        self.set_time_text(get_elapsed_time_string(run.time * 1000))
+        self.update_progress_bar(100 * run.time / run.total_time)
+
+        # When the budget ran out before reaching the target, report the ratio actually achieved and drop the debt,
+        # so the simulation keeps running at the sustainable speed instead of bursting to catch up.
+        status = self.simulation_view.panels['live_status']
+        if ratio is not None and run.time < self.live_target and frame_time > 0:
+            status.set_text(f'Too slow: {(run.time - start_time) / frame_time:.0f}x of {ratio}x')
+            status.enable()
+            self.live_target = run.time
+        else:
+            status.disable()
+
+        if run.finished:
+            self.live_run = None
+            status.disable()
+            self.on_simulation_finished(SimulationResults(
+                time=np.concatenate([chunk.time for chunk in self.live_chunks]),
+                height=np.concatenate([chunk.height for chunk in self.live_chunks]),
+                error=np.concatenate([chunk.error for chunk in self.live_chunks]),
+                action=np.concatenate([chunk.action for chunk in self.live_chunks]),
+                stats=self.live_chunks[-1].stats,
+                recording=self.live_chunks[-1].recording
+            ))
+            self.live_chunks = []
+
+    def tune_controller(self):
+        if self.simulation_running or self.tuning or not self.custom_controllers:
+            return
+        controller = self.custom_controllers[self.custom_controller_id]
+        if not set(GAINS) <= set(controller['variables']):
+            return
+        self.tuning = True
+        status = self.simulation_view.panels['live_status']
+        status.set_text('Tuning...')
+        status.enable()
+        thread = threading.Thread(target=self.tune_thread, args=(controller,))
+        thread.start()
+
+    def tune_thread(self, controller):
+        ts = controller['variables'].get('ts', 0.1)
+        if 'ts' in controller['variables']:
+            ts = self.simulation_view.text_edits['Ts' + controller['name']].get_text_as_float()
+        status = self.simulation_view.panels['live_status']
+        try:
+            results = tune_pid(self.tankWidget.tank, self.tankWidget.control_point, ts=ts,
+                               controller=controller['name'], progressCallback=self.update_progress_bar)
+        except (ValueError, ImportError):
+            status.set_text('Tuning failed')
+        else:
+            for name, value in results.gains.items():
+                self.simulation_view.text_edits[name.capitalize() + controller['name']].set_text(f'{value:.4g}')
+            status.set_text(f'Tuned, cost {results.cost:.3g}')
+        self.tuning = False
+
     def play_simulation(self):
         if self.simulation_finished:
             self.simulation_displaying = True
@@ -263,6 +406,16 @@ class Application:
         self.elapsed_time = 0
         self.elapsed_time_s = 0.0
 
+    def on_simulation_progress(self, percentage):
+        # The background simulation takes fixed steps, so every percentage it reports is 1% of them. Runs read back
+        # from the cache report 100% at once without taking any.
+        if self.simulation_cache.stats.hits > self.simulation_cache_hits:
+            self.overlay.count_cache_hit()
+        else:
+            self.overlay.count_steps((percentage - self.simulation_progress) * self.simulation_steps // 100)
+        self.simulation_progress = percentage
+        self.update_progress_bar(percentage)
+
     def update_progress_bar(self, percentage):
         value = percentage/100.0
         self.simulation_view.progress_bars['progresso'].set_value(value)
@@ -277,6 +430,9 @@ class Application:
             self.simulation_view.buttons['pause'].disable()
 
     def reset(self):
+        self.live_run = None
+        self.live_chunks = []
+        self.simulation_view.panels['live_status'].disable()
         self.tankWidget.tank_level = 0.0
         self.elapsed_time = 0
         self.elapsed_time_s = 0.0
@@ -289,43 +445,13 @@ class Application:
 
     def save_simulation_results(self):
         if self.simulation_finished:
+            import easygui as g  # Only needed for the save dialog
             file = g.filesavebox('Save Simulation Results')
-            self.save_data(file)
+            if file:
+                self.save_data(file)
 
     def save_thread(self, file):
-        data_size = len(self.simulation_results.time)
-        headers = ['Time', 'Height', 'Error', 'Action']
-        units = ['', ' (m)', ' (m)', '']
-        max_time = self.simulation_results.time[data_size-1]
-
-        wb = Workbook()
-        sheet = wb.active
-        sheet.append(headers)
-
-        for i in range(0, data_size):
-            sheet.append([
-                self.simulation_results.time[i], self.simulation_results.height[i], self.simulation_results.error[i],
-                self.simulation_results.action[i]
-            ])
-        for i in range(1, 4):
-            header = headers[i]
-            chart = ScatterChart()
-            chart.title = header + ' x Time'
-            chart.style = 13
-            chart.x_axis.title = 'Time (s)'
-            chart.y_axis.title = header + units[i]
-            chart.x_axis.scaling.min = 0
-            chart.x_axis.scaling.max = max_time
-
-            x_values = Reference(sheet, min_col=1, min_row=2, max_row=data_size)
-            y_values = Reference(sheet, min_col=i+1, min_row=2, max_row=data_size)
-            series = Series(y_values, x_values)
-            chart.series.append(series)
-
-            row = 2+15*(i-1)
-            sheet.add_chart(chart, 'F'+str(row))
-
-        wb.save(file)
+        save_xlsx(self.simulation_results, file)
 
     def save_data(self, file):
         thread = threading.Thread(target=self.save_thread, args=(file,))
@@ -343,6 +469,60 @@ class Application:
                     self.simulation_view.text_edits[key].enable()
                     self.simulation_view.panels[key].enable()
 
+    def add_controller_widgets(self, controller, panels, text_edits, values=None):
+        values = values if values is not None else {}
+        current_y = 100
+        for name in controller['variables']:
+            default_value = str(values.get(name, controller['variables'][name]))
+            new_panel = gui.Panel([450, current_y], [35, 30], self.panel_image, border=gui.Border(1, gui.Color.BLACK),text=gui.Text(name.capitalize(), 16, gui.Color.BLACK))
+            new_edit = gui.TextEdit([495, current_y], [60, 30], self.panel_image, border=gui.Border(1, gui.Color.BLACK), text=gui.Text(default_value, 16, gui.Color.BLACK))
+            if current_y > 100:
+                new_panel.disable()
+                new_edit.disable()
+            panels[name.capitalize()+controller['name']] = new_panel
+            text_edits[name.capitalize()+controller['name']] = new_edit
+            current_y += 45
+
+    def remove_controller_widgets(self, controller):
+        for name in controller['variables']:
+            self.simulation_view.panels.pop(name.capitalize()+controller['name'], None)
+            self.simulation_view.text_edits.pop(name.capitalize()+controller['name'], None)
+
+    def reload_controllers(self):
+        """Applies the plugin changes found by the watcher to the controller menu and parameter widgets."""
+        changes = self.controller_watcher.poll()
+        if changes is None:
+            return
+        for file in changes.files:
+            self.simulation_cache.invalidate(file)
+
+        view = self.simulation_view
+        menu = view.dropdown_menus['controller_select']
+        names = [controller['name'] for controller in self.custom_controllers]
+        for name in changes.removed:
+            index = names.index(name)
+            names.pop(index)
+            self.remove_controller_widgets(self.custom_controllers.pop(index))
+            menu.remove_item(index)
+            self.custom_controller_id = menu.selected_item_id
+        for controller in changes.updated:
+            index = names.index(controller['name'])
+            previous = self.custom_controllers[index]
+            # Values typed in are kept, unless the parameter's default changed.
+            values = {name: view.text_edits[name.capitalize()+previous['name']].get_text()
+                      for name, value in controller['variables'].items()
+                      if name in previous['variables'] and previous['variables'][name] == value}
+            self.remove_controller_widgets(previous)
+            self.custom_controllers[index] = controller
+            self.add_controller_widgets(controller, view.panels, view.text_edits, values)
+        for controller in changes.added:
+            names.append(controller['name'])
+            self.custom_controllers.append(controller)
+            menu.add_item(controller['name'])
+            self.add_controller_widgets(controller, view.panels, view.text_edits)
+        if self.custom_controllers:
+            self.change_custom_controller(None, self.custom_controller_id)
+
     def event_handler(self):
         mouse_pos = pygame.mouse.get_pos()
         events = pygame.event.get()
@@ -350,6 +530,8 @@ class Application:
         for event in events:
             if event.type == pygame.QUIT:
                 self.close()
+            if self.overlay.handle_event(event):
+                continue
 
             self.simulation_view.event_handler(event, mouse_pos)
             self.configuration_view.event_handler(event, mouse_pos)
@@ -0,0 +1,53 @@
+"""
+Startup cost of the headless runner, cli.py, as seen by a job scheduler: the wall time of whole processes running a
+minimal scenario (interpreter startup included), and the modules imported on the way. Fails (exit status 1) when the
+median is over the budget, or when pygame or openpyxl get imported.
+
+Usage:
+    python benchmarks/bench_cli_startup.py [runs] [budget_seconds]
+"""
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+GUI_MODULES = ('pygame', 'openpyxl')
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    with tempfile.TemporaryDirectory() as directory:
+        scenario = Path(directory) / 'minimal.json'
+        scenario.write_text(json.dumps({'total_time': 0.01, 'controller': 'PID'}))
+        command = [sys.executable, str(ROOT / 'cli.py'), str(scenario), '-o', directory, '--quiet']
+
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, check=True)
+            times.append(time.perf_counter() - start)
+
+        imports = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:], check=True,
+                                 capture_output=True, text=True).stderr
+        reported = json.loads((Path(directory) / 'metrics.json').read_text())['startup_time']
+
+    imported = [line.rsplit('|', 1)[-1].strip() for line in imports.splitlines() if '|' in line]
+    gui_imports = sorted({name for name in imported if name.split('.')[0] in GUI_MODULES})
+    median = float(np.median(times))
+    print(f'{runs} runs of cli.py on a minimal scenario')
+    print(f'process wall time: median {median:.3f} s, min {min(times):.3f} s, max {max(times):.3f} s '
+          f'(budget {budget} s)')
+    print(f'startup reported by cli.py (after interpreter startup): {reported:.3f} s')
+    print(f'{len(imported)} modules imported, GUI modules: {", ".join(gui_imports) or "none"}')
+    if median > budget or gui_imports:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Cost of listing controller plugins with get_custom_controllers, for directories of generated plugins: the first
+listing (every file parsed and the index written), later listings (index read, files only stat'ed), a poll of
+ControllerWatcher finding no changes (the application polls every second), and importing every plugin, which is what
+listing used to cost and now only happens for the controllers actually used.
+
+Usage:
+    python benchmarks/bench_controller_discovery.py [counts...]
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from controller import ControllerWatcher, get_custom_controllers  # noqa: E402
+
+COUNTS = (10, 100, 500)
+PLUGIN = '''import numpy as np
+
+from controller import Controller
+
+
+class Generated{index}(Controller):
+    history = 1
+
+    def __init__(self, ts=0.1, gain={index}, offset=0.5):
+        Controller.__init__(self, ts)
+        self.gain = gain
+        self.offset = offset
+        self._table = np.linspace(0, 1, 256)
+
+    def calculate_action(self, readings, time, control_point=0.7):
+        return float(np.clip(self.offset + self.gain * (control_point - readings[-1]), 0, 1))
+'''
+
+
+def best_of(function, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or COUNTS
+    print(f'{"plugins":>8}{"first (ms)":>14}{"listing (ms)":>14}{"poll (ms)":>12}{"import all (ms)":>17}')
+    for count in counts:
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            for index in range(count):
+                (directory / f'Generated{index}.py').write_text(PLUGIN.format(index=index))
+
+            start = time.perf_counter()
+            entries = get_custom_controllers(directory)
+            first = time.perf_counter() - start
+            assert len(entries) == count
+            listing = best_of(lambda: get_custom_controllers(directory))
+            watcher = ControllerWatcher(directory, interval=0)
+            poll = best_of(watcher.poll)
+            start = time.perf_counter()
+            for entry in get_custom_controllers(directory, index_path=False):
+                entry['class']
+            import_all = time.perf_counter() - start
+        print(f'{count:>8}{1000 * first:>14.1f}{1000 * listing:>14.1f}{1000 * poll:>12.2f}'
+              f'{1000 * import_all:>17.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+Cost of each Runge-Kutta method in integrators.TABLEAUS and of the implicit methods in integrators.IMPLICIT_METHODS,
+measured on a WaterTank draining from full, which has the closed form solution sqrt(h) = sqrt(h0) - k1 * t / 2.
+The first table stops before the tank is empty; the second one runs past it, through the square root singularity.
+
+Fixed-step methods are run at several dt values, embedded pairs through simulate_45 at several tolerances. For each
+run the table shows derivative evaluations, accepted steps, evaluations per accepted step, wall time and the final
+error against the exact solution. Evaluations per accepted step include the cost of rejected steps and the savings
+of first-same-as-last reuse.
+
+The last table times the default simulate (rk4, dt = 1 ms, FAST_PATH_TIME seconds of open loop) through the rk4
+tableau's unrolled scalar_step and through the generic stages it replaces for scalar states.
+
+Results can be saved as a JSON baseline and a later run compared against it, as with bench_simulator.py: cases that
+got slower, or need more derivative evaluations, by more than --threshold are flagged and the script exits with
+status 1. benchmarks/baselines/bench_integrators.json is the saved baseline.
+
+Usage:
+    python benchmarks/bench_integrators.py [--repeat N] [--save FILE] [--compare FILE] [--threshold 0.1]
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from dataclasses import replace
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from integrators import IMPLICIT_METHODS, TABLEAUS  # noqa: E402
+from simulator import WaterTank  # noqa: E402
+
+TOTAL_TIME = 10
+EMPTY_TIME = 20
+FAST_PATH_TIME = 60
+BASELINE_VERSION = 1
+
+
+class CountingWaterTank(WaterTank):
+
+    def __init__(self):
+        WaterTank.__init__(self)
+        self.evaluations = 0
+
+    def _dx_dt(self, value, action=None):
+        self.evaluations += 1
+        return WaterTank._dx_dt(self, value, action)
+
+
+def exact_height(tank, t):
+    return max(0.0, 1 - tank._k1 * t / 2) ** 2
+
+
+def run(method, adaptive, setting, total_time, repeat=1):
+    elapsed = np.inf
+    for _ in range(repeat):
+        tank = CountingWaterTank()
+        start = time.perf_counter()
+        if adaptive:
+            results = tank.simulate_45(total_time, dt=1e-3, x0=1, tol=setting, returnValues=True, method=method)
+        else:
+            results = tank.simulate(total_time, dt=setting, x0=1, returnValues=True, method=method)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    steps = len(results.time) - 1
+    rejected = results.stats.rejected if results.stats else 0
+    error = abs(results.height[-1] - exact_height(tank, results.time[-1]))
+    return tank.evaluations, steps, rejected, elapsed, error
+
+
+def table(total_time, repeat):
+    print(f'{"method":<16}{"mode":<10}{"dt/tol":>10}{"evals":>10}{"steps":>10}{"rejected":>10}{"evals/step":>12}'
+          f'{"time (s)":>10}{"error":>12}')
+    results = {}
+    for name, method in list(TABLEAUS.items()) + list(IMPLICIT_METHODS.items()):
+        settings = [(False, dt) for dt in (1e-2, 1e-3)]
+        if method.adaptive:
+            settings += [(True, tol) for tol in (1e-6, 1e-9)]
+        for adaptive, setting in settings:
+            evaluations, steps, rejected, elapsed, error = run(name, adaptive, setting, total_time, repeat)
+            mode = 'adaptive' if adaptive else 'fixed'
+            results[f'{name}/{mode}/{setting:.0e}/{total_time}s'] = {'time': elapsed, 'evaluations': evaluations}
+            print(f'{name:<16}{mode:<10}{setting:>10.0e}{evaluations:>10}{steps:>10}'
+                  f'{rejected:>10}{evaluations / steps:>12.2f}{elapsed:>10.3f}{error:>12.2e}')
+    return results
+
+
+def fast_path(repeat):
+    print(f'{"rk4 scalar step":<24}{"time (s)":>10}{"steps/s":>12}')
+    results = {}
+    generic = replace(TABLEAUS['rk4'], scalar_step=None)
+    for label, method in (('unrolled', 'rk4'), ('generic stages', generic)):
+        evaluations, steps, _, elapsed, _ = run(method, False, 1e-3, FAST_PATH_TIME, repeat)
+        results[f'rk4 {label}/open loop/{FAST_PATH_TIME}s'] = {'time': elapsed, 'evaluations': evaluations}
+        print(f'{label:<24}{elapsed:>10.3f}{steps / elapsed:>12.0f}')
+    return results
+
+
+def save(path, results):
+    baseline = {
+        'version': BASELINE_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cases': results,
+    }
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_text(json.dumps(baseline, indent=2))
+    print(f'\nBaseline saved to {path}')
+
+
+def compare(path, results, threshold):
+    """Prints the change of every case against a saved baseline and returns the number of regressions."""
+    baseline = json.loads(Path(path).read_text())
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError(f'{path} is a version {baseline.get("version")} baseline, expected {BASELINE_VERSION}')
+    print(f'\nCompared with {path} ({baseline["created"]}, {baseline["platform"]})')
+    print(f'{"case":<40}{"speed":>10}{"evals":>10}')
+    regressions = 0
+    for name, case in results.items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            print(f'{name:<40}{"new case":>10}')
+            continue
+        speed = old['time'] / case['time']
+        evaluations = case['evaluations'] / max(old['evaluations'], 1)
+        flags = [label for label, regressed in (('slower', speed < 1 - threshold),
+                                                ('more evaluations', evaluations > 1 + threshold)) if regressed]
+        regressions += bool(flags)
+        print(f'{name:<40}{speed:>9.2f}x{evaluations:>9.2f}x{"  REGRESSION: " + ", ".join(flags) if flags else ""}')
+    print(f'{regressions} regressions beyond {100 * threshold:g}%')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the integration methods on a draining WaterTank.')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per case, the best one is kept')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change flagged as a regression')
+    options = parser.parse_args()
+    repeat = max(1, options.repeat)
+
+    np.seterr(all='ignore')
+    print(f'Draining for {TOTAL_TIME} s')
+    results = table(TOTAL_TIME, repeat)
+    print(f'\nDraining to empty, for {EMPTY_TIME} s')
+    results.update(table(EMPTY_TIME, repeat))
+    print(f'\nDefault simulate, open loop for {FAST_PATH_TIME} s')
+    results.update(fast_path(repeat))
+    if options.save:
+        save(options.save, results)
+    if options.compare and compare(options.compare, results, options.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
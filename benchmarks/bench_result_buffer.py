@@ -0,0 +1,71 @@
+"""
+Compares the memory and throughput of recording simulation samples into Python lists (the previous
+_generic_simulate path) against the chunked ResultBuffer.
+
+Usage:
+    python benchmarks/bench_result_buffer.py [steps]
+"""
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from buffers import ResultBuffer  # noqa: E402
+from simulator import WaterTank  # noqa: E402
+
+
+def record_with_lists(steps):
+    time_, x, error, action = [0.0], [0.0], [0.7], [0.0]
+    xn = 0.0
+    for i in range(1, steps):
+        xn += 1e-4
+        time_.append(i * 0.001)
+        x.append(xn)
+        error.append(0.7 - xn)
+        action.append(1.0)
+    return np.array(time_), np.array(x), np.array(error), np.array(action)
+
+
+def record_with_buffer(steps):
+    buffer = ResultBuffer(('time', 'height', 'error', 'action'))
+    buffer.append(0.0, 0.0, 0.7, 0.0)
+    xn = 0.0
+    for i in range(1, steps):
+        xn += 1e-4
+        buffer.append(i * 0.001, xn, 0.7 - xn, 1.0)
+    return buffer.to_dict()
+
+
+def measure(function, *args):
+    # Timing and memory are taken on separate runs, since tracemalloc slows down every allocation.
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f'Recording {steps} samples of 4 fields')
+    print(f'{"path":<10}{"time (s)":>12}{"steps/s":>14}{"peak (MiB)":>14}')
+    for name, function in [('lists', record_with_lists), ('buffer', record_with_buffer)]:
+        elapsed, peak = measure(function, steps)
+        print(f'{name:<10}{elapsed:>12.3f}{steps / elapsed:>14.0f}{peak / 2 ** 20:>14.1f}')
+
+    tank = WaterTank()
+    start = time.perf_counter()
+    results = tank.simulate(total_time=10, dt=0.001, returnValues=True)
+    elapsed = time.perf_counter() - start
+    print(f'\nWaterTank.simulate (10 s, dt=0.001): {len(results.time) / elapsed:.0f} steps/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Throughput and memory of WaterTank.simulate (rk4 at several dt values) and simulate_45 (dp54 at several tolerances),
+for every controller in Controllers/ and for horizons from 10 s to one hour.
+
+For each case the table shows steps per second, derivative evaluations per second, peak traced memory and the share
+of the wall time spent inside the controller. Timing and memory are taken on separate runs, since tracemalloc slows
+down every allocation; the timing is the best of --repeat runs.
+
+Results can be saved as a JSON baseline, and a later run compared against it: cases whose throughput dropped, or
+whose memory or derivative evaluations grew, by more than --threshold (relative) are flagged as regressions, and the
+script exits with status 1. Runs headless, pygame is not needed.
+
+Usage:
+    python benchmarks/bench_simulator.py [--quick] [--repeat N] [--save FILE] [--compare FILE] [--threshold 0.1]
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from controller import get_custom_controllers  # noqa: E402
+from simulator import WaterTank  # noqa: E402
+
+HORIZONS = (10, 60, 600, 3600)
+QUICK_HORIZONS = (10, 60)
+FIXED_DT = (1e-2, 1e-3)
+TOLERANCES = (1e-6, 1e-9)
+BASELINE_VERSION = 1
+
+
+class CountingWaterTank(WaterTank):
+
+    def __init__(self):
+        WaterTank.__init__(self)
+        self.evaluations = 0
+
+    def _dx_dt(self, value, action=None):
+        self.evaluations += 1
+        return WaterTank._dx_dt(self, value, action)
+
+
+def timed_controller(controller):
+    """Wraps the controller's calculate_action to accumulate the time spent in it, in controller.elapsed."""
+    calculate_action = controller.calculate_action
+    controller.elapsed = 0.0
+
+    def timed(readings, times, control_point):
+        start = time.perf_counter()
+        action = calculate_action(readings, times, control_point)
+        controller.elapsed += time.perf_counter() - start
+        return action
+
+    controller.calculate_action = timed
+    return controller
+
+
+def simulate(tank, controller, adaptive, setting, horizon):
+    if adaptive:
+        return tank.simulate_45(horizon, dt=1e-3, tol=setting, controller=controller, returnValues=True)
+    return tank.simulate(horizon, dt=setting, controller=controller, returnValues=True)
+
+
+def run_case(controller_class, adaptive, setting, horizon, repeat):
+    elapsed = np.inf
+    controller_time = 0.0
+    for _ in range(repeat):
+        controller = timed_controller(controller_class())
+        start = time.perf_counter()
+        results = simulate(WaterTank(), controller, adaptive, setting, horizon)
+        run_time = time.perf_counter() - start
+        if run_time < elapsed:
+            elapsed, controller_time = run_time, controller.elapsed
+    steps = results.stats.accepted if results.stats else len(results.time) - 1
+
+    tank = CountingWaterTank()
+    tracemalloc.start()
+    simulate(tank, controller_class(), adaptive, setting, horizon)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'time': elapsed,
+        'steps': int(steps),
+        'steps_per_s': steps / elapsed,
+        'evaluations': tank.evaluations,
+        'evaluations_per_s': tank.evaluations / elapsed,
+        'peak_memory': peak,
+        'controller_time': controller_time,
+        'controller_share': controller_time / elapsed,
+    }
+
+
+def cases(horizons):
+    for entry in get_custom_controllers(ROOT / 'Controllers'):
+        for horizon in horizons:
+            settings = [(False, dt) for dt in FIXED_DT] + [(True, tol) for tol in TOLERANCES]
+            for adaptive, setting in settings:
+                name = f'{entry["name"]}/{"dp54" if adaptive else "rk4"}/{setting:.0e}/{horizon}s'
+                yield name, entry['class'], adaptive, setting, horizon
+
+
+def benchmark(horizons, repeat):
+    print(f'{"case":<28}{"time (s)":>10}{"steps/s":>12}{"evals/s":>12}{"peak (MiB)":>12}{"controller":>12}')
+    results = {}
+    for name, controller_class, adaptive, setting, horizon in cases(horizons):
+        case = run_case(controller_class, adaptive, setting, horizon, repeat)
+        results[name] = case
+        print(f'{name:<28}{case["time"]:>10.3f}{case["steps_per_s"]:>12.0f}{case["evaluations_per_s"]:>12.0f}'
+              f'{case["peak_memory"] / 2 ** 20:>12.2f}{100 * case["controller_share"]:>11.1f}%')
+    return results
+
+
+def save(path, results):
+    baseline = {
+        'version': BASELINE_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cases': results,
+    }
+    Path(path).write_text(json.dumps(baseline, indent=2))
+    print(f'\nBaseline saved to {path}')
+
+
+def compare(path, results, threshold):
+    """Prints the change of every case against a saved baseline and returns the number of regressions."""
+    baseline = json.loads(Path(path).read_text())
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError(f'{path} is a version {baseline.get("version")} baseline, expected {BASELINE_VERSION}')
+    print(f'\nCompared with {path} ({baseline["created"]}, {baseline["platform"]})')
+    print(f'{"case":<28}{"steps/s":>12}{"evals":>12}{"peak":>12}')
+    regressions = 0
+    for name, case in results.items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            print(f'{name:<28}{"new case":>12}')
+            continue
+        speed = case['steps_per_s'] / old['steps_per_s']
+        evaluations = case['evaluations'] / max(old['evaluations'], 1)
+        memory = case['peak_memory'] / max(old['peak_memory'], 1)
+        flags = [label for label, regressed in (('slower', speed < 1 - threshold),
+                                                ('more evaluations', evaluations > 1 + threshold),
+                                                ('more memory', memory > 1 + threshold)) if regressed]
+        regressions += bool(flags)
+        print(f'{name:<28}{speed:>11.2f}x{evaluations:>11.2f}x{memory:>11.2f}x'
+              f'{"  REGRESSION: " + ", ".join(flags) if flags else ""}')
+    print(f'{regressions} regressions beyond {100 * threshold:g}%')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks WaterTank.simulate and simulate_45.')
+    parser.add_argument('--quick', action='store_true', help=f'only run the {QUICK_HORIZONS} s horizons')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per case, the best one is kept')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change flagged as a regression')
+    options = parser.parse_args()
+
+    np.seterr(all='ignore')
+    results = benchmark(QUICK_HORIZONS if options.quick else HORIZONS, max(1, options.repeat))
+    if options.save:
+        save(options.save, results)
+    if options.compare and compare(options.compare, results, options.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import numpy as np
+
+
+# Growable, chunked storage for simulation samples.
+# Samples are written by index into preallocated NumPy chunks, so a run never keeps one Python object per value
+# and never copies what it already stored while growing. The exact-size arrays are only built once, on demand.
+class ResultBuffer:
+
+    def __init__(self, fields, chunk_size=4096, dtype=float):
+        """
+        fields: sequence of field names, or a dict mapping each name to the shape of a single sample.
+        chunk_size: number of samples allocated at a time.
+        """
+        if not isinstance(fields, dict):
+            fields = {name: () for name in fields}
+        self.fields = {name: tuple(shape) for name, shape in fields.items()}
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+
+        self._full_chunks = {name: [] for name in self.fields}
+        self._chunk = None
+        self._stored = 0
+        self._index = 0
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self._chunk = {name: np.empty((self.chunk_size,) + shape, dtype=self.dtype)
+                       for name, shape in self.fields.items()}
+        # Scalar fields are written through memoryviews, which is several times cheaper than NumPy's __setitem__.
+        self._writers = [memoryview(array) if array.ndim == 1 else array for array in self._chunk.values()]
+        self._index = 0
+
+    def append(self, *values):
+        """Stores one sample. Values are given in the same order as the fields."""
+        index = self._index
+        if index == self.chunk_size:
+            for name in self.fields:
+                self._full_chunks[name].append(self._chunk[name])
+            self._stored += self.chunk_size
+            self._new_chunk()
+            index = 0
+        for writer, value in zip(self._writers, values):
+            writer[index] = value
+        self._index = index + 1
+
+    def __len__(self):
+        return self._stored + self._index
+
+    def column(self, name):
+        """Returns an exact-size copy of every sample stored for a field."""
+        parts = self._full_chunks[name] + [self._chunk[name][:self._index]]
+        if len(parts) == 1:
+            return parts[0].copy()
+        return np.concatenate(parts)
+
+    def last(self, name):
+        """Returns the most recent sample of a field."""
+        if self._index == 0:
+            return self._full_chunks[name][-1][-1]
+        return self._chunk[name][self._index - 1]
+
+    def to_dict(self):
+        return {name: self.column(name) for name in self.fields}
+
+    def take(self, count):
+        """Removes the `count` oldest samples and returns them as a dict of exact-size arrays."""
+        columns = self.to_dict()
+        self.clear()
+        remainder = len(next(iter(columns.values()))) - count
+        if remainder > 0:
+            for values in zip(*(column[count:] for column in columns.values())):
+                self.append(*values)
+        return {name: column[:count] for name, column in columns.items()}
+
+    def clear(self):
+        self._full_chunks = {name: [] for name in self.fields}
+        self._stored = 0
+        self._new_chunk()
+
+
+# Fixed-size window over the most recent samples of a signal.
+# Every value is written twice, at position i and i + size, so the last `size` samples are always contiguous
+# and view() can return a slice of the storage instead of a copy.
+class HistoryWindow:
+
+    def __init__(self, size, shape=(), dtype=float):
+        self.size = size
+        self._data = np.zeros((2 * size,) + tuple(shape), dtype=dtype)
+        self._writer = memoryview(self._data) if self._data.ndim == 1 else self._data
+        self._position = 0
+        self._count = 0
+
+    def append(self, value):
+        position = self._position
+        self._writer[position] = value
+        self._writer[position + self.size] = value
+        self._position = (position + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def view(self):
+        """Returns a read-only view of the stored samples, oldest first. It is only valid until the next append."""
+        end = self._position + self.size
+        view = self._data[end - self._count:end]
+        view.flags.writeable = False
+        return view
+
+
+# Every sample of a signal, for controllers that read their whole input history (history = None).
+# Samples are kept in one contiguous array that doubles when it is full, so view() returns all of them without a
+# copy and appending stays amortized O(1).
+class GrowingHistory:
+
+    def __init__(self, shape=(), capacity=4096, dtype=float):
+        self._data = np.empty((capacity,) + tuple(shape), dtype=dtype)
+        self._count = 0
+
+    def append(self, value):
+        if self._count == len(self._data):
+            data = np.empty((2 * len(self._data),) + self._data.shape[1:], dtype=self._data.dtype)
+            data[:self._count] = self._data
+            self._data = data
+        self._data[self._count] = value
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def view(self):
+        """Returns a read-only view of the stored samples, oldest first. It is only valid until the next append."""
+        view = self._data[:self._count]
+        view.flags.writeable = False
+        return view
+
+
+def history_buffers(size, shape=()):
+    """
+    Buffers of the readings and sample times a controller reads: windows over the last `size` samples, or every
+    sample when size is None (Controller.history). shape is the shape of one reading.
+    """
+    if size:
+        return HistoryWindow(size, shape), HistoryWindow(size)
+    return GrowingHistory(shape), GrowingHistory()
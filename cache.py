@@ -0,0 +1,351 @@
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from pathlib import Path
+
+import numpy as np
+
+from integrators import StepStatistics
+from metrics import METRIC_NAMES
+from simulator import SimulationResults
+
+# Bumped whenever the stored format or the simulator's numerics change, so that older entries are never returned.
+CACHE_VERSION = 2
+
+ARRAY_FIELDS = ('time', 'height', 'error', 'action', 'state')
+
+# Attributes systems keep about their last run, which are not parameters.
+RUN_ATTRIBUTES = ('simulation_results', 'last_checkpoint')
+
+
+@dataclass
+class CacheStatistics:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    bypassed: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self):
+        return (f'{self.hits} hits ({self.disk_hits} from disk), {self.misses} misses, {self.bypassed} bypassed '
+                f'({100 * self.hit_rate:.0f}% hit rate), {self.evictions} evictions, '
+                f'{self.invalidations} invalidations')
+
+
+# Content-addressed cache of simulation results.
+# Entries are keyed by a hash of everything a simulation depends on: the plant's parameters, the source file of the
+# controller's class, the controller's arguments and state, the set point, x0, dt, tolerance and method. Results
+# live in an in-memory LRU limited to `max_bytes` of arrays and, when `directory` is given, in compressed .npz files
+# there, which outlive the application. Runs whose settings cannot be hashed (tasks or callbacks among them) and
+# instrumented runs are simulated without caching. Cached arrays are read-only. A cache can be shared by threads: the
+# application simulates in the background while its main thread invalidates entries of edited controllers.
+class SimulationCache:
+
+    def __init__(self, max_bytes=64 * 2 ** 20, directory=None, controllers_path='Controllers'):
+        self.max_bytes = max_bytes
+        self.directory = Path(directory) if directory is not None else None
+        self.controllers_path = Path(controllers_path)
+        self.stats = CacheStatistics()
+        self.size = 0
+        self._entries = OrderedDict()
+        self._sources = {}
+        self._checkpoints = {}
+        self._file_hashes = {}
+        self._controller_files = self._scan_controllers()
+        self._lock = threading.RLock()
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def simulate(self, system, total_time=10, dt=0.001, x0=0, controller=None, control_point=0.7, onFinished=None,
+                 args=None, progressCallback=None, callbackArgs=None, returnValues=False, **kwargs):
+        """Cached DynamicSystem.simulate. Takes the same arguments."""
+        return self._simulate(system.simulate, system, total_time, dt, x0, controller, control_point, onFinished, args,
+                              progressCallback, callbackArgs, returnValues, kwargs)
+
+    def simulate_45(self, system, total_time=10, dt=0.001, x0=0, tol=1e-6, controller=None, control_point=0.7,
+                    onFinished=None, args=None, progressCallback=None, callbackArgs=None, returnValues=False,
+                    **kwargs):
+        """Cached DynamicSystem.simulate_45. Takes the same arguments."""
+        kwargs['tol'] = tol
+        return self._simulate(system.simulate_45, system, total_time, dt, x0, controller, control_point, onFinished,
+                              args, progressCallback, callbackArgs, returnValues, kwargs)
+
+    def _simulate(self, simulate, system, total_time, dt, x0, controller, control_point, onFinished, args,
+                  progressCallback, callbackArgs, returnValues, kwargs):
+        key, source = self._lookup_key(simulate.__name__, system, total_time, dt, x0, controller, control_point,
+                                       kwargs)
+        results, checkpoint = self._get(key) if key is not None else (None, None)
+        if results is None:
+            results = simulate(total_time=total_time, dt=dt, x0=x0, controller=controller, control_point=control_point,
+                               progressCallback=progressCallback, callbackArgs=callbackArgs, returnValues=True,
+                               **kwargs)
+            if key is not None:
+                self.put(key, results, source, system.last_checkpoint)
+        else:
+            # The system is left as the run would have left it, so resume(system.last_checkpoint, ...) extends it.
+            system.simulation_results = results
+            system.last_checkpoint = checkpoint
+            if progressCallback:
+                progress_args = (100,) + (callbackArgs if callbackArgs is not None else ())
+                progressCallback(*progress_args)
+
+        if onFinished:
+            on_finished_args = (results,) + (args if args is not None else ())
+            onFinished(*on_finished_args)
+
+        if returnValues:
+            return results
+
+    def _lookup_key(self, function, system, total_time, dt, x0, controller, control_point, kwargs):
+        """Returns the key of a run and the controller source file it depends on, or (None, None) to bypass."""
+        self._check_controllers()
+        source = None
+        # Tasks have side effects (sensor samples, cascaded set points) that a cached run would not reproduce.
+        # Instrumented runs measure their own execution, a cached run's timings would be stale.
+        if kwargs.get('tasks') or kwargs.get('instrument'):
+            self.stats.bypassed += 1
+            return None, None
+        try:
+            controller_data = None
+            if controller is not None:
+                source = _class_file(type(controller))
+                controller_data = (_qualified_name(type(controller)), self._source_hash(type(controller), source),
+                                   _canonical(vars(controller)))
+            parameters = {name: value for name, value in vars(system).items() if name not in RUN_ATTRIBUTES}
+            key = self.key(function, _qualified_name(type(system)), _canonical(parameters), controller_data,
+                           total_time, dt, x0, control_point, kwargs)
+        except TypeError:
+            self.stats.bypassed += 1
+            return None, None
+        return key, source
+
+    @staticmethod
+    def key(*values):
+        """Stable hash of any nesting of numbers, strings, arrays, sequences, dicts and plain objects."""
+        text = repr((CACHE_VERSION, _canonical(values)))
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the results stored under key, or None. Disk entries are promoted to memory."""
+        return self._get(key)[0]
+
+    def _get(self, key):
+        """Returns the results and the final checkpoint stored under key, or (None, None)."""
+        with self._lock:
+            results = self._entries.get(key)
+            if results is not None:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return results, self._checkpoints.get(key)
+
+            path = self._path(key)
+            if path is not None and path.exists():
+                try:
+                    results, source, checkpoint = _load(path)
+                except (OSError, ValueError, KeyError):
+                    path.unlink(missing_ok=True)
+                else:
+                    self._remember(key, results, source, checkpoint)
+                    self.stats.hits += 1
+                    self.stats.disk_hits += 1
+                    return results, checkpoint
+            self.stats.misses += 1
+            return None, None
+
+    def put(self, key, results, source=None, checkpoint=None):
+        """
+        Stores results under key. source is the controller file whose changes invalidate them, and checkpoint the
+        run's final simulator.Checkpoint, given back to the system on a hit.
+        """
+        with self._lock:
+            results = _read_only(results)
+            self._remember(key, results, source, checkpoint)
+            path = self._path(key)
+            if path is not None:
+                # Written to a temporary file first, so a reader never sees a partial entry.
+                temporary = path.with_suffix('.tmp.npz')
+                _save(temporary, results, source, checkpoint)
+                os.replace(temporary, path)
+            return results
+
+    def _remember(self, key, results, source, checkpoint=None):
+        if key in self._entries:
+            self._forget(key)
+        nbytes = _nbytes(results)
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = results
+        self._sources[key] = source
+        self._checkpoints[key] = checkpoint
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            self._forget(next(iter(self._entries)))
+            self.stats.evictions += 1
+
+    def _forget(self, key):
+        self.size -= _nbytes(self._entries.pop(key))
+        self._sources.pop(key, None)
+        self._checkpoints.pop(key, None)
+
+    def _path(self, key):
+        return self.directory / f'{key}.npz' if self.directory is not None else None
+
+    def clear(self, disk=True):
+        """Empties the memory tier and, with disk=True, removes the on-disk entries too."""
+        with self._lock:
+            self._entries.clear()
+            self._sources.clear()
+            self._checkpoints.clear()
+            self.size = 0
+            if disk and self.directory is not None:
+                for path in self.directory.glob('*.npz'):
+                    path.unlink(missing_ok=True)
+
+    def invalidate(self, source):
+        """Drops every entry, in memory and on disk, computed with a controller from the file `source`."""
+        with self._lock:
+            source = str(Path(source).resolve())
+            for key in [key for key, entry_source in self._sources.items() if entry_source == source]:
+                self._forget(key)
+                self.stats.invalidations += 1
+            if self.directory is not None:
+                for path in self.directory.glob('*.npz'):
+                    try:
+                        with np.load(path, allow_pickle=False) as data:
+                            stale = str(data['source']) == source
+                    except (OSError, ValueError, KeyError):
+                        stale = True
+                    if stale:
+                        path.unlink(missing_ok=True)
+                        self.stats.invalidations += 1
+            self._file_hashes = {file: value for file, value in self._file_hashes.items() if file[0] != source}
+
+    def _scan_controllers(self):
+        if not self.controllers_path.is_dir():
+            return {}
+        files = {}
+        for path in self.controllers_path.glob('*.py'):
+            stat = path.stat()
+            files[str(path.resolve())] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def _check_controllers(self):
+        """Invalidates the entries of every controller file changed or removed since the last check."""
+        with self._lock:
+            files = self._scan_controllers()
+            if files != self._controller_files:
+                for source, stamp in self._controller_files.items():
+                    if files.get(source) != stamp:
+                        self.invalidate(source)
+                self._controller_files = files
+
+    def _source_hash(self, cls, source):
+        # The whole module file is hashed, so changes to helpers next to the class count too. Hashes are kept per
+        # modification time to avoid reading the file on every run.
+        if source is None:
+            try:
+                return hashlib.sha256(inspect.getsource(cls).encode()).hexdigest()
+            except (OSError, TypeError):
+                return None
+        stamp = os.stat(source).st_mtime_ns
+        with self._lock:
+            file_hash = self._file_hashes.get((source, stamp))
+            if file_hash is None:
+                file_hash = hashlib.sha256(Path(source).read_bytes()).hexdigest()
+                self._file_hashes[(source, stamp)] = file_hash
+        return file_hash
+
+
+def _qualified_name(cls):
+    return f'{cls.__module__}.{cls.__qualname__}'
+
+
+def _class_file(cls):
+    try:
+        source = inspect.getsourcefile(cls)
+    except TypeError:
+        # Classes loaded by get_custom_controllers are not in sys.modules; their methods still know their file.
+        codes = [member.__code__ for member in vars(cls).values() if inspect.isfunction(member)]
+        source = codes[0].co_filename if codes else None
+    return str(Path(source).resolve()) if source else None
+
+
+def _canonical(value):
+    """Converts value into nested tuples of plain values with a stable repr. Raises TypeError for callables."""
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, (float, np.floating)):
+        return float(value).hex()
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        return ('array', array.dtype.str, array.shape, hashlib.sha256(array.tobytes()).hexdigest())
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(item) for item in value)
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((str(name), _canonical(item)) for name, item in value.items()))
+    if callable(value) or not hasattr(value, '__dict__'):
+        raise TypeError(f'Cannot hash {type(value).__name__} values')
+    # Underscore attributes are the object's runtime state (a recording policy's counters, ...), not its settings.
+    return (_qualified_name(type(value)),
+            _canonical({name: item for name, item in vars(value).items() if not name.startswith('_')}))
+
+
+def _nbytes(results):
+    return sum(getattr(results, name).nbytes for name in ARRAY_FIELDS if getattr(results, name) is not None)
+
+
+def _read_only(results):
+    for name in ARRAY_FIELDS:
+        array = getattr(results, name)
+        if array is not None:
+            array.setflags(write=False)
+    return results
+
+
+# Checkpoints are stored pickled, as bytes. Like the rest of the cache directory, they are only read back by the
+# application that wrote them. Checkpoints that cannot be pickled, or no longer unpickle, are left out.
+def _save(path, results, source, checkpoint=None):
+    arrays = {name: getattr(results, name) for name in ARRAY_FIELDS if getattr(results, name) is not None}
+    if results.stats is not None:
+        arrays['stats'] = np.array([getattr(results.stats, field.name) for field in fields(StepStatistics)])
+    if results.metrics is not None:
+        arrays['metrics'] = np.array([results.metrics[name] for name in METRIC_NAMES])
+    if checkpoint is not None:
+        try:
+            arrays['checkpoint'] = np.frombuffer(pickle.dumps(checkpoint), dtype=np.uint8)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            pass
+    np.savez_compressed(path, recording=np.array(results.recording), source=np.array(source or ''), **arrays)
+
+
+def _load(path):
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {name: data[name] for name in ARRAY_FIELDS if name in data}
+        stats = StepStatistics(*(int(value) for value in data['stats'])) if 'stats' in data else None
+        metrics = dict(zip(METRIC_NAMES, data['metrics'].tolist())) if 'metrics' in data else None
+        recording = str(data['recording'])
+        source = str(data['source']) or None
+        checkpoint = None
+        if 'checkpoint' in data:
+            try:
+                checkpoint = pickle.loads(data['checkpoint'].tobytes())
+            except Exception:
+                pass
+    results = _read_only(SimulationResults(stats=stats, recording=recording, metrics=metrics, **arrays))
+    return results, source, checkpoint
@@ -0,0 +1,214 @@
+"""
+Headless batch runner: simulates the runs of a JSON or TOML scenario file and writes their results and metrics,
+without pygame. Meant to be started many times by a job scheduler, so only the standard library is imported at
+startup; NumPy, the simulator and the controllers are imported once the scenario has been read, and openpyxl only
+when results are written as .xlsx. The startup time (up to the first simulation) is reported in metrics.json and
+checked against --startup-budget.
+
+A scenario holds default settings and a list of runs, which override them:
+
+    total_time = 20
+    method = "rk4"
+
+    [[runs]]
+    name = "pid"
+    controller = "PID"
+    controller_kwargs = {Kp = 8, Ki = 0.5}
+
+    [[runs]]
+    name = "onoff-wide"
+    controller = "OnOff"
+    plant = {type = "WaterTank", tank_area = 0.12}
+
+A file without `runs` is a single run. See RUN_SETTINGS for every setting.
+
+Usage:
+    python cli.py scenario.toml [-o OUTPUT] [--format npz|csv|xlsx] [--cache DIR] [--quiet]
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+START = time.perf_counter()
+
+# Settings of a run and their defaults. plant holds the plant's constructor arguments, and its type (a class in
+# PLANTS). Runs without a controller simulate the open loop.
+RUN_SETTINGS = {
+    'name': None,
+    'plant': {},
+    'controller': None,
+    'controller_kwargs': {},
+    'control_point': 0.7,
+    'x0': 0,
+    'total_time': 10,
+    'dt': 0.001,
+    'method': None,
+    'adaptive': False,
+    'tol': 1e-6,
+    'output_dt': None,
+    'relinearize': 0,
+    'instrument': False,
+}
+PLANTS = ('WaterTank', 'CascadedWaterTanks', 'InvertedPendulum', 'LinearSystem')
+STARTUP_BUDGET = 0.5
+
+
+class ScenarioError(ValueError):
+    pass
+
+
+def load_scenario(path):
+    """Reads a scenario file and returns its runs, each one a complete dict of RUN_SETTINGS."""
+    path = Path(path)
+    if path.suffix.lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ScenarioError('TOML scenarios need Python 3.11 or the tomli package') from None
+        with open(path, 'rb') as file:
+            scenario = tomllib.load(file)
+    else:
+        with open(path) as file:
+            scenario = json.load(file)
+
+    runs = scenario.pop('runs', None)
+    if runs is None:
+        runs = [{}]
+    defaults = dict(RUN_SETTINGS, **scenario)
+    complete = []
+    for index, run in enumerate(runs):
+        settings = dict(defaults, **run)
+        unknown = sorted(set(settings) - set(RUN_SETTINGS))
+        if unknown:
+            raise ScenarioError(f'Unknown settings in run {index}: {", ".join(unknown)}')
+        if settings['name'] is None:
+            settings['name'] = f'run{index}' if len(runs) > 1 else path.stem
+        complete.append(settings)
+    names = [run['name'] for run in complete]
+    if len(set(names)) != len(names):
+        raise ScenarioError('Run names must be unique, they name the result files')
+    return complete
+
+
+def make_plant(settings):
+    import simulator
+
+    parameters = dict(settings['plant'])
+    plant_type = parameters.pop('type', 'WaterTank')
+    if plant_type not in PLANTS:
+        raise ScenarioError(f'Unknown plant {plant_type}, use one of {", ".join(PLANTS)}')
+    return getattr(simulator, plant_type)(**parameters)
+
+
+def make_controller(settings, controllers):
+    name = settings['controller']
+    if name is None:
+        return None
+    if name not in controllers:
+        raise ScenarioError(f'Unknown controller {name}, use one of {", ".join(sorted(controllers))}')
+    return controllers[name]['class'](**settings['controller_kwargs'])
+
+
+def simulate(settings, controllers, cache=None):
+    """Runs one simulation of a scenario and returns its SimulationResults."""
+    plant = make_plant(settings)
+    controller = make_controller(settings, controllers)
+    target = cache if cache is not None else plant
+    arguments = [plant] if cache is not None else []
+    if settings['adaptive']:
+        return target.simulate_45(*arguments, total_time=settings['total_time'], dt=settings['dt'],
+                                  x0=settings['x0'], tol=settings['tol'], controller=controller,
+                                  control_point=settings['control_point'], returnValues=True,
+                                  method=settings['method'] or 'dp54', output_dt=settings['output_dt'],
+                                  instrument=settings['instrument'], metrics=True)
+    return target.simulate(*arguments, total_time=settings['total_time'], dt=settings['dt'], x0=settings['x0'],
+                           controller=controller, control_point=settings['control_point'], returnValues=True,
+                           method=settings['method'] or 'rk4', relinearize=settings['relinearize'],
+                           instrument=settings['instrument'], metrics=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the simulations of a scenario file without the GUI.')
+    parser.add_argument('scenario', help='JSON or TOML scenario file')
+    parser.add_argument('-o', '--output', help='output directory, the scenario name followed by _results by default')
+    parser.add_argument('--format', default='npz', choices=('npz', 'csv', 'xlsx'), help='format of the results')
+    parser.add_argument('--cache', metavar='DIR', help='reuse results cached in DIR (see cache.py)')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET,
+                        help='seconds allowed from start to the first simulation before warning')
+    parser.add_argument('--quiet', action='store_true', help='do not print the metrics table')
+    options = parser.parse_args(argv)
+
+    try:
+        runs = load_scenario(options.scenario)
+    except (OSError, ValueError) as error:
+        print(f'{options.scenario}: {error}', file=sys.stderr)
+        return 2
+
+    import numpy as np
+
+    from controller import get_custom_controllers
+    from export import save_results
+    from metrics import METRIC_NAMES
+
+    np.seterr(all='ignore')
+    controllers = {entry['name']: entry for entry in
+                   get_custom_controllers(Path(__file__).resolve().parent / 'Controllers')}
+    cache = None
+    if options.cache:
+        from cache import SimulationCache
+        cache = SimulationCache(directory=options.cache)
+
+    output = Path(options.output or f'{Path(options.scenario).stem}_results')
+    output.mkdir(parents=True, exist_ok=True)
+    startup_time = time.perf_counter() - START
+    if startup_time > options.startup_budget:
+        print(f'Startup took {startup_time:.3f} s, over the {options.startup_budget} s budget', file=sys.stderr)
+
+    summary = {'scenario': str(options.scenario), 'startup_time': startup_time, 'runs': {}}
+    status = 0
+    for settings in runs:
+        start = time.perf_counter()
+        try:
+            results = simulate(settings, controllers, cache)
+        except (ValueError, TypeError, ImportError) as error:
+            print(f'{settings["name"]}: {error}', file=sys.stderr)
+            summary['runs'][settings['name']] = {'settings': settings, 'error': str(error)}
+            status = 1
+            continue
+        elapsed = time.perf_counter() - start
+        file = output / f'{settings["name"]}.{options.format}'
+        save_results(results, file)
+        entry = {'settings': settings, 'results': file.name, 'wall_time': elapsed, 'samples': len(results.time),
+                 'metrics': results.metrics}
+        if results.stats is not None:
+            entry['stats'] = results.stats.to_dict() if hasattr(results.stats, 'to_dict') else vars(results.stats)
+        summary['runs'][settings['name']] = entry
+
+    summary['total_time'] = time.perf_counter() - START
+    (output / 'metrics.json').write_text(json.dumps(summary, indent=2, default=_plain))
+
+    if not options.quiet:
+        headers = ['run', 'wall (s)'] + list(METRIC_NAMES)
+        rows = [[name, f'{entry["wall_time"]:.3f}'] + [f'{entry["metrics"][metric]:.4g}' for metric in METRIC_NAMES]
+                for name, entry in summary['runs'].items() if 'error' not in entry]
+        widths = [max(len(row[column]) for row in [headers] + rows) for column in range(len(headers))]
+        for row in [headers] + rows:
+            print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+        print(f'Startup {startup_time:.3f} s, total {summary["total_time"]:.3f} s, results in {output}')
+    return status
+
+
+def _plain(value):
+    """JSON fallback for NumPy values in the settings and statistics."""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,27 @@
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
 from pathlib import Path
+from time import perf_counter
+import ast
+import copy
 import importlib.util
 import inspect
+import json
+import os
+
+import numpy as np
 
 
 class Controller(ABC):
+    # Number of past samples calculate_action reads from readings and time. When set, the simulator passes a
+    # fixed-size view over the latest samples instead of the whole history. None keeps the full history.
+    history = None
+    # Optional batched form of calculate_action, for simulate_batch: calculate_action_batch(readings, time,
+    # control_point, lanes=slice(None)). It is called on an instance made by make_batch, whose parameters and internal
+    # state are arrays with one value per lane. readings is a (samples, k) array of the k lanes given by lanes (indices
+    # into those arrays), control_point has k values, and the k actions are returned as an array. Controllers that do
+    # not define it are run through ScalarBatch.
+    calculate_action_batch = None
 
     def __init__(self, ts=0.1):
         self.ts = ts
@@ -13,41 +30,341 @@ class Controller(ABC):
     def calculate_action(self, readings, time, control_point):
         pass
 
+    def get_state(self):
+        """
+        Returns a copy of the controller's parameters and internal state (integral error, hysteresis branch, ...), for
+        simulation checkpoints. Controllers holding values that cannot be copied or pickled override both methods.
+        """
+        return copy.deepcopy(vars(self))
 
-def get_custom_controllers():
-    custom_controllers = []
-    controllers_path = Path("Controllers/")
-    for file_path in controllers_path.glob('*.py'):
-        # Ignore __init__.py files
-        if file_path.name == '__init__.py':
-            continue
-        
+    def set_state(self, state):
+        vars(self).update(copy.deepcopy(state))
+
+    @classmethod
+    def make_batch(cls, lanes, **kwargs):
+        """
+        Returns a controller for `lanes` lanes, kwargs holding a value per lane or one shared by all of them. Classes
+        implementing calculate_action_batch get one instance whose numeric attributes are float arrays of length
+        lanes; the others get a ScalarBatch of one instance per lane.
+        """
+        if cls.calculate_action_batch is None:
+            return ScalarBatch(cls, lanes, **kwargs)
+        controller = cls(**kwargs)
+        for name, value in vars(controller).items():
+            if np.ndim(value) <= 1 and np.issubdtype(np.asarray(value).dtype, np.number):
+                setattr(controller, name, np.broadcast_to(np.asarray(value, dtype=float), (lanes,)).copy())
+        return controller
+
+
+class ScalarBatch:
+    """Runs one instance of a controller class per lane through calculate_action, for classes without a batched form."""
+
+    def __init__(self, controller_class, lanes, **kwargs):
+        self.history = controller_class.history
+        self.controllers = [controller_class(**{name: value[lane] if np.ndim(value) else value
+                                                for name, value in kwargs.items()})
+                            for lane in range(lanes)]
+        self.ts = np.array([controller.ts for controller in self.controllers], dtype=float)
+
+    def get_state(self):
+        return [controller.get_state() for controller in self.controllers]
+
+    def set_state(self, state):
+        for controller, controller_state in zip(self.controllers, state):
+            controller.set_state(controller_state)
+
+    def calculate_action_batch(self, readings, time, control_point, lanes=slice(None)):
+        controllers = np.arange(len(self.controllers))[lanes]
+        return np.array([self.controllers[lane].calculate_action(readings[:, index], time, control_point[index])
+                         for index, lane in enumerate(controllers)], dtype=float)
+
+
+# Controller discovery. Plugins are listed without being imported: the classes of each file, their bases and the
+# editable defaults of their __init__ are read from its syntax tree and kept in an index (INDEX_FILE, in the plugins'
+# __pycache__) keyed by path, modification time and size, so that only new or edited files are parsed again. An
+# entry's class is imported when it is first read. Files whose __init__ defaults are not literals are imported while
+# listing, and files that fail to parse or import are reported once and skipped until they change.
+INDEX_FILE = 'controllers-index.json'
+INDEX_VERSION = 1
+
+# Plugin modules already imported, shared by the entries of a file: path -> (stamp, module). A file imported again
+# after it changed replaces its previous module, which is released once its classes are no longer used.
+_modules = {}
+
+
+class ControllerEntry(dict):
+    """Entry of get_custom_controllers: 'name', 'variables', 'path' and 'class', imported on first access."""
+
+    def __init__(self, *args, stamp=None, index_path=None, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.stamp = stamp
+        self.index_path = index_path
+
+    def __missing__(self, key):
+        if key != 'class':
+            raise KeyError(key)
         try:
-            # Create a module spec from the file path
-            module_name = file_path.stem
-            spec = importlib.util.spec_from_file_location(module_name, file_path)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
-            
-            # Find classes in the module that are subclasses of Controller
-            for name, obj in inspect.getmembers(module, inspect.isclass):
-                if issubclass(obj, Controller) and obj is not Controller:
-                    controller_class = obj
-                    editable_variables = {}
-                    # Inspect the __init__ parameters for default values
-                    sig = inspect.signature(controller_class.__init__)
-                    for param in sig.parameters.values():
-                        if param.name != 'self' and param.default is not inspect.Parameter.empty:
-                            # Convention: parameters not starting with '_' are user-editable
-                            if not param.name.startswith('_'):
-                                editable_variables[param.name] = param.default
-                    
-                    custom_controllers.append({
-                        'name': controller_class.__name__,
-                        'class': controller_class,
-                        'variables': editable_variables
-                    })
+            controller_class = getattr(_import_module(self['path'], self.stamp), self['name'])
+            if not (inspect.isclass(controller_class) and issubclass(controller_class, Controller)):
+                raise TypeError(f"{self['name']} is not a Controller")
         except Exception as e:
-            print(f"Error loading controller from {file_path}: {e}")
-            
+            print(f"Error loading controller from {self['path']}: {e}")
+            _record_error(self.index_path, self['path'], e)
+            raise ImportError(f"Cannot load controller {self['name']} from {self['path']}") from e
+        self['class'] = controller_class
+        return controller_class
+
+
+def get_custom_controllers(controllers_path="Controllers/", index_path=None):
+    """
+    Returns a ControllerEntry for every Controller subclass in the .py files of controllers_path. index_path
+    defaults to INDEX_FILE in the directory's __pycache__, and False lists the plugins without an index.
+    """
+    controllers_path = Path(controllers_path)
+    if index_path is None:
+        index_path = controllers_path / '__pycache__' / INDEX_FILE
+    index = _read_index(index_path) if index_path else {}
+
+    files = {}
+    directory = controllers_path.resolve()
+    with os.scandir(directory) as scan:
+        plugins = sorted((item.name, item) for item in scan if item.name.endswith('.py') and item.is_file())
+    for file_name, item in plugins:
+        # Ignore __init__.py files
+        if file_name == '__init__.py':
+            continue
+        path = os.path.join(directory, file_name)
+        status = item.stat()
+        stamp = [status.st_mtime_ns, status.st_size]
+        record = index.get(path)
+        if record is None or record['stamp'] != stamp:
+            record = _describe_file(Path(path))
+            record['stamp'] = stamp
+        files[path] = record
+    if index_path and files != index:
+        _write_index(index_path, files)
+
+    custom_controllers = []
+    classes = {}
+    for path, record in files.items():
+        if record['import']:
+            custom_controllers += _import_controllers(path, record, index_path)
+        for description in record['classes']:
+            classes.setdefault(description['name'], description)
+    for path, record in files.items():
+        for description in sorted(record['classes'], key=lambda item: item['name']):
+            if _is_controller(description['name'], classes):
+                custom_controllers.append(ControllerEntry(
+                    name=description['name'],
+                    variables=_variables(description['name'], classes),
+                    path=path,
+                    stamp=tuple(record['stamp']),
+                    index_path=index_path
+                ))
     return custom_controllers
+
+
+# Changes found by ControllerWatcher.poll: entries of new controllers, names of the removed ones, entries of the
+# controllers whose file changed, and the paths of the files changed, added or removed.
+@dataclass(frozen=True)
+class ControllerChanges:
+    added: list
+    removed: list
+    updated: list
+    files: list
+
+
+class ControllerWatcher:
+    """
+    Keeps `entries` (as returned by get_custom_controllers) up to date with a plugin directory. poll() only stats the
+    files, at most every `interval` seconds; when some changed, the directory is listed again, which only reads the
+    changed files, and their controllers are imported right away so load errors show up as the file is saved.
+    Controllers that fail to load are left out of entries.
+    """
+
+    def __init__(self, controllers_path="Controllers/", interval=1.0, index_path=None):
+        self.controllers_path = Path(controllers_path)
+        self.interval = interval
+        self.index_path = index_path
+        self.entries = get_custom_controllers(self.controllers_path, index_path)
+        self._stamps = self._scan()
+        self._next_poll = perf_counter() + interval
+
+    def _scan(self):
+        stamps = {}
+        try:
+            with os.scandir(self.controllers_path.resolve()) as scan:
+                for item in scan:
+                    if item.name.endswith('.py') and item.name != '__init__.py' and item.is_file():
+                        status = item.stat()
+                        stamps[item.path] = (status.st_mtime_ns, status.st_size)
+        except OSError:
+            pass
+        return stamps
+
+    def poll(self, now=None):
+        """Returns the ControllerChanges since the last scan, or None when there are none or the scan is not due."""
+        now = perf_counter() if now is None else now
+        if now < self._next_poll:
+            return None
+        self._next_poll = now + self.interval
+        stamps = self._scan()
+        if stamps == self._stamps:
+            return None
+        files = sorted(path for path in set(stamps) | set(self._stamps) if stamps.get(path) != self._stamps.get(path))
+        self._stamps = stamps
+        for path in files:
+            if path not in stamps:
+                _modules.pop(path, None)
+
+        previous = [entry['name'] for entry in self.entries]
+        entries = []
+        for entry in get_custom_controllers(self.controllers_path, self.index_path):
+            if entry['path'] in files:
+                try:
+                    entry['class']
+                except ImportError:
+                    continue
+            entries.append(entry)
+        self.entries = entries
+        current = {entry['name'] for entry in entries}
+        known = set(previous)
+        return ControllerChanges(
+            added=[entry for entry in entries if entry['name'] not in known],
+            removed=[name for name in previous if name not in current],
+            updated=[entry for entry in entries if entry['name'] in known and entry['path'] in files],
+            files=files
+        )
+
+
+def _editable_variables(controller_class):
+    editable_variables = {}
+    # Inspect the __init__ parameters for default values
+    sig = inspect.signature(controller_class.__init__)
+    for param in sig.parameters.values():
+        if param.name != 'self' and param.default is not inspect.Parameter.empty:
+            # Convention: parameters not starting with '_' are user-editable
+            if not param.name.startswith('_'):
+                editable_variables[param.name] = param.default
+    return editable_variables
+
+
+def _describe_file(file_path):
+    """
+    Reads the classes of a plugin from its source. Editable defaults are kept as JSON values, except those JSON
+    cannot hold exactly (tuples, complex numbers, ...), which are kept as reprs in 'literals'.
+    """
+    try:
+        tree = ast.parse(file_path.read_bytes(), str(file_path))
+    except (SyntaxError, ValueError) as e:
+        print(f"Error loading controller from {file_path}: {e}")
+        return {'classes': [], 'import': False, 'error': str(e)}
+
+    classes = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        bases = [base.id if isinstance(base, ast.Name) else base.attr for base in node.bases
+                 if isinstance(base, (ast.Name, ast.Attribute))]
+        variables = None  # Inherited from the bases
+        literals = {}
+        for item in node.body:
+            if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)) and item.name == '__init__':
+                try:
+                    variables = _literal_defaults(item.args)
+                except (ValueError, TypeError, SyntaxError):
+                    return {'classes': [], 'import': True, 'error': None}
+                for name, value in variables.items():
+                    if type(value) not in (int, float, str, bool, type(None)):
+                        variables[name] = None
+                        literals[name] = repr(value)
+        classes.append({'name': node.name, 'bases': bases, 'variables': variables, 'literals': literals})
+    return {'classes': classes, 'import': False, 'error': None}
+
+
+def _literal_defaults(arguments):
+    positional = arguments.posonlyargs + arguments.args
+    pairs = list(zip(positional[len(positional) - len(arguments.defaults):], arguments.defaults))
+    pairs += [(argument, default) for argument, default in zip(arguments.kwonlyargs, arguments.kw_defaults)
+              if default is not None]
+    return {argument.arg: ast.literal_eval(default) for argument, default in pairs
+            if argument.arg != 'self' and not argument.arg.startswith('_')}
+
+
+def _is_controller(name, classes, seen=()):
+    description = classes.get(name)
+    if description is None or name in seen:
+        return False
+    return any(base == 'Controller' or _is_controller(base, classes, seen + (name,))
+               for base in description['bases'])
+
+
+def _variables(name, classes, seen=()):
+    description = classes.get(name)
+    if description is None or name in seen:
+        return {}
+    if description['variables'] is not None:
+        literals = description['literals']
+        return {variable: ast.literal_eval(literals[variable]) if variable in literals else value
+                for variable, value in description['variables'].items()}
+    for base in description['bases']:
+        if base == 'Controller':
+            return _editable_variables(Controller)
+        if base in classes:
+            return _variables(base, classes, seen + (name,))
+    return {}
+
+
+def _import_module(path, stamp):
+    cached_stamp, module = _modules.get(path, (None, None))
+    if module is None or cached_stamp != stamp:
+        # Create a module spec from the file path
+        spec = importlib.util.spec_from_file_location(Path(path).stem, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[path] = (stamp, module)
+    return module
+
+
+def _import_controllers(path, record, index_path):
+    """Lists the controllers of a file that has to be imported to be described, as get_custom_controllers did."""
+    try:
+        module = _import_module(path, tuple(record['stamp']))
+    except Exception as e:
+        print(f"Error loading controller from {path}: {e}")
+        _record_error(index_path, path, e)
+        return []
+    # Find classes in the module that are subclasses of Controller
+    return [ControllerEntry(name=obj.__name__, variables=_editable_variables(obj), path=path, **{'class': obj})
+            for name, obj in inspect.getmembers(module, inspect.isclass)
+            if issubclass(obj, Controller) and obj is not Controller]
+
+
+def _read_index(index_path):
+    try:
+        index = json.loads(Path(index_path).read_text())
+    except (OSError, ValueError):
+        return {}
+    return index['files'] if index.get('version') == INDEX_VERSION else {}
+
+
+def _write_index(index_path, files):
+    # Written under a temporary name first, since several processes (sweep workers) may list the plugins at once.
+    index_path = Path(index_path)
+    temporary = index_path.with_name(f'{index_path.name}.{os.getpid()}.tmp')
+    try:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary.write_text(json.dumps({'version': INDEX_VERSION, 'files': files}))
+        os.replace(temporary, index_path)
+    except OSError:
+        pass
+
+
+def _record_error(index_path, path, error):
+    """Marks a file that failed to import in the index, so it is skipped, without a new report, until it changes."""
+    if not index_path:
+        return
+    files = _read_index(index_path)
+    if path in files:
+        files[path].update(classes=[], error=str(error), **{'import': False})
+        _write_index(index_path, files)
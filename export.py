@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+
+# Columns written for every run, with their headers and units.
+COLUMNS = ('time', 'height', 'error', 'action')
+HEADERS = ['Time', 'Height', 'Error', 'Action']
+UNITS = ['', ' (m)', ' (m)', '']
+
+
+# Writers of SimulationResults, chosen by file extension in save_results. Only the Excel writer needs openpyxl,
+# which is imported when it is used, so the other formats work without it.
+def save_xlsx(results, file):
+    """Writes the results to an Excel workbook, with a chart of each signal against time."""
+    from openpyxl import Workbook
+    from openpyxl.chart import Reference, ScatterChart, Series
+
+    data_size = len(results.time)
+    max_time = results.time[data_size - 1]
+
+    wb = Workbook()
+    sheet = wb.active
+    sheet.append(HEADERS)
+
+    for i in range(0, data_size):
+        sheet.append([float(results.time[i]), float(results.height[i]), float(results.error[i]),
+                      float(results.action[i])])
+    for i in range(1, 4):
+        header = HEADERS[i]
+        chart = ScatterChart()
+        chart.title = header + ' x Time'
+        chart.style = 13
+        chart.x_axis.title = 'Time (s)'
+        chart.y_axis.title = header + UNITS[i]
+        chart.x_axis.scaling.min = 0
+        chart.x_axis.scaling.max = max_time
+
+        x_values = Reference(sheet, min_col=1, min_row=2, max_row=data_size)
+        y_values = Reference(sheet, min_col=i+1, min_row=2, max_row=data_size)
+        series = Series(y_values, x_values)
+        chart.series.append(series)
+
+        row = 2+15*(i-1)
+        sheet.add_chart(chart, 'F'+str(row))
+
+    wb.save(file)
+
+
+def save_csv(results, file):
+    """Writes the results as comma separated columns. Vector systems get one more column per state component."""
+    columns = [getattr(results, name) for name in COLUMNS]
+    headers = list(HEADERS)
+    if results.state is not None and np.ndim(results.state) == 2:
+        columns += list(results.state.T)
+        headers += [f'State {index}' for index in range(results.state.shape[1])]
+    np.savetxt(file, np.column_stack(columns), delimiter=',', header=','.join(headers), comments='')
+
+
+def save_npz(results, file):
+    """Writes the results' arrays to a compressed .npz file, with the solver statistics and the metrics as JSON when
+    present."""
+    arrays = {name: getattr(results, name) for name in COLUMNS}
+    if results.state is not None:
+        arrays['state'] = results.state
+    if results.stats is not None:
+        stats = results.stats.to_dict() if hasattr(results.stats, 'to_dict') else vars(results.stats)
+        arrays['stats'] = np.array(json.dumps(stats))
+    if results.metrics is not None:
+        arrays['metrics'] = np.array(json.dumps(results.metrics))
+    np.savez_compressed(file, recording=np.array(results.recording), **arrays)
+
+
+FORMATS = {
+    'csv': save_csv,
+    'npz': save_npz,
+    'xlsx': save_xlsx,
+}
+
+
+def save_results(results, file):
+    """Writes the results in the format given by the file's extension, one of FORMATS."""
+    extension = str(file).rsplit('.', 1)[-1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f'Unknown results format .{extension}, use one of {", ".join(FORMATS)}')
+    FORMATS[extension](results, file)
@@ -0,0 +1,608 @@
+import numpy as np
+
+from dataclasses import dataclass, field, replace
+
+
+# Butcher tableau of an explicit Runge-Kutta method.
+# a is the (s, s) strictly lower triangular stage matrix, b the weights and c the nodes. Embedded pairs also carry
+# b_error = b - b_hat, the weights of the local error estimate, and error_order, the order of the embedded solution.
+# dense, when present, is the (s, m) coefficient matrix of the continuous extension
+# x(t + theta*dt) = x + dt * sum_j (k.T @ dense)[j] * theta^(j+1).
+# scalar_step(f, x, dt), when present, is the same step unrolled with the coefficients inlined, for scalar states,
+# where the cost of looping over the stages is most of the cost of the step.
+@dataclass(frozen=True)
+class ButcherTableau:
+    name: str
+    a: np.ndarray
+    b: np.ndarray
+    c: np.ndarray
+    order: int
+    b_error: np.ndarray = None
+    error_order: int = None
+    fsal: bool = False
+    dense: np.ndarray = None
+    description: str = field(default='', compare=False)
+    scalar_step: object = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        # Nonzero coefficients of each stage row and of the weights, as plain floats. Scalar states are cheaper to
+        # accumulate with these than with NumPy dot products, whose call overhead dominates for a single value.
+        rows = [[(j, float(value)) for j, value in enumerate(row[:i]) if value != 0] for i, row in enumerate(self.a)]
+        object.__setattr__(self, '_scalar_rows', rows)
+        object.__setattr__(self, '_scalar_b', [(j, float(value)) for j, value in enumerate(self.b) if value != 0])
+        if self.b_error is not None:
+            object.__setattr__(self, '_scalar_b_error',
+                               [(j, float(value)) for j, value in enumerate(self.b_error) if value != 0])
+
+    @property
+    def stages(self):
+        return len(self.b)
+
+    @property
+    def adaptive(self):
+        return self.b_error is not None
+
+
+def _tableau(name, a, b, c, order, b_hat=None, error_order=None, fsal=False, dense=None, description='',
+             scalar_step=None):
+    stages = len(b)
+    matrix = np.zeros((stages, stages))
+    for i, row in enumerate(a):
+        matrix[i + 1, :len(row)] = row
+    b = np.array(b, dtype=float)
+    b_error = None if b_hat is None else b - np.array(b_hat, dtype=float)
+    dense = None if dense is None else np.array(dense, dtype=float)
+    return ButcherTableau(name, matrix, b, np.array(c, dtype=float), order, b_error, error_order, fsal, dense,
+                          description, scalar_step)
+
+
+def _scalar_rk4_step(derivative_function, xn, dt):
+    # Same operations, in the same order, as _scalar_rk_stages on the rk4 tableau, so both give the same bits.
+    k1 = derivative_function(xn)
+    k2 = derivative_function(xn + dt * (0.5 * k1))
+    k3 = derivative_function(xn + dt * (0.5 * k2))
+    k4 = derivative_function(xn + dt * k3)
+    return xn + dt * (1 / 6 * k1 + 1 / 3 * k2 + 1 / 3 * k3 + 1 / 6 * k4)
+
+
+TABLEAUS = {
+    'heun': _tableau(
+        'heun',
+        a=[[1]],
+        b=[1 / 2, 1 / 2],
+        b_hat=[1, 0],
+        c=[0, 1],
+        order=2, error_order=1,
+        description='Heun 2(1), with the explicit Euler step as error estimate'
+    ),
+    'rk4': _tableau(
+        'rk4',
+        a=[[1 / 2],
+           [0, 1 / 2],
+           [0, 0, 1]],
+        b=[1 / 6, 1 / 3, 1 / 3, 1 / 6],
+        c=[0, 1 / 2, 1 / 2, 1],
+        order=4,
+        description='Classic fourth order Runge-Kutta',
+        scalar_step=_scalar_rk4_step
+    ),
+    'bs32': _tableau(
+        'bs32',
+        a=[[1 / 2],
+           [0, 3 / 4],
+           [2 / 9, 1 / 3, 4 / 9]],
+        b=[2 / 9, 1 / 3, 4 / 9, 0],
+        b_hat=[7 / 24, 1 / 4, 1 / 3, 1 / 8],
+        c=[0, 1 / 2, 3 / 4, 1],
+        order=3, error_order=2, fsal=True,
+        description='Bogacki-Shampine 3(2)'
+    ),
+    'dp54': _tableau(
+        'dp54',
+        a=[[1 / 5],
+           [3 / 40, 9 / 40],
+           [44 / 45, -56 / 15, 32 / 9],
+           [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+           [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+           [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]],
+        b=[35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0],
+        b_hat=[5179 / 57600, 0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40],
+        c=[0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1],
+        order=5, error_order=4, fsal=True,
+        # Shampine's fourth order continuous extension.
+        dense=[[1, -8048581381 / 2820520608, 8663915743 / 2820520608, -12715105075 / 11282082432],
+               [0, 0, 0, 0],
+               [0, 131558114200 / 32700410799, -68118460800 / 10900136933, 87487479700 / 32700410799],
+               [0, -1754552775 / 470086768, 14199869525 / 1410260304, -10690763975 / 1880347072],
+               [0, 127303824393 / 49829197408, -318862633887 / 49829197408, 701980252875 / 199316789632],
+               [0, -282668133 / 205662961, 2019193451 / 616988883, -1453857185 / 822651844],
+               [0, 40617522 / 29380423, -110615467 / 29380423, 69997945 / 29380423]],
+        description='Dormand-Prince 5(4), the ODE45 pair'
+    ),
+    'tsit5': _tableau(
+        'tsit5',
+        a=[[0.161],
+           [-0.008480655492356989, 0.335480655492357],
+           [2.897153057105493, -6.359448489975075, 4.3622954328695815],
+           [5.325864828439257, -11.748883564062828, 7.4955393428898365, -0.09249506636175525],
+           [5.86145544294642, -12.92096931784711, 8.159367898576159, -0.071584973281401, -0.028269050394068383],
+           [0.09646076681806523, 0.01, 0.4798896504144996, 1.379008574103742, -3.290069515436081,
+            2.324710524099774]],
+        b=[0.09646076681806523, 0.01, 0.4798896504144996, 1.379008574103742, -3.290069515436081,
+           2.324710524099774, 0],
+        b_hat=[0.09646076681806523 + 0.00178001105222577714, 0.01 + 0.0008164344596567469,
+               0.4798896504144996 - 0.007880878010261995, 1.379008574103742 + 0.1447110071732629,
+               -3.290069515436081 - 0.5823571654525552, 2.324710524099774 + 0.45808210592918697,
+               -1 / 66],
+        c=[0, 0.161, 0.327, 0.9, 0.9800255409045097, 1, 1],
+        order=5, error_order=4, fsal=True,
+        description='Tsitouras 5(4)'
+    ),
+}
+
+
+def get_tableau(method):
+    """Returns the tableau for a method name, or the tableau itself when one is given."""
+    if isinstance(method, ButcherTableau):
+        return method
+    try:
+        return TABLEAUS[method]
+    except KeyError:
+        raise ValueError(f'Unknown integration method: {method}. Available: {", ".join(TABLEAUS)}') from None
+
+
+def explicit_rk_step(tableau, derivative_function, xn, dt):
+    """
+    Advances xn by one step of the tableau.
+    Returns the new state and, for embedded pairs, the local error estimate (else None).
+    """
+    xn_1, error, _ = rk_stages(tableau, derivative_function, xn, dt)
+    return xn_1, error
+
+
+def rk_stages(tableau, derivative_function, xn, dt, k_first=None):
+    """
+    Evaluates every stage of one step and returns the new state, the error estimate and the stages.
+    The stages are kept in one (s, *state_shape) array, so every stage input and the final combination are a single
+    dot product over it. k_first, when given, is used as the first stage instead of evaluating derivative_function.
+    """
+    if np.ndim(xn) == 0:
+        return _scalar_rk_stages(tableau, derivative_function, xn, dt, k_first)
+    a = tableau.a
+    k = np.empty((tableau.stages,) + np.shape(xn))
+    # np.dot contracts the stage axis only while it is the second to last one, i.e. for one-dimensional states.
+    combine = np.dot if k.ndim <= 2 else _stage_dot
+    k[0] = derivative_function(xn) if k_first is None else k_first
+    for i in range(1, tableau.stages):
+        k[i] = derivative_function(xn + dt * combine(a[i, :i], k[:i]))
+    xn_1 = xn + dt * combine(tableau.b, k)
+    error = None if tableau.b_error is None else dt * combine(tableau.b_error, k)
+    return xn_1, error, k
+
+
+def _stage_dot(weights, k):
+    return np.tensordot(weights, k, axes=1)
+
+
+def _scalar_rk_stages(tableau, derivative_function, xn, dt, k_first=None):
+    k = [derivative_function(xn) if k_first is None else k_first]
+    for row in tableau._scalar_rows[1:]:
+        k.append(derivative_function(xn + dt * sum(value * k[j] for j, value in row)))
+    xn_1 = xn + dt * sum(value * k[j] for j, value in tableau._scalar_b)
+    error = None if tableau.b_error is None else dt * sum(value * k[j] for j, value in tableau._scalar_b_error)
+    return xn_1, error, k
+
+
+# Counters of an adaptive run. jacobians counts the Jacobian evaluations of implicit methods.
+@dataclass
+class StepStatistics:
+    accepted: int = 0
+    rejected: int = 0
+    evaluations: int = 0
+    jacobians: int = 0
+
+    @property
+    def evaluations_per_step(self):
+        return self.evaluations / self.accepted if self.accepted else 0.0
+
+    def __str__(self):
+        text = (f'{self.accepted} accepted steps, {self.rejected} rejected, {self.evaluations} derivative evaluations '
+                f'({self.evaluations_per_step:.2f} per accepted step)')
+        if self.jacobians:
+            text += f', {self.jacobians} Jacobian evaluations'
+        return text
+
+
+# Step-size control shared by the adaptive integrators.
+# A step is accepted when its scaled error norm is at most 1, with the error scaled by tol + rtol * |x|. Rejected
+# steps are retried with a smaller dt. The next dt comes from a PI controller on the last two error norms, which
+# avoids the oscillating step sizes of a plain I controller. The derivative at the end of an accepted step is kept,
+# so subclasses whose methods start from f(xn) can reuse it as the start of the next step.
+class _StepSizeController:
+
+    def __init__(self, error_order, tol, rtol, dt_limits, safety, min_factor, max_factor, beta):
+        self.atol = tol
+        self.rtol = tol if rtol is None else rtol
+        self.dt_min = dt_limits[0] if dt_limits[0] is not None else 1e-12
+        self.dt_max = dt_limits[1] if dt_limits[1] is not None else np.inf
+        self.safety = safety
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.error_order = error_order
+        exponent = 1 / (error_order + 1)
+        self.beta = 0.2 * exponent if beta is None else beta
+        self.alpha = exponent - 0.75 * self.beta
+        self.stats = StepStatistics()
+
+        self._previous_error = 1e-4
+        self._f_last = None
+        self._function = None
+        self._state = None
+        self._last_step = None
+
+    def reset(self):
+        """Drops the reused derivative, for when the derivative function or the state changed between steps."""
+        self._f_last = None
+
+    def get_state(self):
+        """Returns the statistics and the PI controller's memory, for simulation checkpoints."""
+        return {'stats': replace(self.stats), 'previous_error': self._previous_error}
+
+    def set_state(self, state):
+        self.stats = replace(state['stats'])
+        self._previous_error = state['previous_error']
+        self.reset()
+
+    def _error_norm(self, error, xn, xn_1):
+        scale = self.atol + self.rtol * np.maximum(np.abs(xn), np.abs(xn_1))
+        return float(np.max(np.abs(error) / scale))
+
+    def _advance(self, attempt, derivative_function, xn, dt):
+        """
+        Retries attempt(dt, f_first) with shrinking dt until its error is accepted. attempt returns the new state
+        (None when the step failed), the error estimate and the derivatives of the step, whose first and last entries
+        are f(xn) and f(xn_1).
+        Returns the new state, the dt actually taken and the dt proposed for the next step.
+        """
+        f_first = None
+        if self._f_last is not None and derivative_function is self._function and \
+                (xn is self._state or np.array_equal(xn, self._state)):
+            f_first = self._f_last
+
+        dt = min(max(dt, self.dt_min), self.dt_max)
+        rejected = False
+        while True:
+            xn_1, error, k = attempt(dt, f_first)
+            f_first = k[0]
+            error_norm = np.inf if xn_1 is None else self._error_norm(error, xn, xn_1)
+            if error_norm <= 1 or dt <= self.dt_min:
+                break
+            # Rejected: shrink with the I part only, the PI memory is for accepted steps.
+            self.stats.rejected += 1
+            rejected = True
+            factor = max(self.min_factor, self.safety * error_norm ** -(1 / (self.error_order + 1)))
+            dt = max(dt * factor, self.dt_min)
+
+        self.stats.accepted += 1
+        error_norm = max(error_norm, 1e-10)
+        factor = self.safety * error_norm ** -self.alpha * self._previous_error ** self.beta
+        factor = min(self.max_factor, max(self.min_factor, factor))
+        if rejected:
+            factor = min(factor, 1.0)
+        self._previous_error = max(error_norm, 1e-4)
+
+        self._function = derivative_function
+        self._state = xn_1
+        self._last_step = (xn, xn_1, dt, k)
+        return xn_1, dt, min(max(dt * factor, self.dt_min), self.dt_max)
+
+    def interpolate(self, theta):
+        """
+        Evaluates the solution inside the last accepted step, at the fractions theta (in [0, 1]) of its dt, with a
+        cubic Hermite interpolant. Returns an array shaped (len(theta), *state_shape).
+        """
+        xn, xn_1, dt, k = self._last_step
+        return _hermite(theta, xn, xn_1, dt, k[0], k[-1])
+
+
+def _hermite(theta, xn, xn_1, dt, f0, f1):
+    """Cubic Hermite interpolant through both ends of a step and their derivatives, at the fractions theta of dt."""
+    theta = np.asarray(theta, dtype=float).reshape((-1,) + (1,) * np.ndim(xn))
+    h00 = (1 + 2 * theta) * (1 - theta) ** 2
+    h10 = theta * (1 - theta) ** 2
+    h01 = theta ** 2 * (3 - 2 * theta)
+    h11 = theta ** 2 * (theta - 1)
+    return h00 * xn + h10 * dt * f0 + h01 * xn_1 + h11 * dt * f1
+
+
+# Adaptive step integrator for an embedded pair. For first-same-as-last pairs the final stage of an accepted step is
+# f(xn_1), so it is reused as the first stage of the next step.
+class AdaptiveIntegrator(_StepSizeController):
+
+    def __init__(self, tableau, tol=1e-6, rtol=None, dt_limits=(None, None), safety=0.9, min_factor=0.2,
+                 max_factor=5.0, beta=None):
+        if not tableau.adaptive:
+            raise ValueError(f'{tableau.name} has no embedded error estimate and cannot be used adaptively')
+        super().__init__(tableau.error_order, tol, rtol, dt_limits, safety, min_factor, max_factor, beta)
+        self.tableau = tableau
+
+    def step(self, derivative_function, xn, dt):
+        """
+        Takes one accepted step from xn, trying dt first.
+        Returns the new state, the dt actually taken and the dt proposed for the next step.
+        """
+        tableau = self.tableau
+
+        def attempt(dt, k_first):
+            xn_1, error, k = rk_stages(tableau, derivative_function, xn, dt, k_first)
+            self.stats.evaluations += tableau.stages - (k_first is not None)
+            return xn_1, error, k
+
+        result = self._advance(attempt, derivative_function, xn, dt)
+        self._f_last = self._last_step[3][-1] if tableau.fsal else None
+        return result
+
+    def interpolate(self, theta):
+        """
+        Evaluates the solution inside the last accepted step, at the fractions theta (in [0, 1]) of its dt.
+        Uses the tableau's continuous extension when it has one, otherwise a cubic Hermite interpolant through both
+        ends of the step and their derivatives.
+        Returns an array shaped (len(theta), *state_shape).
+        """
+        xn, xn_1, dt, k = self._last_step
+        k = np.asarray(k)
+        if self.tableau.dense is not None:
+            theta = np.asarray(theta, dtype=float)
+            powers = theta[:, None] ** np.arange(1, self.tableau.dense.shape[1] + 1)
+            coefficients = np.tensordot(self.tableau.dense.T, k, axes=1)
+            return xn + dt * np.tensordot(powers, coefficients, axes=1)
+
+        if self.tableau.fsal:
+            f_end = k[-1]
+        else:
+            f_end = self._function(xn_1)
+            self.stats.evaluations += 1
+        return _hermite(theta, xn, xn_1, dt, k[0], f_end)
+
+
+# Implicit one-step method. Each stage solves x = rhs + coefficient * f(x) with Newton's iteration, which keeps the
+# step stable where the derivative is stiff or unbounded (the outflow of an almost empty tank). Methods with an
+# error_order can be used adaptively.
+@dataclass(frozen=True)
+class ImplicitMethod:
+    name: str
+    order: int
+    error_order: int = None
+    description: str = field(default='', compare=False)
+
+    @property
+    def adaptive(self):
+        return self.error_order is not None
+
+
+IMPLICIT_METHODS = {
+    'backward_euler': ImplicitMethod('backward_euler', 1, description='Backward (implicit) Euler'),
+    'trbdf2': ImplicitMethod('trbdf2', 2, 2, description='TR-BDF2, a trapezoidal stage followed by a BDF2 stage'),
+}
+
+# TR-BDF2 constants. With gamma = 2 - sqrt(2) both stages share the coefficient gamma / 2, and the local error is
+# _TRBDF2_ERROR * dt^3 times the third derivative of the solution (Hosea and Shampine, 1996).
+_GAMMA = 2 - np.sqrt(2)
+_TRBDF2_ERROR = (-3 * _GAMMA ** 2 + 4 * _GAMMA - 2) / (12 * (2 - _GAMMA))
+
+
+def get_implicit_method(method):
+    """Returns the implicit method for a name, or None when the name is not an implicit method."""
+    if isinstance(method, ImplicitMethod):
+        return method
+    return IMPLICIT_METHODS.get(method) if isinstance(method, str) else None
+
+
+def numeric_jacobian(derivative_function, x, elementwise, f_x=None):
+    """
+    Forward difference Jacobian of derivative_function at x.
+    elementwise is for scalar states, and batches of independent scalar states: the result is the derivative of each
+    element, shaped like x. Otherwise the last axis of x holds the state components and the result is (..., n, n).
+    """
+    f_x = derivative_function(x) if f_x is None else f_x
+    step = np.sqrt(np.finfo(float).eps)
+    if elementwise:
+        delta = step * np.maximum(1.0, np.abs(x))
+        return (derivative_function(x + delta) - f_x) / delta
+    columns = []
+    for component in range(np.shape(x)[-1]):
+        delta = step * np.maximum(1.0, np.abs(x[..., component]))
+        shifted = np.array(x, dtype=float)
+        shifted[..., component] += delta
+        columns.append((derivative_function(shifted) - f_x) / np.expand_dims(delta, -1))
+    return np.stack(columns, axis=-1)
+
+
+def newton_solve(derivative_function, jacobian, rhs, coefficient, guess, tol, max_iterations=8):
+    """
+    Solves x = rhs + coefficient * f(x) with Newton's iteration, starting from guess.
+    jacobian(x) is shaped like x for scalar states (elementwise), or (..., n, n) for vector states.
+    Returns the solution, the number of iterations and whether the iteration converged, i.e. whether the last
+    correction was below tol * (1 + |x|). Every iteration evaluates the derivative and the Jacobian once.
+    """
+    x = guess
+    for iteration in range(1, max_iterations + 1):
+        residual = x - rhs - coefficient * derivative_function(x)
+        slope = jacobian(x)
+        if np.ndim(slope) == np.ndim(x):
+            correction = residual / (1 - coefficient * slope)
+        else:
+            matrix = np.eye(np.shape(x)[-1]) - coefficient * slope
+            correction = np.linalg.solve(matrix, np.expand_dims(residual, -1))[..., 0]
+        x = x - correction
+        if np.all(np.abs(correction) <= tol * (1 + np.abs(x))):
+            return x, iteration, True
+    return x, max_iterations, False
+
+
+def implicit_step(method, derivative_function, jacobian, xn, dt, f_first=None, newton_tol=1e-10):
+    """
+    Advances xn by one step of an implicit method.
+    Returns the new state, the local error estimate (None for methods without one), the derivatives at both ends of
+    the step, the number of Newton iterations and the number of derivative evaluations. The new state is None when
+    Newton's iteration did not converge, so the caller can retry with a smaller dt. f_first, when given, is used as
+    the derivative at xn.
+    """
+    f0 = derivative_function(xn) if f_first is None else f_first
+    evaluations = int(f_first is None)
+    if method.name == 'backward_euler':
+        xn_1, iterations, converged = newton_solve(derivative_function, jacobian, xn, dt, xn + dt * f0, newton_tol)
+        if not converged:
+            return None, None, (f0, None), iterations, evaluations + iterations
+        return xn_1, None, (f0, derivative_function(xn_1)), iterations, evaluations + iterations + 1
+
+    # TR-BDF2: trapezoidal rule up to t + gamma*dt, then BDF2 through xn, x_gamma and xn_1.
+    d = _GAMMA / 2
+    x_gamma, iterations, converged = newton_solve(derivative_function, jacobian, xn + d * dt * f0, d * dt,
+                                                  xn + _GAMMA * dt * f0, newton_tol)
+    evaluations += iterations
+    if not converged:
+        return None, None, (f0, None), iterations, evaluations
+    f_gamma = derivative_function(x_gamma)
+    rhs = (x_gamma - (1 - _GAMMA) ** 2 * xn) / (_GAMMA * (2 - _GAMMA))
+    xn_1, bdf_iterations, converged = newton_solve(derivative_function, jacobian, rhs, d * dt,
+                                                   x_gamma + (1 - _GAMMA) * dt * f_gamma, newton_tol)
+    iterations += bdf_iterations
+    evaluations += bdf_iterations + 1
+    if not converged:
+        return None, None, (f0, None), iterations, evaluations
+    f1 = derivative_function(xn_1)
+    error = 2 * _TRBDF2_ERROR * dt * (f0 / _GAMMA - f_gamma / (_GAMMA * (1 - _GAMMA)) + f1 / (1 - _GAMMA))
+    return xn_1, error, (f0, f1), iterations, evaluations + 1
+
+
+# Adaptive step integrator for an implicit method with an error estimate, with the same step-size control as
+# AdaptiveIntegrator. Steps whose Newton iteration does not converge are rejected like steps with a large error.
+# The derivative at the end of an accepted step is reused as the start of the next one.
+class ImplicitIntegrator(_StepSizeController):
+
+    def __init__(self, method, tol=1e-6, rtol=None, dt_limits=(None, None), safety=0.9, min_factor=0.2,
+                 max_factor=5.0, beta=None):
+        if not method.adaptive:
+            raise ValueError(f'{method.name} has no error estimate and cannot be used adaptively')
+        super().__init__(method.error_order, tol, rtol, dt_limits, safety, min_factor, max_factor, beta)
+        self.method = method
+        self.newton_tol = 0.01 * tol
+
+    def step(self, derivative_function, xn, dt, jacobian=None):
+        """
+        Takes one accepted step from xn, trying dt first. jacobian(x) defaults to forward differences.
+        Returns the new state, the dt actually taken and the dt proposed for the next step.
+        """
+        if jacobian is None:
+            jacobian = lambda x: numeric_jacobian(derivative_function, x, np.ndim(x) == 0)
+
+        def attempt(dt, f_first):
+            xn_1, error, f, iterations, evaluations = implicit_step(self.method, derivative_function, jacobian, xn,
+                                                                    dt, f_first, self.newton_tol)
+            self.stats.evaluations += evaluations
+            self.stats.jacobians += iterations
+            # A failed Newton iteration is retried with the largest shrink factor, down to the minimum dt.
+            if xn_1 is None and dt <= self.dt_min:
+                raise RuntimeError(f'Newton iteration of {self.method.name} did not converge at the minimum dt')
+            return xn_1, error, f
+
+        result = self._advance(attempt, derivative_function, xn, dt)
+        self._f_last = self._last_step[3][-1]
+        return result
+
+
+def expm(matrix):
+    """
+    Matrix exponential, by scaling and squaring with the (6, 6) Pade approximant (Golub and Van Loan, algorithm
+    11.3.1). The matrix is scaled until its infinity norm is at most 1/2, which keeps the approximant accurate to
+    round-off.
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    norm = np.linalg.norm(matrix, np.inf)
+    squarings = max(0, int(np.floor(np.log2(norm))) + 2) if norm > 0 else 0
+    scaled = matrix / 2 ** squarings
+    identity = np.eye(len(matrix))
+    numerator = identity.copy()
+    denominator = identity.copy()
+    power = identity
+    coefficient = 1.0
+    q = 6
+    for k in range(1, q + 1):
+        coefficient *= (q - k + 1) / (k * (2 * q - k + 1))
+        power = scaled @ power
+        numerator += coefficient * power
+        denominator += (-1) ** k * coefficient * power
+    result = np.linalg.solve(denominator, numerator)
+    for _ in range(squarings):
+        result = result @ result
+    return result
+
+
+def zoh_discretize(a, b, d, dt):
+    """
+    Exact discretization of dx_dt = a x + b u + d over dt with u held constant, as x(t + dt) = phi x + gamma_u u +
+    gamma_d. a is a matrix for vector states; for scalar states, and batches of them, it is elementwise and the
+    exponential has a closed form.
+    Returns phi, gamma_u and gamma_d.
+    """
+    if np.ndim(a) <= 1:
+        a = np.asarray(a, dtype=float)
+        phi = np.exp(a * dt)
+        # (phi - 1) / a, with its limit dt where a is zero.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            integral = np.where(a != 0, np.expm1(a * dt) / np.where(a != 0, a, 1), dt)
+        return phi, integral * b, integral * d
+    if np.ndim(a) != 2:
+        raise ValueError('Zero-order hold discretization of batched vector states is not supported')
+    states = len(a)
+    augmented = np.zeros((states + 2, states + 2))
+    augmented[:states, :states] = a
+    augmented[:states, states] = b
+    augmented[:states, states + 1] = d
+    transition = expm(augmented * dt)
+    return transition[:states, :states], transition[:states, states], transition[:states, states + 1]
+
+
+# Zero-order hold stepper. Between controller samples the action is constant, so an affine model
+# dx_dt = a x + b u + d is advanced over a whole sample exactly, with one product by a precomputed transition matrix.
+# linearize(x, action, derivative) returns (a, b, d). Linear systems give an exact model once (exact=True).
+# Nonlinear ones are re-linearized whenever the state moved more than `relinearize` from the point of the current
+# model: 0 does it at every step, np.inf keeps the model of the initial state. The transition matrices are cached per
+# step length, and rebuilt only when the model changes.
+class ZeroOrderHold:
+
+    def __init__(self, linearize, exact=False, relinearize=0):
+        self.linearize = linearize
+        self.exact = exact
+        self.relinearize = relinearize
+        self.stats = StepStatistics()
+        self._model = None
+        self._point = None
+        self._transitions = {}
+
+    def get_state(self):
+        """Returns the statistics and the current linear model, for simulation checkpoints."""
+        return {'stats': replace(self.stats), 'model': self._model, 'point': self._point}
+
+    def set_state(self, state):
+        self.stats = replace(state['stats'])
+        self._model = state['model']
+        self._point = state['point']
+        self._transitions = {}
+
+    def step(self, xn, action, dt, derivative=None):
+        """Advances xn by dt with the action held constant. derivative is passed on to linearize."""
+        if self._model is None or (not self.exact and np.max(np.abs(xn - self._point)) >= self.relinearize):
+            self._model = self.linearize(xn, action, derivative)
+            self._point = xn
+            self._transitions = {}
+            self.stats.jacobians += 1
+        transition = self._transitions.get(dt)
+        if transition is None:
+            transition = self._transitions[dt] = zoh_discretize(*self._model, dt)
+        phi, gamma_u, gamma_d = transition
+        self.stats.accepted += 1
+        if np.ndim(phi) == 2:
+            return xn @ phi.T + np.multiply.outer(action, gamma_u) + gamma_d
+        return phi * xn + gamma_u * action + gamma_d
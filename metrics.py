@@ -0,0 +1,195 @@
+import numpy as np
+
+
+# Closed-loop performance metrics of a simulated step response.
+# rise_time: time to go from 10% to 90% of the way between the initial value and the set point.
+# overshoot: largest excursion past the set point, relative to the size of the step.
+# settling_time: time after which the output stays within `settling_band` (relative) of the set point.
+# ise, iae, itae: integral of the squared, absolute and time-weighted absolute error.
+# control_effort: integral of the absolute control action.
+METRIC_NAMES = ('rise_time', 'overshoot', 'settling_time', 'steady_state_error', 'ise', 'iae', 'itae',
+                'control_effort')
+
+
+def compute_metrics(time, height, action, control_point, settling_band=0.02):
+    """Post-processes a scalar SimulationResults-like set of arrays into a dict of METRIC_NAMES."""
+    time = np.asarray(time, dtype=float)
+    height = np.asarray(height, dtype=float)
+    action = np.asarray(action, dtype=float)
+    error = control_point - height
+    step = control_point - height[0]
+    direction = 1.0 if step >= 0 else -1.0
+    progress = direction * (height - height[0])
+
+    rise_time = np.nan
+    if step != 0:
+        above_10 = np.flatnonzero(progress >= 0.1 * abs(step))
+        above_90 = np.flatnonzero(progress >= 0.9 * abs(step))
+        if above_10.size and above_90.size:
+            rise_time = time[above_90[0]] - time[above_10[0]]
+
+    overshoot = 0.0
+    if step != 0:
+        overshoot = max(0.0, float(np.max(-direction * error)) / abs(step))
+
+    band = settling_band * max(abs(control_point), abs(step), np.finfo(float).eps)
+    outside = np.flatnonzero(np.abs(error) > band)
+    if outside.size == 0:
+        settling_time = 0.0
+    elif outside[-1] == len(time) - 1:
+        settling_time = np.nan
+    else:
+        settling_time = time[outside[-1] + 1]
+
+    dt = np.diff(time)
+    return {
+        'rise_time': float(rise_time),
+        'overshoot': float(overshoot),
+        'settling_time': float(settling_time),
+        'steady_state_error': float(error[-1]),
+        'ise': float(np.sum(error[1:] ** 2 * dt)),
+        'iae': float(np.sum(np.abs(error[1:]) * dt)),
+        'itae': float(np.sum(time[1:] * np.abs(error[1:]) * dt)),
+        'control_effort': float(np.sum(np.abs(action[1:]) * dt)),
+    }
+
+
+# Online form of compute_metrics, updated one sample at a time in constant memory, for runs that do not keep their
+# results (see recording.RecordNone). Fed with every step of a run, from the initial sample on, it gives the values
+# compute_metrics gives on the results recorded with RecordAll, up to rounding in the sums.
+class MetricsAccumulator:
+
+    def __init__(self, control_point, settling_band=0.02):
+        self.control_point = control_point
+        self.settling_band = settling_band
+        self.time = None
+
+    def start(self, time, height):
+        """Takes the initial sample, which sets the size and direction of the step."""
+        self.time = float(time)
+        self.step = self.control_point - float(height)
+        self.direction = 1.0 if self.step >= 0 else -1.0
+        self.band = self.settling_band * max(abs(self.control_point), abs(self.step), np.finfo(float).eps)
+        self.rise_start = np.nan
+        self.rise_end = np.nan
+        self.peak = -abs(self.step)
+        self.settling_time = np.nan if abs(self.step) > self.band else 0.0
+        self.outside = abs(self.step) > self.band
+        self.error = self.step
+        self.ise = 0.0
+        self.iae = 0.0
+        self.itae = 0.0
+        self.control_effort = 0.0
+        self._rising = self.step != 0
+
+    def update(self, time, height, action):
+        """Takes the sample of one step: the time it ends at, the output there and the action applied during it."""
+        time = float(time)
+        error = self.control_point - float(height)
+        absolute_error = abs(error)
+        dt = time - self.time
+        self.time = time
+        self.error = error
+        self.ise += error * error * dt
+        self.iae += absolute_error * dt
+        self.itae += time * absolute_error * dt
+        self.control_effort += abs(action) * dt
+
+        if self._rising:
+            # The output moved (step - error) from its initial value, in the direction of the step.
+            progress = self.direction * (self.step - error)
+            if progress >= 0.1 * abs(self.step) and self.rise_start != self.rise_start:
+                self.rise_start = time
+            if progress >= 0.9 * abs(self.step):
+                self.rise_end = time
+                self._rising = False
+        overshoot = -self.direction * error
+        if overshoot > self.peak:
+            self.peak = overshoot
+        if absolute_error > self.band:
+            if not self.outside:
+                self.outside = True
+                self.settling_time = np.nan
+        elif self.outside:
+            self.outside = False
+            self.settling_time = time
+
+    def result(self):
+        """Returns the metrics of the samples taken so far, as compute_metrics does."""
+        if self.time is None:
+            raise ValueError('MetricsAccumulator.start() has not been called')
+        return {
+            'rise_time': float(self.rise_end - self.rise_start),
+            'overshoot': float(max(0.0, self.peak) / abs(self.step)) if self.step != 0 else 0.0,
+            'settling_time': float(self.settling_time),
+            'steady_state_error': float(self.error),
+            'ise': float(self.ise),
+            'iae': float(self.iae),
+            'itae': float(self.itae),
+            'control_effort': float(self.control_effort),
+        }
+
+
+# MetricsAccumulator of a batched run, holding one value per lane in every counter. height, action and control_point
+# are arrays with a value per lane; the result maps each of METRIC_NAMES to an array with a value per lane.
+class BatchMetricsAccumulator(MetricsAccumulator):
+
+    def start(self, time, height):
+        self.time = float(time)
+        self.step = np.asarray(self.control_point - height, dtype=float)
+        self.direction = np.where(self.step >= 0, 1.0, -1.0)
+        self.band = self.settling_band * np.maximum(np.maximum(np.abs(self.control_point), np.abs(self.step)),
+                                                    np.finfo(float).eps)
+        self.rise_start = np.full(self.step.shape, np.nan)
+        self.rise_end = np.full(self.step.shape, np.nan)
+        self.peak = -np.abs(self.step)
+        self.outside = np.abs(self.step) > self.band
+        self.settling_time = np.where(self.outside, np.nan, 0.0)
+        self.error = self.step
+        self.ise = np.zeros(self.step.shape)
+        self.iae = np.zeros(self.step.shape)
+        self.itae = np.zeros(self.step.shape)
+        self.control_effort = np.zeros(self.step.shape)
+        self._rising = self.step != 0
+
+    def update(self, time, height, action):
+        time = float(time)
+        error = self.control_point - height
+        absolute_error = np.abs(error)
+        dt = time - self.time
+        self.time = time
+        self.error = error
+        self.ise += error * error * dt
+        self.iae += absolute_error * dt
+        self.itae += time * absolute_error * dt
+        self.control_effort += np.abs(action) * dt
+
+        if self._rising.any():
+            progress = self.direction * (self.step - error)
+            rise_size = np.abs(self.step)
+            started = self._rising & (progress >= 0.1 * rise_size) & np.isnan(self.rise_start)
+            self.rise_start[started] = time
+            ended = self._rising & (progress >= 0.9 * rise_size)
+            self.rise_end[ended] = time
+            self._rising &= ~ended
+        np.maximum(self.peak, -self.direction * error, out=self.peak)
+        outside = absolute_error > self.band
+        self.settling_time[outside & ~self.outside] = np.nan
+        self.settling_time[~outside & self.outside] = time
+        self.outside = outside
+
+    def result(self):
+        if self.time is None:
+            raise ValueError('MetricsAccumulator.start() has not been called')
+        overshoot = np.divide(np.maximum(0.0, self.peak), np.abs(self.step), out=np.zeros(self.step.shape),
+                              where=self.step != 0)
+        return {
+            'rise_time': self.rise_end - self.rise_start,
+            'overshoot': overshoot,
+            'settling_time': self.settling_time.copy(),
+            'steady_state_error': np.array(self.error, dtype=float),
+            'ise': self.ise.copy(),
+            'iae': self.iae.copy(),
+            'itae': self.itae.copy(),
+            'control_effort': self.control_effort.copy(),
+        }
@@ -0,0 +1,110 @@
+import numpy as np
+
+
+# Recording policies decide which simulation steps are stored in the results.
+# The simulator asks keep() once per step, in order, and always stores the last step so the results reach the end of
+# the horizon. Policies accept scalar states and batched (array) states alike.
+class RecordingPolicy:
+
+    def start(self, time, value, action):
+        """Called at the start of every run, with the initial sample (which is always stored)."""
+        pass
+
+    def keep(self, time, value, action):
+        return True
+
+    def __str__(self):
+        return 'all'
+
+
+# Stores every step. This is the default.
+class RecordAll(RecordingPolicy):
+    pass
+
+
+# Stores no step: the results only hold the initial sample and the last step, which are always stored. For runs that
+# only need scalar scores, such as the metrics of simulate(metrics=True).
+class RecordNone(RecordingPolicy):
+
+    def keep(self, time, value, action):
+        return False
+
+    def __str__(self):
+        return 'none'
+
+
+# Stores one step out of every `every`.
+class Decimate(RecordingPolicy):
+
+    def __init__(self, every):
+        if every < 1:
+            raise ValueError('Decimate needs every >= 1')
+        self.every = int(every)
+        self._count = 0
+
+    def start(self, time, value, action):
+        self._count = 0
+
+    def keep(self, time, value, action):
+        self._count += 1
+        if self._count == self.every:
+            self._count = 0
+            return True
+        return False
+
+    def __str__(self):
+        return f'every {self.every} steps'
+
+
+# Stores the first step at or after each multiple of `period` seconds.
+class FixedPeriod(RecordingPolicy):
+
+    def __init__(self, period):
+        if period <= 0:
+            raise ValueError('FixedPeriod needs a positive period')
+        self.period = period
+        self._next_time = period
+
+    def start(self, time, value, action):
+        self._next_time = time + self.period
+
+    def keep(self, time, value, action):
+        if time >= self._next_time - 1e-12:
+            self._next_time = (np.floor(time / self.period + 1e-9) + 1) * self.period
+            return True
+        return False
+
+    def __str__(self):
+        return f'every {self.period:g} s'
+
+
+# Deadband compression: stores a step only when the value moved more than `tolerance` from the last stored value,
+# or when the control action changed. Between stored samples the signal is known to stay within the band.
+class Deadband(RecordingPolicy):
+
+    def __init__(self, tolerance):
+        if tolerance < 0:
+            raise ValueError('Deadband needs a non-negative tolerance')
+        self.tolerance = tolerance
+        self._scalar = True
+        self._value = None
+        self._action = None
+
+    def start(self, time, value, action):
+        # Scalar runs compare plain numbers, which is much cheaper than going through NumPy on every step.
+        self._scalar = np.ndim(value) == 0
+        self._value = value if self._scalar else np.copy(value)
+        self._action = action if self._scalar else np.copy(action)
+
+    def keep(self, time, value, action):
+        if self._scalar:
+            changed = abs(value - self._value) > self.tolerance or action != self._action
+        else:
+            changed = np.any(np.abs(value - self._value) > self.tolerance) or np.any(action != self._action)
+        if changed:
+            self._value = value if self._scalar else np.copy(value)
+            self._action = action if self._scalar else np.copy(action)
+        return changed
+
+    def __str__(self):
+        return f'deadband {self.tolerance:g}'
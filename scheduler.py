@@ -0,0 +1,169 @@
+import heapq
+import itertools
+
+import numpy as np
+
+from buffers import ResultBuffer, history_buffers
+
+
+# Periodic task run by the Scheduler at offset + k * period, for k = 1, 2, ...
+# Tasks due at the same instant run by priority (sensors and disturbances before controllers), then in the order they
+# were added. fire() receives the SimulationRun, whose time is exactly the sample instant.
+class Task:
+    priority = 1
+
+    def __init__(self, period, offset=0.0, name=None):
+        if period <= 0:
+            raise ValueError('Tasks need a positive period')
+        self.period = period
+        self.offset = offset
+        self.name = name if name is not None else type(self).__name__
+
+    def instant(self, count):
+        """Instant of the count-th sample of the task."""
+        return self.offset + count * self.period
+
+    def start(self, run):
+        """Called once when the run starts, before any task fires."""
+        pass
+
+    def fire(self, run):
+        pass
+
+
+# Samples a signal of the run at its own rate, for example a noisy or quantized measurement. measure(state, action)
+# defaults to the system's output. The samples are kept in `samples`, and controllers can read the latest one by
+# taking the sensor as their measure. In batched runs each sample holds a value per lane.
+class SensorTask(Task):
+    priority = 0
+
+    def __init__(self, period, measure=None, offset=0.0, name=None):
+        Task.__init__(self, period, offset, name)
+        self.measure = measure
+        self.samples = ResultBuffer(('time', 'value'))
+        self.value = None
+
+    def start(self, run):
+        self.value = self._read(run)
+        self.samples = ResultBuffer({'time': (), 'value': np.shape(self.value)})
+        self.samples.append(run.time, self.value)
+
+    def _read(self, run):
+        if self.measure is None:
+            return run.system.output(run.x)
+        return self.measure(run.x, run.control_action)
+
+    def fire(self, run):
+        self.value = self._read(run)
+        self.samples.append(run.time, self.value)
+
+
+# Input disturbance: signal(time) is added to the action applied to the system, and held until the next sample.
+class DisturbanceTask(Task):
+    priority = 0
+
+    def __init__(self, period, signal, offset=0.0, name=None):
+        Task.__init__(self, period, offset, name)
+        self.signal = signal
+
+    def start(self, run):
+        run.disturbance = self.signal(run.time)
+
+    def fire(self, run):
+        run.disturbance = self.signal(run.time)
+
+
+# Runs a controller at its own sample time (controller.ts).
+# measure(state, action) is the controlled variable, the system's output by default; a SensorTask can be given to
+# read its latest sample instead. setpoint defaults to the run's control point. The result drives the system's action
+# when target is None, or becomes the setpoint of the target ControllerTask, which makes cascaded loops: an outer
+# level loop setting the reference of an inner loop. Readings are the measure sampled at this task's own instants.
+class ControllerTask(Task):
+
+    def __init__(self, controller, measure=None, setpoint=None, target=None, offset=0.0, name=None):
+        Task.__init__(self, controller.ts, offset, name if name is not None else type(controller).__name__)
+        self.controller = controller
+        self.measure = measure
+        self.initial_setpoint = setpoint
+        self.setpoint = setpoint
+        self.target = target
+        self.output = 0.0
+        self._history = None
+
+    def start(self, run):
+        self.setpoint = self.initial_setpoint if self.initial_setpoint is not None else run.control_point
+        reading = self._read(run)
+        self._history = history_buffers(self.controller.history, np.shape(reading))
+        self._history[0].append(reading)
+        self._history[1].append(run.time)
+
+    def _read(self, run):
+        if self.measure is None:
+            return run.system.output(run.x)
+        if isinstance(self.measure, SensorTask):
+            return self.measure.value
+        return self.measure(run.x, run.control_action)
+
+    def _record(self, run):
+        self._history[0].append(self._read(run))
+        self._history[1].append(run.time)
+
+    def fire(self, run):
+        self._record(run)
+        readings, times = self._history[0].view(), self._history[1].view()
+        self.output = run.call_controller(self.controller, readings, times, self.setpoint)
+        if self.target is None:
+            run.control_action = self.output
+        else:
+            self.target.setpoint = self.output
+
+
+# Event scheduler: a priority queue of tasks keyed by their next sample instant.
+# Instants are computed as offset + k * period rather than accumulated, so they never drift, and the simulator
+# shortens or stretches its steps so that they end exactly on them.
+class Scheduler:
+
+    def __init__(self, tasks=()):
+        self.tasks = []
+        self._heap = []
+        self._order = itertools.count()
+        for task in tasks:
+            self.add(task)
+
+    def add(self, task):
+        self.tasks.append(task)
+        heapq.heappush(self._heap, (task.instant(1), task.priority, next(self._order), 1, task))
+
+    @property
+    def next_time(self):
+        """Instant of the next task to fire, or infinity when there are no tasks."""
+        return self._heap[0][0] if self._heap else np.inf
+
+    def start(self, run):
+        for task in self.tasks:
+            task.start(run)
+
+    def get_state(self):
+        """Returns how many times each task, in the order they were added, is due to have fired at its next instant."""
+        counts = {id(entry[4]): entry[3] for entry in self._heap}
+        return [counts[id(task)] for task in self.tasks]
+
+    def set_state(self, counts):
+        """Reschedules the tasks from get_state, instead of from their first instants."""
+        if len(counts) != len(self.tasks):
+            raise ValueError(f'The state has {len(counts)} tasks, the scheduler {len(self.tasks)}')
+        self._heap = [(task.instant(count), task.priority, order, count, task)
+                      for order, (task, count) in enumerate(zip(self.tasks, counts))]
+        heapq.heapify(self._heap)
+        self._order = itertools.count(len(self.tasks))
+
+    def fire_due(self, run):
+        """Fires, in order, every task due at or before the run's time, and schedules their next instants."""
+        fired = 0
+        while self._heap and self._heap[0][0] <= run.time:
+            _, priority, order, count, task = heapq.heappop(self._heap)
+            task.fire(run)
+            fired += 1
+            count += 1
+            heapq.heappush(self._heap, (task.instant(count), priority, order, count, task))
+        return fired
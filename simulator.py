@@ -1,28 +1,136 @@
 import numpy as np
 
+import copy
+import pickle
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
+from time import perf_counter
+
+from buffers import ResultBuffer, history_buffers
+from integrators import AdaptiveIntegrator, ImplicitIntegrator, StepStatistics, ZeroOrderHold, explicit_rk_step, \
+    get_implicit_method, get_tableau, implicit_step, numeric_jacobian
+from metrics import BatchMetricsAccumulator, MetricsAccumulator
+from recording import RecordAll
+from scheduler import Scheduler, Task
 
 
 # Data structure to save the simulation.
+# height is the measured output of the system (the level, for a single tank). Systems with a vector state also store
+# the whole state as (T, n) in `state`. Batched runs store time as (T,), height, error and action as (N, T), one row
+# per lane, and state as (N, T, n). Runs with metrics=True hold the metrics.METRIC_NAMES of the whole run in
+# `metrics`, computed from every step whatever was recorded; batched runs hold an array with a value per lane for each.
 @dataclass(frozen=True)
 class SimulationResults:
     time: np.array
     height: np.array
     error: np.array
     action: np.array
+    stats: StepStatistics = None
+    recording: str = 'all'
+    state: np.array = None
+    metrics: dict = None
+
+
+# Counters of an instrumented run (instrument=True), in SimulationResults.stats.
+# On top of the step counters, it holds the smallest, largest and mean dt taken, the controller calls, and the wall time
+# spent in the integrator (derivative evaluations included), in the controllers, in the progress callback and in the
+# whole run. evaluations counts every call of the derivative function the integrator was given.
+@dataclass
+class SimulationStats(StepStatistics):
+    min_dt: float = np.inf
+    max_dt: float = 0.0
+    total_dt: float = 0.0
+    controller_calls: int = 0
+    integrator_time: float = 0.0
+    controller_time: float = 0.0
+    callback_time: float = 0.0
+    wall_time: float = 0.0
+
+    @property
+    def mean_dt(self):
+        return self.total_dt / self.accepted if self.accepted else 0.0
+
+    def to_dict(self):
+        """Returns the counters and the derived values as a dict of plain numbers, for exporting."""
+        values = asdict(self)
+        values.update(mean_dt=self.mean_dt, evaluations_per_step=self.evaluations_per_step)
+        if not self.accepted:
+            values['min_dt'] = 0.0
+        return values
+
+    def __str__(self):
+        wall_time = self.wall_time or 1.0
+        other_time = self.wall_time - self.integrator_time - self.controller_time - self.callback_time
+        return '\n'.join([
+            StepStatistics.__str__(self),
+            f'dt: min {self.min_dt if self.accepted else 0:.3g}, mean {self.mean_dt:.3g}, max {self.max_dt:.3g}',
+            f'{self.controller_calls} controller calls',
+            f'wall time {self.wall_time:.4g} s: integrator {100 * self.integrator_time / wall_time:.1f}%, '
+            f'controller {100 * self.controller_time / wall_time:.1f}%, '
+            f'callbacks {100 * self.callback_time / wall_time:.1f}%, other {100 * other_time / wall_time:.1f}%',
+        ])
+
+
+def append_results(results, more):
+    """Joins the results of a run resumed from a checkpoint to the results of the run the checkpoint was taken from."""
+    axis = np.ndim(results.height) - 1
+    columns = {'time': np.concatenate([results.time, more.time])}
+    columns.update({name: np.concatenate([getattr(results, name), getattr(more, name)], axis=axis)
+                    for name in ('height', 'error', 'action')})
+    if results.state is not None and more.state is not None:
+        columns['state'] = np.concatenate([results.state, more.state], axis=axis)
+    return SimulationResults(**columns, stats=more.stats, recording=more.recording, metrics=more.metrics)
+
+
+# Snapshot of a SimulationRun, from which DynamicSystem.resume_run continues it, over the same or a longer horizon.
+# It holds the state, the current dt, the sample counts of the scheduler, the controller's state (from
+# Controller.get_state) and the history it reads, the integrator's state, the recording policy and the metrics
+# accumulated so far; not the results recorded so far. Batched runs also keep their lane count and the sample counts
+# of each lane's controller. Checkpoints pickle, so long runs can save them and recover from them.
+@dataclass(frozen=True)
+class Checkpoint:
+    time: float
+    total_time: float
+    x: np.array
+    dt: float
+    control_point: float
+    control_action: float
+    disturbance: float
+    controller_state: dict
+    schedule: list
+    history: tuple
+    solver: dict
+    integrator_state: dict
+    output_dt: float
+    next_output: int
+    policy: object
+    pending: tuple
+    metrics: MetricsAccumulator = None
+    lanes: int = None
+    lane_schedule: np.array = None
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            pickle.dump(self, file)
+
+    @staticmethod
+    def load(path):
+        """Loads a checkpoint written by save(). As with any pickle, only load files you trust."""
+        with open(path, 'rb') as file:
+            return pickle.load(file)
 
 
 # Dynamic System class. Simulates a dynamic system on the form:
 # dx_dt = f(x,t)
+# The state is a scalar when `states` is 1, and otherwise an array whose last axis holds the `states` components (a
+# leading axis is added by batched runs). Limits of a vector state may be given per component, as sequences.
+# The controllers read output(x), the measured variable, which is also what the results store as the height.
 class DynamicSystem(ABC):
-    a21 = 1 / 5
-    a31, a32 = 3 / 40, 9 / 40
-    a41, a42, a43 = 44 / 55, -56 / 15, 32 / 9
-    a51, a52, a53, a54 = 19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729
-    a61, a62, a63, a64, a65 = 9017 / 3186, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656
-    a71, a73, a74, a75, a76 = 35 / 384, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84
-    a81, a83, a84, a85, a86, a87 = 71 / 57600, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40
+    states = 1
+    # Linear systems return their exact model from linearize(), so the zero-order hold never re-linearizes them.
+    linear = False
+    # Array attributes that describe the system itself rather than one value per lane of a batched run.
+    _fixed_parameters = ()
 
     def __init__(self, limits=None):
         keywords = ['dx_dt', 'x', 'action', 'dt']
@@ -32,8 +140,19 @@ class DynamicSystem(ABC):
         for keyword in keywords:
             if keyword not in limits.keys():
                 self.limits[keyword] = [None, None]
+            else:
+                self.limits[keyword] = [self._bound(limits[keyword][0], -np.inf),
+                                        self._bound(limits[keyword][1], np.inf)]
 
         self.simulation_results = None
+        self.last_checkpoint = None
+
+    @staticmethod
+    def _bound(bound, missing):
+        """Per-component bounds become float arrays, with None components replaced by an infinite bound."""
+        if isinstance(bound, (list, tuple, np.ndarray)):
+            return np.array([missing if value is None else value for value in bound], dtype=float)
+        return bound
 
     def dx_dt(self, value, action=None):
         return self.limit(self._dx_dt(value, action), self.limits['dx_dt'])
@@ -42,88 +161,130 @@ class DynamicSystem(ABC):
     def _dx_dt(self, value, action=None):
         pass
 
+    def output(self, value):
+        """Measured variable of a state, read by the controllers. Vector systems pick it along the last axis."""
+        return value
+
+    def jacobian(self, value, action=None):
+        """
+        Jacobian of dx_dt with respect to the state, used by the implicit methods. Shaped like the state for scalar
+        systems, and (..., n, n) for vector ones. Defaults to forward differences; systems can override it with the
+        analytic one.
+        """
+        return numeric_jacobian(lambda val: self.dx_dt(val, action), value, self.states == 1)
+
+    def linearize(self, value, action, derivative=None):
+        """
+        Affine model dx_dt = a x + b u + d of the system around a state and action, for the zero-order hold method.
+        a is the Jacobian and b the derivative with respect to the action (a forward difference).
+        derivative(value, action) replaces dx_dt, for instrumented runs counting its evaluations.
+        """
+        derivative = derivative or self.dx_dt
+        if type(self).jacobian is DynamicSystem.jacobian:
+            a = numeric_jacobian(lambda val: derivative(val, action), value, self.states == 1)
+        else:
+            a = self.jacobian(value, action)
+        f_x = derivative(value, action)
+        delta = np.sqrt(np.finfo(float).eps) * np.maximum(1.0, np.abs(action))
+        b = (derivative(value, action + delta) - f_x) / delta
+        d = f_x - (a @ value if self.states > 1 else a * value) - b * action
+        return a, b, d
+
+    def initial_state(self, x0, lanes=None):
+        """Broadcasts x0 to the shape of the state, with a leading lane axis when lanes is given."""
+        shape = () if self.states == 1 else (self.states,)
+        if lanes is not None:
+            shape = (lanes,) + shape
+        elif not shape:
+            return x0
+        return np.array(np.broadcast_to(np.asarray(x0, dtype=float), shape))
+
     @staticmethod
     def runge_kutta(derivative_function, xn, dt):
-        weights = [2, 2, 1]
-        k = derivative_function(xn)
-        x_n1 = k
-        for i in range(3):
-            k = derivative_function(xn + dt * k / weights[i])
-            x_n1 += k * weights[i]
-        x_n1 *= dt / 6
-        x_n1 += xn
-        return x_n1
+        xn_1, _ = explicit_rk_step(get_tableau('rk4'), derivative_function, xn, dt)
+        return xn_1
 
+    # Steppers return the new state, the dt that was taken and the dt to try on the next step.
+    # kwargs['remaining'] is the time left to the next event (a sample instant or the end of the run); steppers end
+    # their step exactly on it when it is within reach, see _land.
     def _rk_stepper(self, derivative_func, xn, dt, **kwargs):
-        """Fixed-step Runge-Kutta stepper."""
-        xn_1 = self.runge_kutta(derivative_func, xn, dt)
-        return xn_1, dt
+        """Fixed-step Runge-Kutta stepper, for any tableau in integrators.TABLEAUS."""
+        step = _land(dt, kwargs['remaining'])
+        xn_1, _ = explicit_rk_step(kwargs['tableau'], derivative_func, xn, step)
+        return xn_1, step, dt
+
+    def _scalar_rk_stepper(self, derivative_func, xn, dt, **kwargs):
+        """
+        Fixed-step stepper of scalar systems for tableaus with an unrolled scalar_step (rk4), which is the default
+        method. Batched runs, whose lanes make the state an array, take the generic stages.
+        """
+        step = _land(dt, kwargs['remaining'])
+        if isinstance(xn, np.ndarray):
+            return explicit_rk_step(kwargs['tableau'], derivative_func, xn, step)[0], step, dt
+        return kwargs['tableau'].scalar_step(derivative_func, xn, step), step, dt
 
     def _dp_stepper(self, derivative_func, xn, dt, **kwargs):
-        """Adaptive-step Dormand-Prince stepper."""
-        tol = kwargs.get('tol', 1e-6)
-        xn_1, dt_new = self.dormand_prince(derivative_func, xn, dt, tol)
-        return xn_1, dt_new
+        """Adaptive-step stepper, for any embedded pair in integrators.TABLEAUS."""
+        return kwargs['integrator'].step(derivative_func, xn, _land(dt, kwargs['remaining']))
+
+    def _implicit_stepper(self, derivative_func, xn, dt, **kwargs):
+        """
+        Stepper for the methods in integrators.IMPLICIT_METHODS, with the Jacobian from kwargs['jacobian'].
+        Adaptive when an integrator is given. Fixed steps whose Newton iteration does not converge are split in two.
+        """
+        integrator = kwargs.get('integrator')
+        step = _land(dt, kwargs['remaining'])
+        if integrator:
+            return integrator.step(derivative_func, xn, step, kwargs['jacobian'])
+        return self._implicit_substeps(kwargs['implicit'], derivative_func, kwargs['jacobian'], xn, step), step, dt
+
+    def _zoh_stepper(self, derivative_func, xn, dt, **kwargs):
+        """
+        Zero-order hold stepper: advances a whole controller sample (kwargs['ts']) at once with the action held
+        constant, through integrators.ZeroOrderHold. Without a controller it steps by dt.
+        """
+        step = _land(kwargs['ts'] or dt, kwargs['remaining'])
+        return kwargs['integrator'].step(xn, kwargs['action'], step, kwargs.get('derivative')), step, dt
+
+    def _implicit_substeps(self, method, derivative_func, jacobian, xn, dt, depth=0):
+        xn_1 = implicit_step(method, derivative_func, jacobian, xn, dt)[0]
+        if xn_1 is not None:
+            return xn_1
+        if depth == 10:
+            raise RuntimeError(f'Newton iteration of {method.name} did not converge')
+        half = self._implicit_substeps(method, derivative_func, jacobian, xn, dt / 2, depth + 1)
+        return self._implicit_substeps(method, derivative_func, jacobian, half, dt / 2, depth + 1)
+
+    def _lane_count(self, x0, *values):
+        """
+        Number of lanes of a batched run, broadcast from x0, the given values and the array-valued plant parameters.
+        For vector systems the last axis of x0 and of the parameters is the state component, not the lane.
+        """
+        parameters = [value for name, value in vars(self).items()
+                      if isinstance(value, np.ndarray) and name not in self._fixed_parameters]
+        component_axes = 0 if self.states == 1 else 1
+        shapes = [np.shape(value)[:np.ndim(value) - component_axes] for value in [x0] + parameters]
+        shape = np.broadcast_shapes(*shapes, *(np.shape(value) for value in values))
+        if len(shape) > 1:
+            raise ValueError(f'Batched simulations take one-dimensional lanes, got shape {shape}')
+        return shape[0] if shape else 1
 
     def _generic_simulate(self, stepper, total_time, dt, x0, controller, control_point,
                           onFinished, args, progressCallback, callbackArgs, returnValues, **kwargs):
-        """Generic simulation loop."""
-        # Control Variables
-        control_action = 0
-        control_timer = 0
-
-        # Simulation Variables
-        xn = x0
-        time = [0.0]
-        x = [x0]
-        error = [control_point - x0]
-        action = [0.0]
-
-        elapsed_time = 0.0
-        last_percentage = 0
-
-        while elapsed_time < total_time:
-            # Define the derivative function for this step
-            derivative_func = lambda val: self.dx_dt(val, control_action)
-
-            # Perform one integration step
-            xn, dt = stepper(derivative_func, xn, dt, **kwargs)
-            xn = self.limit(xn, self.limits['x'])
-
-            # Update time and timers
-            elapsed_time += dt
-            control_timer += dt
-
-            # Store results
-            time.append(elapsed_time)
-            x.append(xn)
-            error.append(control_point - xn)
-            action.append(control_action)
-
-            # Calculate the Control Action if the system has a controller.
-            if controller:
-                if control_timer >= controller.ts:
-                    control_timer -= controller.ts
-                    # Pass numpy arrays to the controller for consistency
-                    control_action = controller.calculate_action(np.array(x), np.array(time), control_point)
-            else:
-                control_action = 0
-
-            # Progress Callback.
-            percentage = int(100 * elapsed_time / total_time)
-            if percentage > last_percentage: # Use > to avoid multiple calls for the same percentage
-                last_percentage = percentage
-                if progressCallback:
-                    progress_args = (percentage,) + (callbackArgs if callbackArgs is not None else ())
-                    progressCallback(*progress_args)
-
-        # Convert results to numpy arrays and store them
-        self.simulation_results = SimulationResults(
-            time=np.array(time),
-            height=np.array(x),
-            error=np.array(error),
-            action=np.array(action)
-        )
+        """Runs a whole simulation by collecting the chunks of _iterate."""
+        run = SimulationRun(self, stepper, total_time, dt, x0, controller, control_point, progressCallback,
+                            callbackArgs, **kwargs)
+        return self._finish_run(run, onFinished, args, returnValues)
+
+    def _finish_run(self, run, onFinished, args, returnValues, previous=None):
+        """Runs a SimulationRun to the end and stores its results. previous results are prepended."""
+        while not run.finished:
+            run.advance()
+        self.simulation_results = run.make_results(run.results.to_dict())
+        if previous is not None:
+            self.simulation_results = append_results(previous, self.simulation_results)
+        # The run's final state, so the simulation can be extended with resume() without starting over.
+        self.last_checkpoint = run.checkpoint()
 
         # Finalization callbacks
         if onFinished:
@@ -133,61 +294,573 @@ class DynamicSystem(ABC):
         if returnValues:
             return self.simulation_results
 
-    def simulate(self, total_time=10, dt=0.001, x0=0, controller=None, control_point=0.7,
-                 onFinished=None, args=None, progressCallback=None, callbackArgs=None, returnValues=False):
-        """Simulates the system using a fixed-step Runge-Kutta method."""
-        return self._generic_simulate(self._rk_stepper, total_time, dt, x0, controller, control_point,
-                                      onFinished, args, progressCallback, callbackArgs, returnValues)
-
-    def simulate_45(self, total_time=10, dt=0.001, x0=0, tol=1e-6, controller=None, control_point=0.7,
-                    onFinished=None, args=None, progressCallback=None, callbackArgs=None, returnValues=False):
-        """Simulates the system using an adaptive-step Dormand-Prince (ODE45) method."""
+    @staticmethod
+    def _iterate(run, chunk_size):
+        """Advances a SimulationRun, yielding its samples as SimulationResults of chunk_size samples."""
+        while not run.finished:
+            run.advance(max_samples=chunk_size)
+            while len(run.results) >= chunk_size:
+                yield run.make_results(run.results.take(chunk_size))
+        if len(run.results):
+            yield run.make_results(run.results.take(len(run.results)))
+
+    def simulate_iter(self, total_time=10, dt=0.001, x0=0, controller=None, control_point=0.7, chunk_size=4096,
+                      method=None, adaptive=False, tol=1e-6, output_dt=None, recording=None, progressCallback=None,
+                      callbackArgs=None, relinearize=0, tasks=None, instrument=False, metrics=False):
+        """
+        Simulates the system incrementally, yielding the results as they are produced.
+        Each item is a SimulationResults holding the next chunk_size samples (the last one may be shorter), so
+        consumers can start right away and memory stays bounded by the chunk size. The generator can be paused
+        between chunks and stopped at any time with close().
+        adaptive selects simulate_45's behaviour (tol, output_dt); method defaults to 'dp54' for adaptive runs and
+        to 'rk4' otherwise. relinearize, tasks, instrument and metrics are described in simulate; the metrics are
+        attached to the chunks taken once the run has finished.
+        """
+        run = self.start_run(total_time, dt, x0, controller, control_point, method, adaptive, tol, output_dt,
+                             recording, progressCallback, callbackArgs, relinearize, tasks, instrument, metrics)
+        return self._iterate(run, chunk_size)
+
+    def start_run(self, total_time=10, dt=0.001, x0=0, controller=None, control_point=0.7, method=None,
+                  adaptive=False, tol=1e-6, output_dt=None, recording=None, progressCallback=None,
+                  callbackArgs=None, relinearize=0, tasks=None, instrument=False, metrics=False, lanes=None):
+        """
+        Creates a SimulationRun without advancing it, for callers that drive the integration themselves (for example
+        a few steps per frame). Takes the same arguments as simulate_iter. lanes makes it a batched run of that many
+        lanes (see simulate_batch), whose controller is made by Controller.make_batch.
+        """
+        ts = None
         if controller:
-            self.limits['dt'] = [1e-12, controller.ts]
-        return self._generic_simulate(self._dp_stepper, total_time, dt, x0, controller, control_point,
-                                      onFinished, args, progressCallback, callbackArgs, returnValues, tol=tol)
-
-    def dormand_prince(self, derivative_function, xn, dt, tol=1e-6):
-        k1 = derivative_function(xn)
-        k2 = derivative_function(xn + dt * self.a21 * k1)
-        k3 = derivative_function(xn + dt * (self.a31 * k1 + self.a32 * k2))
-        k4 = derivative_function(xn + dt * (self.a41 * k1 + self.a42 * k2 + self.a43 * k3))
-        k5 = derivative_function(xn + dt * (self.a51 * k1 + self.a52 * k2 + self.a53 * k3 + self.a54 * k4))
-        k6 = derivative_function(
-            xn + dt * (self.a61 * k1 + self.a62 * k2 + self.a63 * k3 + self.a64 * k4 + self.a65 * k5))
-        xn_1 = xn + dt * (self.a71 * k1 + self.a73 * k3 + self.a74 * k4 + self.a75 * k5 + self.a76 * k6)
-        k7 = derivative_function(xn_1)
-        error = abs(
-            dt * (self.a81 * k1 + self.a83 * k3 + self.a84 * k4 + self.a85 * k5 + self.a86 * k6 + self.a87 * k7))
-
-        if error == 0:
-            dt_new = 2*dt
-        elif error > tol or (error < tol/10):
-            a = np.power(tol * dt / (2 * error), 1 / 5)
-            factor = 0.9 * a
-            if factor > 2:
-                dt_new = 2*dt
-            elif 0.5 < factor:
-                dt_new = dt/2
+            ts = controller.ts if lanes is None else np.min(controller.ts)
+        stepper, kwargs = self._make_stepper(method, adaptive, tol, ts, relinearize)
+        if adaptive:
+            kwargs['output_dt'] = output_dt
+        return SimulationRun(self, stepper, total_time, dt, x0, controller, control_point, progressCallback,
+                             callbackArgs, recording=recording, tasks=tasks, instrument=instrument, metrics=metrics,
+                             lanes=lanes, **kwargs)
+
+    def resume_run(self, checkpoint, total_time=None, controller=None, progressCallback=None, callbackArgs=None,
+                   tasks=None):
+        """
+        Creates a SimulationRun continuing from a Checkpoint, with the solver and recording policy of the original
+        run. total_time keeps the original horizon by default, and can extend it.
+        controller must be a controller of the class the checkpoint was taken with; its state is replaced with the
+        checkpoint's. tasks are the extra tasks of the original run, in the same order: they keep their own state and
+        fire again at their next sample instants. Checkpoints of batched runs take the batched controller, as made by
+        Controller.make_batch.
+        """
+        if (controller is None) != (checkpoint.controller_state is None):
+            raise ValueError('Runs resume with a controller exactly when the checkpoint was taken with one')
+        total_time = checkpoint.total_time if total_time is None else total_time
+        if total_time < checkpoint.time:
+            raise ValueError(f'The checkpoint is at t={checkpoint.time}, past total_time={total_time}')
+        solver = checkpoint.solver
+        ts = None
+        if controller:
+            ts = controller.ts if checkpoint.lanes is None else np.min(controller.ts)
+        stepper, kwargs = self._make_stepper(solver['method'], solver['adaptive'], solver['tol'], ts,
+                                             solver['relinearize'])
+        if solver['adaptive']:
+            kwargs['output_dt'] = checkpoint.output_dt
+        return SimulationRun(self, stepper, total_time, checkpoint.dt, checkpoint.x, controller,
+                             checkpoint.control_point, progressCallback, callbackArgs,
+                             recording=copy.deepcopy(checkpoint.policy), tasks=tasks, checkpoint=checkpoint,
+                             lanes=checkpoint.lanes, **kwargs)
+
+    def resume(self, checkpoint, total_time=None, controller=None, results=None, onFinished=None, args=None,
+               progressCallback=None, callbackArgs=None, returnValues=False, tasks=None):
+        """
+        Continues a simulation from a checkpoint up to total_time, like simulate. With results, the results the run
+        had recorded up to the checkpoint, the new samples are appended to them, so a finished simulation can be
+        extended with simulate(...) followed by resume(system.last_checkpoint, longer_time, controller, results).
+        See resume_run for the other arguments.
+        """
+        run = self.resume_run(checkpoint, total_time, controller, progressCallback, callbackArgs, tasks)
+        return self._finish_run(run, onFinished, args, returnValues, results)
+
+    def _make_stepper(self, method, adaptive, tol, ts, relinearize=0):
+        """
+        Returns the stepper and its keyword arguments for a method name. kwargs['solver'] keeps the arguments, which
+        checkpoints store to rebuild the stepper.
+        """
+        if method is None:
+            method = 'dp54' if adaptive else 'rk4'
+        implicit = get_implicit_method(method)
+        if method == 'zoh':
+            stepper, kwargs = self._zoh_stepper, {'integrator': ZeroOrderHold(self.linearize, self.linear, relinearize),
+                                                  'ts': ts}
+        elif not adaptive:
+            if implicit:
+                stepper, kwargs = self._implicit_stepper, {'implicit': implicit}
             else:
-                dt_new = factor*dt
+                tableau = get_tableau(method)
+                stepper = self._scalar_rk_stepper if tableau.scalar_step and self.states == 1 else self._rk_stepper
+                kwargs = {'tableau': tableau}
+        elif implicit:
+            integrator = ImplicitIntegrator(implicit, tol, dt_limits=self.limits['dt'])
+            stepper, kwargs = self._implicit_stepper, {'integrator': integrator}
         else:
-            dt_new = dt
+            integrator = AdaptiveIntegrator(get_tableau(method), tol, dt_limits=self.limits['dt'])
+            stepper, kwargs = self._dp_stepper, {'integrator': integrator}
+        kwargs['solver'] = {'method': method, 'adaptive': adaptive, 'tol': tol, 'relinearize': relinearize}
+        return stepper, kwargs
 
-        dt_new = self.limit(dt_new, self.limits['dt'])
+    def simulate(self, total_time=10, dt=0.001, x0=0, controller=None, control_point=0.7,
+                 onFinished=None, args=None, progressCallback=None, callbackArgs=None, returnValues=False,
+                 method='rk4', recording=None, relinearize=0, tasks=None, instrument=False, metrics=False):
+        """
+        Simulates the system using a fixed-step Runge-Kutta method (any name in integrators.TABLEAUS), or an implicit
+        one ('backward_euler' or 'trbdf2'), which stays stable with larger steps where the system is stiff, such as a
+        tank running empty.
+        method='zoh' advances each controller sample in a single step, exactly for linear systems, through the
+        matrix exponential of the system linearized around its state (see DynamicSystem.linearize). Nonlinear systems
+        are re-linearized whenever the state moved more than relinearize from the last linearization point: 0 does it
+        at every sample, np.inf keeps the linearization around x0.
+        recording is a recording.RecordingPolicy choosing which steps are stored; by default all of them are.
+        tasks are extra scheduler.Task objects run at their own rates next to the controller: more controllers
+        (cascaded loops included), sensors and disturbances. Integration steps end exactly on every sample instant.
+        instrument=True collects a SimulationStats in SimulationResults.stats: derivative evaluations, step sizes,
+        controller calls and where the wall time went. Uninstrumented runs do not pay for it.
+        metrics=True updates a metrics.MetricsAccumulator at every step and puts its metrics in
+        SimulationResults.metrics. They do not depend on the results being kept, so runs that only need them can
+        pass recording=recording.RecordNone().
+        """
+        stepper, kwargs = self._make_stepper(method, False, None, controller.ts if controller else None, relinearize)
+        return self._generic_simulate(stepper, total_time, dt, x0, controller, control_point,
+                                      onFinished, args, progressCallback, callbackArgs, returnValues,
+                                      recording=recording, tasks=tasks, instrument=instrument, metrics=metrics,
+                                      **kwargs)
 
-        return xn_1, dt_new
+    def simulate_45(self, total_time=10, dt=0.001, x0=0, tol=1e-6, controller=None, control_point=0.7,
+                    onFinished=None, args=None, progressCallback=None, callbackArgs=None, returnValues=False,
+                    method='dp54', output_dt=None, recording=None, tasks=None, instrument=False, metrics=False):
+        """
+        Simulates the system using an adaptive-step method, Dormand-Prince (ODE45) by default.
+        method can be any embedded pair in integrators.TABLEAUS: 'heun', 'bs32', 'dp54' or 'tsit5', or the implicit
+        'trbdf2', which needs far fewer steps where the system is stiff (see DynamicSystem.jacobian).
+        Steps whose error exceeds tol (absolute, and relative to the height) are rejected and retried. The step
+        counters are returned in SimulationResults.stats.
+        With output_dt, the results are sampled every output_dt seconds through the method's dense output (for
+        example 1/60 for playback), so their size depends on the horizon and not on the tolerance.
+        recording is a recording.RecordingPolicy choosing which steps (or output samples) are stored.
+        Steps end exactly on the sample instants of the controller and of the tasks (see simulate), so the step
+        size is only limited by the tolerance. instrument and metrics are described in simulate.
+        """
+        stepper, kwargs = self._make_stepper(method, True, tol, controller.ts if controller else None)
+        return self._generic_simulate(stepper, total_time, dt, x0, controller, control_point,
+                                      onFinished, args, progressCallback, callbackArgs, returnValues,
+                                      output_dt=output_dt, recording=recording, tasks=tasks, instrument=instrument,
+                                      metrics=metrics, **kwargs)
+
+    def simulate_batch(self, total_time=10, dt=0.001, x0=0, controller_class=None, controller_kwargs=None,
+                       control_point=0.7, method=None, adaptive=False, tol=1e-6, recording=None, onFinished=None,
+                       args=None, progressCallback=None, callbackArgs=None, returnValues=False, relinearize=0,
+                       output_dt=None, tasks=None, instrument=False, metrics=False):
+        """
+        Simulates N configurations at once, with an N-length state vector (an (N, n) array for vector systems).
+        x0, control_point, the controller kwargs and the plant parameters may be arrays with one value per lane.
+        The lanes are controlled through controller_class.make_batch: one instance holding per-lane arrays when the
+        class implements calculate_action_batch, one instance per lane otherwise. Adaptive runs share one step size
+        across lanes.
+        Since the results hold N values per sample, large batches should usually pass a recording policy such as
+        recording.Decimate.
+        method defaults to 'dp54' for adaptive runs and to 'rk4' otherwise. Steps end exactly on the sample instants
+        of every lane. With method='zoh' a step never spans more than the smallest controller sample time.
+        The run is a SimulationRun like the others: output_dt, tasks and instrument are described in simulate and
+        simulate_45 (tasks read and act on every lane at once), and system.last_checkpoint resumes it.
+        metrics=True accumulates the metrics of every lane at once (see metrics.BatchMetricsAccumulator), so with
+        recording=recording.RecordNone() a batch scores its lanes in memory independent of the horizon.
+        """
+        controller_kwargs = controller_kwargs if controller_kwargs is not None else {}
+        lanes = self._lane_count(x0, control_point, *controller_kwargs.values())
+        controller = controller_class.make_batch(lanes, **controller_kwargs) if controller_class else None
+        stepper, kwargs = self._make_stepper(method, adaptive, tol, np.min(controller.ts) if controller else None,
+                                             relinearize)
+        if adaptive:
+            kwargs['output_dt'] = output_dt
+        return self._generic_simulate(stepper, total_time, dt, x0, controller, control_point,
+                                      onFinished, args, progressCallback, callbackArgs, returnValues,
+                                      recording=recording, tasks=tasks, instrument=instrument, metrics=metrics,
+                                      lanes=lanes, **kwargs)
+
+    def dormand_prince(self, derivative_function, xn, dt, tol=1e-6):
+        """
+        Takes one accepted Dormand-Prince step, retrying with a smaller dt while the error is above tol.
+        Returns the new state, the dt taken and the dt proposed for the next step.
+        """
+        integrator = AdaptiveIntegrator(get_tableau('dp54'), tol, dt_limits=self.limits['dt'])
+        return integrator.step(derivative_function, xn, dt)
 
     @staticmethod
     def limit(x, limits):
+        lower, upper = limits
+        if isinstance(x, np.ndarray):
+            if lower is None and upper is None:
+                return x
+            return np.clip(x, lower, upper)
         out = x
-        if limits[0]:
-            out = max(limits[0], out)
-        if limits[1]:
-            out = min(limits[1], out)
+        if lower is not None:
+            out = max(lower, out)
+        if upper is not None:
+            out = min(upper, out)
         return out
 
 
+# State of one simulation in progress.
+# Holds everything the integration loop needs between steps, so a run can be advanced a few steps at a time and its
+# samples taken out of `results` as they are produced. Batched runs (lanes=N) advance N lanes as one state array: the
+# control point and action hold a value per lane, and the controller is a batched one (see Controller.make_batch)
+# whose lanes fire at their own sample instants.
+class SimulationRun:
+
+    def __init__(self, system, stepper, total_time, dt, x0, controller, control_point, progressCallback=None,
+                 callbackArgs=None, **kwargs):
+        self.system = system
+        self.stepper = stepper
+        checkpoint = kwargs.pop('checkpoint', None)
+        self.solver = kwargs.pop('solver', None)
+        self.lanes = kwargs.pop('lanes', None)
+        self.kwargs = kwargs
+        self.total_time = total_time
+        self.dt = dt
+        self.controller = controller
+        lane_shape = () if self.lanes is None else (self.lanes,)
+        if self.lanes is not None:
+            control_point = np.broadcast_to(np.asarray(control_point, dtype=float), lane_shape)
+        self.control_point = control_point
+        self.progressCallback = progressCallback
+        self.callbackArgs = callbackArgs
+
+        # Instrumented runs wrap the stepper and the callback with counting and timing code, so the integration loop
+        # is the same whether the run is instrumented or not.
+        self.instrumentation = SimulationStats() if kwargs.pop('instrument', False) else None
+        if self.instrumentation:
+            self.stepper = self._instrumented_stepper(stepper)
+            if progressCallback:
+                self.progressCallback = self._instrumented_callback(progressCallback)
+
+        # Control Variables. The system receives applied_action, the control action plus any disturbance.
+        self.control_action = 0 if self.lanes is None else np.zeros(lane_shape)
+        self.disturbance = 0
+        self.applied_action = self.control_action
+
+        # Simulation Variables. Vector systems also store the whole state next to the measured output, and batched
+        # runs store a value per lane in every column but the time.
+        self._vector = system.states > 1
+        self.x = system.initial_state(x0, self.lanes)
+        y0 = system.output(self.x) if self._vector else self.x
+        self.time = 0.0
+        if self._vector or self.lanes is not None:
+            fields = {'time': (), 'height': lane_shape, 'error': lane_shape, 'action': lane_shape}
+            if self._vector:
+                fields['state'] = lane_shape + (system.states,)
+            self.results = ResultBuffer(fields)
+            self.results.append(0.0, y0, control_point - y0, self.control_action, self.x)
+        else:
+            self.results = ResultBuffer(('time', 'height', 'error', 'action'))
+            self.results.append(0.0, y0, control_point - y0, 0.0)
+        self.last_percentage = 0
+
+        # Metrics are accumulated from every step, independently of what the recording policy keeps.
+        self.metrics = None
+        if kwargs.pop('metrics', False):
+            self.metrics = (MetricsAccumulator if self.lanes is None else BatchMetricsAccumulator)(control_point)
+        if self.metrics and checkpoint is None:
+            self.metrics.start(0.0, y0)
+
+        # The recording policy picks the stored steps. The last step is always stored, see `_pending`.
+        self.policy = kwargs.pop('recording', None) or RecordAll()
+        self._record_all = type(self.policy) is RecordAll
+        if checkpoint is None:
+            self.policy.start(0.0, self.x, self.control_action)
+        self._pending = None
+
+        # With an output period, samples come from the integrator's dense output on a uniform grid instead of
+        # being recorded at every internal step.
+        self.integrator = kwargs.get('integrator')
+        self.output_dt = kwargs.pop('output_dt', None)
+        self._next_output = 1
+        self._last_output = int(np.floor(total_time / self.output_dt + 1e-9)) if self.output_dt else 0
+
+        # Controllers that declare how much history they read get a bounded window instead of the full arrays. The
+        # history is kept apart from `results`, which only holds the recorded steps and is drained as chunks are taken.
+        self.history = None
+        if controller:
+            self.history = history_buffers(controller.history, lane_shape)
+            self.history[0].append(y0)
+            self.history[1].append(0.0)
+
+        # The controller and the extra tasks fire from a scheduler, whose instants the integration steps end on.
+        self.scheduler = Scheduler()
+        self._controller_task = None
+        if controller:
+            self._controller_task = _RunController(controller) if self.lanes is None else \
+                _RunBatchController(controller, self.lanes)
+            self.scheduler.add(self._controller_task)
+        for task in kwargs.pop('tasks', None) or ():
+            self.scheduler.add(task)
+        if checkpoint is None:
+            self.scheduler.start(self)
+        else:
+            self._restore(checkpoint)
+        self._update_action()
+
+        self._derivative_func = None
+        self._derivative_action = None
+        self._jacobian_func = None
+        self._closed = False
+
+    @property
+    def finished(self):
+        return self._closed
+
+    def _update_action(self):
+        self.applied_action = self.control_action + self.disturbance if self.disturbance else self.control_action
+        self._next_event = min(self.scheduler.next_time, self.total_time)
+
+    def _run_controller(self, firing=None):
+        """
+        Runs the run's own controller, which reads the output at every integration step. In batched runs only the
+        lanes in `firing` are at one of their sample instants, and the others keep their action.
+        """
+        readings, times = self.history[0].view(), self.history[1].view()
+        if firing is None:
+            self.control_action = self.call_controller(self.controller, readings, times, self.control_point)
+            return
+        if firing.size < self.lanes:
+            readings = readings[:, firing]
+        control_action = self.control_action.copy()
+        control_action[firing] = self.call_controller(self.controller, readings, times, self.control_point[firing],
+                                                      firing)
+        self.control_action = control_action
+
+    def call_controller(self, controller, readings, times, control_point, lanes=None):
+        """
+        Returns controller.calculate_action(...), or calculate_action_batch(..., lanes) when lanes are given, counted
+        and timed when the run is instrumented.
+        """
+        calculate = controller.calculate_action if lanes is None else \
+            lambda *arguments: controller.calculate_action_batch(*arguments, lanes)
+        if self.instrumentation is None:
+            return calculate(readings, times, control_point)
+        start = perf_counter()
+        action = calculate(readings, times, control_point)
+        self.instrumentation.controller_time += perf_counter() - start
+        self.instrumentation.controller_calls += 1
+        return action
+
+    def _instrumented_stepper(self, stepper):
+        stats = self.instrumentation
+        counted = {}
+
+        def count(function):
+            # The same wrapper is returned for the same function, which keeps the integrators' stage reuse working.
+            if counted.get('function') is not function:
+                def counted_function(value):
+                    stats.evaluations += 1
+                    return function(value)
+                counted.update(function=function, wrapper=counted_function)
+            return counted['wrapper']
+
+        def counted_jacobian(jacobian):
+            def wrapper(value):
+                stats.jacobians += 1
+                return jacobian(value)
+            return wrapper
+
+        # The zero-order hold evaluates the system itself, to linearize it.
+        def counted_derivative(value, action):
+            stats.evaluations += 1
+            return self.system.dx_dt(value, action)
+
+        def instrumented(derivative_func, xn, dt, **kwargs):
+            kwargs['jacobian'] = counted_jacobian(kwargs['jacobian'])
+            kwargs['derivative'] = counted_derivative
+            start = perf_counter()
+            result = stepper(count(derivative_func), xn, dt, **kwargs)
+            stats.integrator_time += perf_counter() - start
+            step = result[1]
+            stats.accepted += 1
+            stats.total_dt += step
+            stats.min_dt = min(stats.min_dt, step)
+            stats.max_dt = max(stats.max_dt, step)
+            return result
+        return instrumented
+
+    def _instrumented_callback(self, callback):
+        def instrumented(*args):
+            start = perf_counter()
+            callback(*args)
+            self.instrumentation.callback_time += perf_counter() - start
+        return instrumented
+
+    def checkpoint(self):
+        """Returns a Checkpoint of the run at its current time. It is resumed with DynamicSystem.resume_run."""
+        history = (self.history[0].view().copy(), self.history[1].view().copy()) if self.history else None
+        lane_schedule = None
+        if isinstance(self._controller_task, _RunBatchController):
+            lane_schedule = self._controller_task.fire_count.copy()
+        return Checkpoint(
+            time=self.time, total_time=self.total_time, x=np.copy(self.x) if isinstance(self.x, np.ndarray) else self.x,
+            dt=self.dt,
+            control_point=self.control_point, control_action=self.control_action, disturbance=self.disturbance,
+            controller_state=self.controller.get_state() if self.controller else None,
+            schedule=self.scheduler.get_state(), history=history, solver=self.solver,
+            integrator_state=self.integrator.get_state() if self.integrator else None, output_dt=self.output_dt,
+            next_output=self._next_output, policy=copy.deepcopy(self.policy), pending=self._pending,
+            metrics=copy.deepcopy(self.metrics), lanes=self.lanes, lane_schedule=lane_schedule
+        )
+
+    def _restore(self, checkpoint):
+        """Continues from a checkpoint instead of from t = 0. The state and dt were already given to __init__."""
+        self.time = checkpoint.time
+        self.control_action = checkpoint.control_action
+        self.disturbance = checkpoint.disturbance
+        self.last_percentage = int(100 * self.time / self.total_time)
+        self.results.clear()
+        self._pending = checkpoint.pending
+        self._next_output = checkpoint.next_output
+        if checkpoint.metrics is not None:
+            self.metrics = copy.deepcopy(checkpoint.metrics)
+
+        if self.controller:
+            self.controller.set_state(checkpoint.controller_state)
+            readings, times = checkpoint.history
+            if self.controller.history:
+                readings, times = readings[-self.controller.history:], times[-self.controller.history:]
+            self.history = history_buffers(self.controller.history, np.shape(self.control_point))
+            for reading, time in zip(readings, times):
+                self.history[0].append(reading)
+                self.history[1].append(time)
+        if self.integrator and checkpoint.integrator_state:
+            self.integrator.set_state(checkpoint.integrator_state)
+        if checkpoint.lane_schedule is not None:
+            self._controller_task.set_counts(checkpoint.lane_schedule)
+        self.scheduler.set_state(checkpoint.schedule)
+
+    def make_results(self, columns):
+        """Wraps arrays taken from `results` into a SimulationResults."""
+        stats = self.integrator.stats if self.integrator else None
+        if self.instrumentation:
+            # Rejected steps and linearizations only show in the integrator's own counters.
+            if stats:
+                self.instrumentation.rejected = stats.rejected
+                if isinstance(self.integrator, ZeroOrderHold):
+                    self.instrumentation.jacobians = stats.jacobians
+            stats = self.instrumentation
+        metrics = self.metrics.result() if self.metrics and self._closed else None
+        if self.lanes is not None:
+            # The buffer holds one row per sample; batched results hold one row per lane.
+            columns = {name: column if name == 'time' else np.ascontiguousarray(np.moveaxis(column, 0, 1))
+                       for name, column in columns.items()}
+        return SimulationResults(**columns, stats=stats, recording=str(self.policy), metrics=metrics)
+
+    def advance(self, max_steps=None, max_samples=None, until=None, deadline=None):
+        """
+        Integrates until the end of the horizon, or until one of the optional limits is reached: max_steps steps
+        taken, max_samples samples held in `results`, the simulated time reaching `until`, or time.perf_counter()
+        passing `deadline`. Returns the number of steps taken.
+        """
+        system = self.system
+        stepper = self.stepper
+        kwargs = self.kwargs
+        total_time = self.total_time
+        control_point = self.control_point
+        controller = self.controller
+        results = self.results
+        policy = self.policy
+        record_all = self._record_all
+        history = self.history
+        vector = self._vector
+        metrics = self.metrics
+        steps = 0
+
+        if until is not None and self.time >= until:
+            return steps
+        start = perf_counter() if self.instrumentation else None
+
+        while self.time < total_time:
+            # Define the derivative function. It is only rebuilt when the action changes, so that adaptive
+            # integrators can tell when the last stage of the previous step is still valid.
+            control_action = self.applied_action
+            if self._derivative_func is None or control_action is not self._derivative_action:
+                self._derivative_action = control_action
+                self._derivative_func = lambda val, action=control_action: system.dx_dt(val, action)
+                self._jacobian_func = lambda val, action=control_action: system.jacobian(val, action)
+
+            # Perform one integration step, ending on the next event when it is within reach
+            remaining = self._next_event - self.time
+            xn, step, self.dt = stepper(self._derivative_func, self.x, self.dt, remaining=remaining,
+                                        jacobian=self._jacobian_func, action=control_action, **kwargs)
+            xn = system.limit(xn, system.limits['x'])
+            self.x = xn
+            yn = system.output(xn) if vector else xn
+
+            # Update time. Steps that reach the event land exactly on it, so sample instants never drift.
+            self.time = self._next_event if step >= remaining else self.time + step
+            elapsed_time = self.time
+            steps += 1
+            if metrics:
+                metrics.update(elapsed_time, yn, control_action)
+
+            # Store results
+            if self.output_dt:
+                self._record_outputs(step, control_action)
+            elif record_all or policy.keep(elapsed_time, xn, control_action):
+                results.append(elapsed_time, yn, control_point - yn, control_action, xn)
+                self._pending = None
+            else:
+                self._pending = (elapsed_time, yn, control_point - yn, control_action, xn)
+            if history:
+                history[0].append(yn)
+                history[1].append(elapsed_time)
+
+            # Run the controller and the tasks due at this instant.
+            if elapsed_time >= self._next_event:
+                self.scheduler.fire_due(self)
+                self._update_action()
+
+            # Progress Callback.
+            percentage = int(100 * elapsed_time / total_time)
+            if percentage > self.last_percentage:  # Use > to avoid multiple calls for the same percentage
+                self.last_percentage = percentage
+                if self.progressCallback:
+                    progress_args = (percentage,) + (self.callbackArgs if self.callbackArgs is not None else ())
+                    self.progressCallback(*progress_args)
+
+            if (max_steps is not None and steps >= max_steps) or \
+                    (max_samples is not None and len(results) >= max_samples) or \
+                    (until is not None and elapsed_time >= until) or \
+                    (deadline is not None and perf_counter() >= deadline):
+                break
+
+        if self.time >= total_time and not self._closed:
+            if self._pending:
+                results.append(*self._pending)
+                self._pending = None
+            self._closed = True
+        if start is not None:
+            self.instrumentation.wall_time += perf_counter() - start
+        return steps
+
+    def _record_outputs(self, step, control_action):
+        """Records the output grid samples that fall inside the last step, from the integrator's dense output."""
+        elapsed_time = self.time
+        outputs = min(int(np.floor(elapsed_time / self.output_dt + 1e-9)), self._last_output)
+        if outputs < self._next_output:
+            return
+        output_times = np.arange(self._next_output, outputs + 1) * self.output_dt
+        theta = (output_times - (elapsed_time - step)) / step
+        states = self.system.limit(self.integrator.interpolate(theta), self.system.limits['x'])
+        measured = self.system.output(states)
+        for output_time, state, output in zip(output_times, states, measured):
+            if self._record_all or self.policy.keep(output_time, state, control_action):
+                self.results.append(output_time, output, self.control_point - output, control_action, state)
+                self._pending = None
+            else:
+                self._pending = (output_time, output, self.control_point - output, control_action, state)
+        self._next_output = outputs + 1
+
+
 # Implementation of Water Tank Dynamics.
 class WaterTank(DynamicSystem):
     g = 9.81
@@ -202,25 +875,148 @@ class WaterTank(DynamicSystem):
         self._k2 = incoming_max_velocity * input_area / tank_area
 
     def _dx_dt(self, value, action=None):
-        return self._k2 * action - self._k1 * np.sqrt(max(0, value)) # Avoid sqrt of negative
-
-
-# class InvertedPendulum:
-#     g = 9.81
-#
-#     def __init__(self, L=1, inital_theta=0.00001):
-#         self.L
-#         self.theta = 0
-#
-#
-#     def iterate(self, action, dt=0.01):
-#         dh = self.k2*action - self.k1*np.sqrt(self.h)
-#         self.h += dh*dt
-#         self.elapsed_time += dt
-#         if self.h <= 0:
-#             self.h = 0
-#         if self.h >= self.h_max:
-#             self.h = self.h_max
-#
-#     def get_reading(self):
-#         return self.h + np.random.normal(0, 0.03)
+        return self._k2 * action - self._k1 * np.sqrt(value * (value > 0))  # Avoid sqrt of negative
+
+    def jacobian(self, value, action=None):
+        # d/dh of -k1*sqrt(h) is unbounded at h = 0. Below a small fraction of the height it is held at its value
+        # there, which keeps Newton's iteration finite while the tank empties.
+        return -self._k1 / (2 * np.sqrt(np.maximum(value, 1e-8 * self._h_max)))
+
+
+# Linear time-invariant system dx_dt = a x + b u + d. The measured output is the component `measured` of the state;
+# one-dimensional systems have a scalar state. The zero-order hold method simulates these exactly.
+class LinearSystem(DynamicSystem):
+    linear = True
+    _fixed_parameters = ('_a', '_b', '_d')
+
+    def __init__(self, a, b, d=0, measured=0, limits=None):
+        a = np.atleast_2d(np.asarray(a, dtype=float))
+        self.states = len(a)
+        DynamicSystem.__init__(self, limits)
+        b = np.broadcast_to(np.asarray(b, dtype=float).ravel(), (self.states,))
+        d = np.broadcast_to(np.asarray(d, dtype=float).ravel(), (self.states,))
+        if self.states == 1:
+            self._a, self._b, self._d = float(a[0, 0]), float(b[0]), float(d[0])
+        else:
+            self._a, self._b, self._d = a, np.array(b), np.array(d)
+        self._measured = measured
+
+    def _dx_dt(self, value, action=None):
+        if self.states == 1:
+            return self._a * value + self._b * action + self._d
+        return value @ self._a.T + np.multiply.outer(action, self._b) + self._d
+
+    def jacobian(self, value, action=None):
+        if self.states == 1:
+            return np.full(np.shape(value), self._a) if np.ndim(value) else self._a
+        return np.broadcast_to(self._a, np.shape(value)[:-1] + self._a.shape)
+
+    def linearize(self, value, action, derivative=None):
+        return self._a, self._b, self._d
+
+    def output(self, value):
+        return value if self.states == 1 else value[..., self._measured]
+
+
+# Implementation of a cascade of water tanks, each one draining into the next.
+# The pump feeds the first tank, and the level of the last one is the measured output. The tank parameters can be
+# given per tank, as sequences.
+class CascadedWaterTanks(DynamicSystem):
+    g = 9.81
+
+    def __init__(self, tanks=2, max_height=1, tank_area=0.09, tank_escape_area=0.001 * np.pi,
+                 incoming_max_velocity=20, input_area=0.0004 * np.pi):
+        self.states = tanks
+        max_height = np.broadcast_to(np.asarray(max_height, dtype=float), (tanks,))
+        DynamicSystem.__init__(self, {
+            'x': [[0] * tanks, list(max_height)]
+        })
+        tank_area = np.broadcast_to(np.asarray(tank_area, dtype=float), (tanks,))
+        tank_escape_area = np.broadcast_to(np.asarray(tank_escape_area, dtype=float), (tanks,))
+        self._h_max = np.array(max_height)
+        # Outflow of each tank, and the share of the previous tank's outflow that reaches each tank.
+        self._k1 = np.sqrt(2 * self.g) * tank_escape_area / tank_area
+        self._k_in = np.concatenate(([0.0], tank_escape_area[:-1] / tank_area[1:])) * np.sqrt(2 * self.g)
+        self._k2 = incoming_max_velocity * input_area / tank_area[0]
+
+    def _dx_dt(self, value, action=None):
+        drain = np.sqrt(value * (value > 0))  # Avoid sqrt of negative
+        dx = -self._k1 * drain
+        dx[..., 1:] += self._k_in[1:] * drain[..., :-1]
+        dx[..., 0] += self._k2 * action
+        return dx
+
+    def output(self, value):
+        return value[..., -1]
+
+
+# Implementation of an inverted pendulum driven by a torque at its pivot.
+# The state is [theta, omega], with theta measured from the upright position. The action is the normalized motor
+# command in [-1, 1], scaled by max_torque. The measured output is the angle.
+class InvertedPendulum(DynamicSystem):
+    g = 9.81
+    states = 2
+
+    def __init__(self, length=1, mass=1, friction=0.1, max_torque=20, max_speed=None):
+        DynamicSystem.__init__(self, {
+            'x': [[None, None if max_speed is None else -max_speed], [None, max_speed]]
+        })
+        self._g_l = self.g / length
+        self._inertia = mass * length ** 2
+        self._friction = friction
+        self._max_torque = max_torque
+
+    def _dx_dt(self, value, action=None):
+        theta = value[..., 0]
+        omega = value[..., 1]
+        torque = self._max_torque * action
+        alpha = self._g_l * np.sin(theta) + (torque - self._friction * omega) / self._inertia
+        return np.stack((omega, alpha), axis=-1)
+
+    def output(self, value):
+        return value[..., 0]
+
+
+# Scheduler task running the controller given to a simulation, on the history kept by the SimulationRun.
+class _RunController(Task):
+
+    def __init__(self, controller):
+        Task.__init__(self, controller.ts, name=type(controller).__name__)
+        self.controller = controller
+
+    def fire(self, run):
+        run._run_controller()
+
+
+# Scheduler task running the batched controller of a batched run. Each lane has its own sample time; the task is due
+# at the earliest next instant of any lane, and only runs the lanes due then. Instants are kept as exact multiples of
+# each lane's ts.
+class _RunBatchController(Task):
+
+    def __init__(self, controller, lanes):
+        self.ts = np.broadcast_to(np.asarray(controller.ts, dtype=float), (lanes,))
+        Task.__init__(self, float(self.ts.min()), name=type(controller).__name__)
+        self.controller = controller
+        self.set_counts(np.ones(lanes))
+
+    def set_counts(self, counts):
+        """Sets how many times each lane is due to have fired at its next instant, for resuming from a checkpoint."""
+        self.fire_count = np.array(counts, dtype=float)
+        self.next_fire = self.ts * self.fire_count
+
+    def instant(self, count):
+        return self.next_fire.min()
+
+    def fire(self, run):
+        firing = np.flatnonzero(self.next_fire <= run.time)
+        self.fire_count[firing] += 1
+        self.next_fire[firing] = self.ts[firing] * self.fire_count[firing]
+        run._run_controller(firing)
+
+
+def _land(dt, remaining):
+    """
+    Step to take towards an event `remaining` seconds away: the whole remaining time when it is within dt, or only
+    slightly beyond it (round-off in the accumulated time), else dt.
+    """
+    return remaining if remaining <= dt * (1 + 1e-6) else dt
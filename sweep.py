@@ -0,0 +1,173 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from controller import get_custom_controllers
+from metrics import METRIC_NAMES
+from recording import RecordAll, RecordNone
+from simulator import WaterTank
+
+# Order of the signals stored for each run in the shared block.
+SIGNALS = ('height', 'error', 'action')
+
+
+# Results of a parameter sweep. metrics holds the metrics of every run, indexed like `runs`. Sweeps run with
+# signals=True also resample every run on the same uniform time grid, and store the signals as (runs, samples) arrays;
+# the others leave time, height, error and action as None.
+@dataclass(frozen=True)
+class SweepResults:
+    runs: list
+    time: np.ndarray
+    height: np.ndarray
+    error: np.ndarray
+    action: np.ndarray
+    metrics: list
+
+    def summary(self):
+        """Returns the per-run metrics as a text table."""
+        headers = ['run', 'controller', 'parameters'] + list(METRIC_NAMES)
+        rows = []
+        for index, (run, metrics) in enumerate(zip(self.runs, self.metrics)):
+            parameters = ', '.join(f'{name}={value:g}' for name, value in
+                                   list(run['plant'].items()) + list(run['controller_kwargs'].items()))
+            rows.append([str(index), run['controller'], parameters] + [f'{metrics[name]:.4g}' for name in METRIC_NAMES])
+        widths = [max(len(row[column]) for row in [headers] + rows) for column in range(len(headers))]
+        lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in [headers] + rows]
+        lines.insert(1, '  '.join('-' * width for width in widths))
+        return '\n'.join(lines)
+
+
+def make_grid(tank_parameters, controllers, controller_kwargs=None):
+    """
+    Builds the list of runs of a sweep.
+    tank_parameters: dict mapping WaterTank arguments to the list of values to try.
+    controllers: controller entries from get_custom_controllers(), or their names.
+    controller_kwargs: dict mapping a controller name to a dict of argument -> list of values to try.
+    """
+    controller_kwargs = controller_kwargs if controller_kwargs is not None else {}
+    plant_names = list(tank_parameters)
+    plants = [dict(zip(plant_names, values)) for values in itertools.product(*tank_parameters.values())]
+
+    runs = []
+    for controller in controllers:
+        name = controller if isinstance(controller, str) else controller['name']
+        grid = controller_kwargs.get(name, {})
+        kwargs_list = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+        for plant, kwargs in itertools.product(plants, kwargs_list):
+            runs.append({'plant': plant, 'controller': name, 'controller_kwargs': kwargs})
+    return runs
+
+
+# Worker state, set once per process by _init_worker.
+_worker = {}
+
+
+def _init_worker(block_name, shape, settings):
+    # Pool workers share the parent's resource tracker, so attaching here does not take ownership of the block.
+    _worker['data'] = None
+    if block_name is not None:
+        block = shared_memory.SharedMemory(name=block_name)
+        _worker['block'] = block
+        _worker['data'] = np.ndarray(shape, dtype=float, buffer=block.buf)
+    _worker['settings'] = settings
+    _worker['controllers'] = {entry['name']: entry for entry in get_custom_controllers()}
+
+
+def _lane_values(arguments):
+    """Joins the keyword arguments of several runs, which have the same names, into one array per name."""
+    return {name: np.array([values[name] for values in arguments], dtype=float) for name in arguments[0]}
+
+
+def _run_chunk(indices, runs):
+    """
+    Simulates the runs of a chunk as one batched run per controller, with a lane per run holding its plant parameters
+    and controller kwargs. The metrics are accumulated while the lanes run, so without signals nothing is recorded.
+    """
+    settings = _worker['settings']
+    data = _worker['data']
+    grid = np.arange(data.shape[2]) * settings['dt'] if data is not None else None
+    groups = {}
+    for index, run in zip(indices, runs):
+        groups.setdefault(run['controller'], []).append((index, run))
+
+    metrics = []
+    for name, members in groups.items():
+        tank = WaterTank(**_lane_values([run['plant'] for _, run in members]))
+        output_dt = settings['dt'] if data is not None and settings['adaptive'] else None
+        results = tank.simulate_batch(settings['total_time'], settings['dt'], settings['x0'],
+                                      _worker['controllers'][name]['class'],
+                                      _lane_values([run['controller_kwargs'] for _, run in members]),
+                                      settings['control_point'], method=settings['method'],
+                                      adaptive=settings['adaptive'], tol=settings['tol'],
+                                      recording=RecordNone() if data is None else RecordAll(), output_dt=output_dt,
+                                      metrics=True, returnValues=True)
+        for lane, (index, _) in enumerate(members):
+            if data is not None:
+                for row, signal in enumerate(SIGNALS):
+                    data[index, row] = np.interp(grid, results.time, getattr(results, signal)[lane])
+            metrics.append((index, {metric: float(values[lane]) for metric, values in results.metrics.items()}))
+    return metrics
+
+
+def sweep(tank_parameters, controllers, controller_kwargs=None, total_time=10, dt=0.001, x0=0, control_point=0.7,
+          method=None, adaptive=False, tol=1e-6, workers=None, chunk_size=8, signals=False, progressCallback=None,
+          callbackArgs=None):
+    """
+    Runs every combination of make_grid(tank_parameters, controllers, controller_kwargs) in a process pool.
+    Each chunk of chunk_size runs is simulated with WaterTank.simulate_batch, a lane per run. adaptive selects the
+    adaptive methods (with tol, and a step size shared by the lanes of a batch); method defaults to 'dp54' for
+    adaptive runs and to 'rk4' otherwise.
+    Workers only send back the metrics, which are accumulated during the runs. With signals=True they also write the
+    signals, resampled every dt, straight into a shared memory block.
+    progressCallback is called with the completed percentage as runs finish.
+    """
+    runs = make_grid(tank_parameters, controllers, controller_kwargs)
+    samples = int(round(total_time / dt)) + 1
+    shape = (len(runs), len(SIGNALS), samples)
+    settings = {'total_time': total_time, 'dt': dt, 'x0': x0, 'control_point': control_point, 'method': method,
+                'adaptive': adaptive, 'tol': tol}
+
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8)) if signals else None
+    data = None
+    try:
+        if block is not None:
+            data = np.ndarray(shape, dtype=float, buffer=block.buf)
+        metrics = [None] * len(runs)
+        chunks = [list(range(start, min(start + chunk_size, len(runs)))) for start in range(0, len(runs), chunk_size)]
+        workers = workers if workers is not None else os.cpu_count()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(block and block.name, shape, settings)) as executor:
+            futures = [executor.submit(_run_chunk, chunk, [runs[index] for index in chunk]) for chunk in chunks]
+            done = 0
+            last_percentage = 0
+            for future in as_completed(futures):
+                for index, run_metrics in future.result():
+                    metrics[index] = run_metrics
+                    done += 1
+                percentage = int(100 * done / len(runs))
+                if percentage > last_percentage:
+                    last_percentage = percentage
+                    if progressCallback:
+                        progress_args = (percentage,) + (callbackArgs if callbackArgs is not None else ())
+                        progressCallback(*progress_args)
+
+        results = SweepResults(
+            runs=runs,
+            time=np.arange(samples) * dt if signals else None,
+            height=data[:, 0].copy() if signals else None,
+            error=data[:, 1].copy() if signals else None,
+            action=data[:, 2].copy() if signals else None,
+            metrics=metrics
+        )
+    finally:
+        # The array view has to be released before the block can be closed.
+        del data
+        if block is not None:
+            block.close()
+            block.unlink()
+    return results
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from Controllers.PID import PID
+from recording import RecordNone
+from simulator import WaterTank
+
+
+@pytest.fixture(autouse=True)
+def ignore_float_errors():
+    with np.errstate(all='ignore'):
+        yield
+
+
+# Without calculate_action_batch, the lanes run through a ScalarBatch of one PID per lane.
+class ScalarPID(PID):
+    calculate_action_batch = None
+
+
+@pytest.mark.parametrize('controller_class', [PID, ScalarPID])
+def test_resume_batch(controller_class):
+    gains = {'Kp': np.linspace(1, 5, 4), 'Ki': 0.5, 'ts': [0.1, 0.05, 0.2, 0.1]}
+    control_point = np.linspace(0.3, 0.9, 4)
+    tank = WaterTank()
+    first = tank.simulate_batch(5, 0.01, 0, controller_class, gains, control_point, returnValues=True)
+    resumed = tank.resume(tank.last_checkpoint, 10, controller_class.make_batch(4, **gains), first, returnValues=True)
+
+    direct = WaterTank().simulate_batch(10, 0.01, 0, controller_class, gains, control_point, returnValues=True)
+    assert resumed.height.shape == direct.height.shape == (4, len(direct.time))
+    np.testing.assert_array_equal(resumed.time, direct.time)
+    np.testing.assert_array_equal(resumed.height, direct.height)
+    np.testing.assert_array_equal(resumed.action, direct.action)
+
+
+def test_batch_lane_matches_single_run():
+    single = WaterTank().simulate_45(10, 0.01, 0, 1e-6, PID(0.1, 3), 0.6, output_dt=0.1, returnValues=True)
+    batch = WaterTank().simulate_batch(10, 0.01, 0, PID, {'Kp': 3}, [0.6], adaptive=True, output_dt=0.1,
+                                       instrument=True, returnValues=True)
+    np.testing.assert_array_equal(batch.time, single.time)
+    np.testing.assert_allclose(batch.height[0], single.height, rtol=0, atol=1e-12)
+    assert batch.stats.controller_calls == 100
+
+
+def test_batch_metrics_match_single_runs():
+    gains = np.array([1.0, 3.0, 8.0])
+    control_point = np.array([0.3, 0.6, 0.0])
+    batch = WaterTank().simulate_batch(10, 0.001, 0, PID, {'Kp': gains, 'Ki': 0.5}, control_point,
+                                       recording=RecordNone(), metrics=True, returnValues=True)
+    assert batch.height.shape == (3, 2)
+    for lane in range(3):
+        single = WaterTank().simulate(10, 0.001, 0, PID(0.1, gains[lane], 0.5), control_point[lane],
+                                      recording=RecordNone(), metrics=True, returnValues=True)
+        for name, value in single.metrics.items():
+            np.testing.assert_allclose(batch.metrics[name][lane], value, rtol=1e-12)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from cache import SimulationCache
+from Controllers.PID import PID
+from simulator import WaterTank
+
+
+@pytest.fixture(autouse=True)
+def ignore_float_errors():
+    with np.errstate(all='ignore'):
+        yield
+
+
+@pytest.mark.parametrize('tier', ['memory', 'disk'])
+def test_resume_after_cache_hit(tmp_path, tier):
+    cache = SimulationCache(directory=tmp_path)
+    tank = WaterTank()
+    cache.simulate(tank, 5, 0.001, 0, PID(), 0.7)
+    if tier == 'disk':
+        cache = SimulationCache(directory=tmp_path)
+
+    # Another run replaces the tank's checkpoint, and the hit has to restore the one of the cached run.
+    tank.simulate(2, 0.001, 0, PID(), 0.5)
+    results = cache.simulate(tank, 5, 0.001, 0, PID(), 0.7, returnValues=True)
+    assert cache.stats.hits == 1
+    assert cache.stats.disk_hits == (tier == 'disk')
+    assert tank.last_checkpoint.time == pytest.approx(5)
+    assert tank.last_checkpoint.control_point == 0.7
+
+    resumed = tank.resume(tank.last_checkpoint, 8, PID(), results, returnValues=True)
+    direct = WaterTank().simulate(8, 0.001, 0, PID(), 0.7, returnValues=True)
+    np.testing.assert_allclose(resumed.time, direct.time)
+    np.testing.assert_allclose(resumed.height, direct.height, rtol=1e-12, atol=1e-12)
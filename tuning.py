@@ -0,0 +1,342 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from controller import Controller, get_custom_controllers
+from recording import RecordNone
+from simulator import WaterTank
+
+# Integrals of the error the tuner can minimize, see metrics.compute_metrics.
+OBJECTIVES = ('ise', 'iae', 'itae')
+OPTIMIZERS = ('nelder-mead', 'cma')
+GAINS = ('Kp', 'Ki', 'Kv')
+
+# Ziegler-Nichols style rules: Kp, integral time and derivative time as fractions of the ultimate gain and period.
+RULES = {
+    'classic': (0.6, 1 / 2, 1 / 8),
+    'pessen': (0.7, 2 / 5, 3 / 20),
+    'some-overshoot': (0.33, 1 / 2, 1 / 3),
+    'no-overshoot': (0.2, 1 / 2, 1 / 3),
+    'tyreus-luyben': (0.45, 2.2, 1 / 6.3),
+}
+
+
+# Results of an auto-tuning run. gains are the best Kp, Ki and Kv found, cost their objective value and metrics the
+# metrics.METRIC_NAMES of their step response. initial_gains come from the relay experiment and the tuning rule.
+# evaluations counts the simulations run by the optimizer, aborted those stopped early, and history holds the best
+# cost after each iteration.
+@dataclass(frozen=True)
+class TuningResults:
+    gains: dict
+    cost: float
+    metrics: dict
+    initial_gains: dict
+    ultimate_gain: float
+    ultimate_period: float
+    evaluations: int
+    aborted: int
+    history: list
+
+
+# Relay with hysteresis used to find the ultimate gain and period: the action switches between bias + amplitude and
+# bias - amplitude whenever the error crosses +-hysteresis.
+class RelayController(Controller):
+    history = 1
+
+    def __init__(self, ts=0.1, bias=0.5, amplitude=0.5, hysteresis=0.0):
+        Controller.__init__(self, ts)
+        self.bias = bias
+        self.amplitude = amplitude
+        self.hysteresis = hysteresis
+        self._high = 1
+
+    def calculate_action(self, readings, time, control_point=0.7):
+        error = control_point - readings[-1]
+        if self._high and error < -self.hysteresis:
+            self._high = 0
+        elif not self._high and error > self.hysteresis:
+            self._high = 1
+        return self.bias + self.amplitude if self._high else self.bias - self.amplitude
+
+
+def relay_feedback(tank=None, control_point=0.7, ts=0.1, bias=0.5, amplitude=0.5, hysteresis=0.0, total_time=60,
+                   dt=0.001, settle_time=20):
+    """
+    Runs a relay feedback experiment around control_point and returns the ultimate gain and period of the loop,
+    from the oscillation after settle_time (describing function: Ku = 4 d / (pi sqrt(a^2 - hysteresis^2))).
+    Raises ValueError when the output does not oscillate around the set point.
+    """
+    tank = tank if tank is not None else WaterTank()
+    relay = RelayController(ts, bias, amplitude, hysteresis)
+    results = tank.simulate(total_time, dt, control_point, relay, control_point, returnValues=True)
+    steady = results.time >= settle_time
+    time, height = results.time[steady], results.height[steady]
+    error = control_point - height
+    upward = np.flatnonzero((error[:-1] <= 0) & (error[1:] > 0))
+    if len(upward) < 3:
+        raise ValueError('The relay experiment did not oscillate around the set point, '
+                         'try another bias or amplitude')
+    period = float(np.mean(np.diff(time[upward])))
+    oscillation = (np.max(height[upward[0]:]) - np.min(height[upward[0]:])) / 2
+    ultimate_gain = 4 * amplitude / (np.pi * np.sqrt(max(oscillation ** 2 - hysteresis ** 2, np.finfo(float).tiny)))
+    return float(ultimate_gain), period
+
+
+def ziegler_nichols(ultimate_gain, ultimate_period, rule='classic'):
+    """Returns the PID's Kp, Ki and Kv for an ultimate gain and period, by one of RULES."""
+    if rule not in RULES:
+        raise ValueError(f'Unknown rule {rule}, use one of {", ".join(RULES)}')
+    gain, integral_time, derivative_time = RULES[rule]
+    kp = gain * ultimate_gain
+    return {'Kp': kp, 'Ki': kp / (integral_time * ultimate_period), 'Kv': kp * derivative_time * ultimate_period}
+
+
+def evaluate(candidates, tank, controller_class, settings, bound=np.inf):
+    """
+    Simulates the step responses of controller_class(ts, **gains) for a list of gains, as one batched run with a lane
+    per candidate, and returns the cost of each and whether the run went to the end. The cost is the objective's
+    integral plus overshoot_weight times the relative overshoot, read from the metrics the run accumulates. Both only
+    grow with time, so the run stops as soon as every cost passes bound, and the costs returned are then lower bounds
+    of the full ones.
+    """
+    # A single candidate takes a plain run, which is much faster than a batch of one lane.
+    lanes = len(candidates) if len(candidates) > 1 else None
+    if lanes is None:
+        controller = controller_class(ts=settings['ts'], **candidates[0])
+    else:
+        gains = {name: np.array([candidate[name] for candidate in candidates]) for name in candidates[0]}
+        controller = controller_class.make_batch(lanes, ts=settings['ts'], **gains)
+    run = tank.start_run(settings['total_time'], settings['dt'], settings['x0'], controller, settings['control_point'],
+                         recording=RecordNone(), metrics=True, lanes=lanes)
+    while True:
+        run.advance(until=run.time + settings['check_period'])
+        metrics = run.metrics.result()
+        costs = np.atleast_1d(metrics[settings['objective']] + settings['overshoot_weight'] * metrics['overshoot'])
+        if run.finished or np.all(costs > bound):
+            return [(float(cost), run.finished) for cost in costs]
+
+
+# Worker state, set once per process by _init_worker.
+_worker = {}
+
+
+def _init_worker(tank, controller_name, controllers_path, settings):
+    _worker['tank'] = tank
+    _worker['controller'] = {entry['name']: entry for entry in
+                             get_custom_controllers(controllers_path)}[controller_name]['class']
+    _worker['settings'] = settings
+
+
+def _evaluate_in_worker(candidates, bound):
+    return evaluate(candidates, _worker['tank'], _worker['controller'], _worker['settings'], bound)
+
+
+class _Evaluator:
+    """
+    Runs candidates in log-gain space and counts the simulations. The candidates of a call are split into one batch
+    per worker of the pool when there is one, and run as a single batch otherwise.
+    """
+
+    def __init__(self, tank, controller_class, settings, executor, workers=1):
+        self.tank = tank
+        self.controller_class = controller_class
+        self.settings = settings
+        self.executor = executor
+        self.workers = workers
+        self.evaluations = 0
+        self.aborted = 0
+
+    def __call__(self, points, bound=np.inf):
+        candidates = [dict(zip(GAINS, np.exp(point))) for point in points]
+        if self.executor is None:
+            outcomes = evaluate(candidates, self.tank, self.controller_class, self.settings, bound)
+        else:
+            size = -(-len(candidates) // self.workers)
+            batches = [candidates[start:start + size] for start in range(0, len(candidates), size)]
+            outcomes = [outcome for batch in self.executor.map(_evaluate_in_worker, batches, [bound] * len(batches))
+                        for outcome in batch]
+        self.evaluations += len(outcomes)
+        self.aborted += sum(not finished for _, finished in outcomes)
+        return [cost for cost, _ in outcomes]
+
+
+def _nelder_mead(evaluate_points, x0, step, max_evaluations, speculative, tol, on_iteration):
+    """
+    Minimizes in log-gain space. Each iteration's trial points (reflection, expansion and both contractions) are
+    bounded by the worst vertex: a trial costing more is rejected whatever its exact cost, so it can be aborted.
+    speculative evaluates the four trial points together, which costs no time with a pool of four workers or more.
+    """
+    simplex = np.vstack([x0, x0 + step * np.eye(len(x0))])
+    costs = np.array(evaluate_points(simplex))
+    while evaluate_points.evaluations < max_evaluations:
+        order = np.argsort(costs)
+        simplex, costs = simplex[order], costs[order]
+        on_iteration(simplex[0], costs[0])
+        if costs[-1] - costs[0] <= tol * max(abs(costs[0]), 1e-12) and np.ptp(simplex, axis=0).max() <= tol:
+            break
+
+        worst, worst_cost = simplex[-1], costs[-1]
+        centroid = simplex[:-1].mean(axis=0)
+        trials = {
+            'reflection': centroid + (centroid - worst),
+            'expansion': centroid + 2 * (centroid - worst),
+            'outside': centroid + 0.5 * (centroid - worst),
+            'inside': centroid - 0.5 * (centroid - worst),
+        }
+        known = {}
+
+        def cost(name):
+            if name not in known:
+                names = [other for other in trials if other not in known] if speculative else [name]
+                known.update(zip(names, evaluate_points([trials[other] for other in names], worst_cost)))
+            return known[name]
+
+        reflection = cost('reflection')
+        if reflection < costs[0]:
+            expansion = cost('expansion')
+            simplex[-1], costs[-1] = (trials['expansion'], expansion) if expansion < reflection else \
+                (trials['reflection'], reflection)
+        elif reflection < costs[-2]:
+            simplex[-1], costs[-1] = trials['reflection'], reflection
+        elif reflection < worst_cost and cost('outside') <= reflection:
+            simplex[-1], costs[-1] = trials['outside'], cost('outside')
+        elif reflection >= worst_cost and cost('inside') < worst_cost:
+            simplex[-1], costs[-1] = trials['inside'], cost('inside')
+        else:
+            simplex[1:] = simplex[0] + 0.5 * (simplex[1:] - simplex[0])
+            costs[1:] = evaluate_points(simplex[1:])
+    best = int(np.argmin(costs))
+    return simplex[best], costs[best]
+
+
+def _cma(evaluate_points, x0, step, max_evaluations, abort_factor, seed, tol, on_iteration):
+    """
+    Minimizes in log-gain space with a (mu/mu_w, lambda) evolution strategy adapting its covariance matrix (rank-one
+    and rank-mu updates) and step size (cumulative step-size adaptation). Every generation is evaluated at once.
+    Candidates costing more than abort_factor times the best cost so far are aborted; their lower bound cost still
+    ranks them among the worst.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(x0)
+    population = 4 + int(3 * np.log(n))
+    parents = population // 2
+    weights = np.log(parents + 0.5) - np.log(np.arange(1, parents + 1))
+    weights /= weights.sum()
+    mu_eff = 1 / np.sum(weights ** 2)
+    c_sigma = (mu_eff + 2) / (n + mu_eff + 5)
+    d_sigma = 1 + 2 * max(0.0, np.sqrt((mu_eff - 1) / (n + 1)) - 1) + c_sigma
+    c_c = (4 + mu_eff / n) / (n + 4 + 2 * mu_eff / n)
+    c_1 = 2 / ((n + 1.3) ** 2 + mu_eff)
+    c_mu = min(1 - c_1, 2 * (mu_eff - 2 + 1 / mu_eff) / ((n + 2) ** 2 + mu_eff))
+    expected_norm = np.sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n ** 2))
+
+    mean = np.array(x0, dtype=float)
+    sigma = step
+    covariance = np.eye(n)
+    path_sigma = np.zeros(n)
+    path_c = np.zeros(n)
+    best, best_cost = mean.copy(), evaluate_points([mean])[0]
+    generation = 0
+    while evaluate_points.evaluations + population <= max_evaluations:
+        generation += 1
+        eigenvalues, basis = np.linalg.eigh(covariance)
+        scales = np.sqrt(np.maximum(eigenvalues, 1e-20))
+        samples = rng.standard_normal((population, n))
+        directions = (samples * scales) @ basis.T
+        candidates = mean + sigma * directions
+        costs = np.array(evaluate_points(candidates, abort_factor * best_cost))
+        order = np.argsort(costs)
+        if costs[order[0]] < best_cost:
+            best, best_cost = candidates[order[0]].copy(), costs[order[0]]
+        on_iteration(best, best_cost)
+
+        selected = directions[order[:parents]]
+        step_direction = weights @ selected
+        mean = mean + sigma * step_direction
+        whitened = basis @ ((basis.T @ step_direction) / scales)
+        path_sigma = (1 - c_sigma) * path_sigma + np.sqrt(c_sigma * (2 - c_sigma) * mu_eff) * whitened
+        progressing = np.linalg.norm(path_sigma) / np.sqrt(1 - (1 - c_sigma) ** (2 * generation)) < \
+            (1.4 + 2 / (n + 1)) * expected_norm
+        path_c = (1 - c_c) * path_c + progressing * np.sqrt(c_c * (2 - c_c) * mu_eff) * step_direction
+        covariance = (1 - c_1 - c_mu) * covariance + c_1 * np.outer(path_c, path_c) + \
+            c_mu * (selected.T * weights) @ selected
+        sigma *= np.exp((c_sigma / d_sigma) * (np.linalg.norm(path_sigma) / expected_norm - 1))
+        if sigma * scales.max() <= tol:
+            break
+    return best, best_cost
+
+
+def tune_pid(tank=None, control_point=0.7, x0=0, total_time=10, dt=0.01, ts=0.1, objective='itae',
+             overshoot_weight=1.0, optimizer='nelder-mead', rule='classic', initial_gains=None, max_evaluations=150,
+             workers=None, abort_factor=2.0, step=0.5, tol=1e-3, seed=None, controller='PID',
+             controllers_path=None, progressCallback=None, callbackArgs=None):
+    """
+    Tunes the Kp, Ki and Kv of a PID-like controller (by name, from controllers_path) on a step response of tank,
+    from x0 to control_point. The starting point comes from a relay experiment and a Ziegler-Nichols rule (see
+    RULES) unless initial_gains is given. The optimizer, one of OPTIMIZERS, then minimizes the objective (one of
+    OBJECTIVES) plus overshoot_weight times the relative overshoot, over the logarithm of the gains so they stay
+    positive; step is its initial spread in that space. Candidates are simulated as batched runs, split across a pool
+    of `workers` processes (all CPUs by default, none with 0 or 1), and the runs of clearly bad candidates are aborted
+    (see evaluate, _nelder_mead and _cma). progressCallback is called with the percentage of max_evaluations used.
+    """
+    if objective not in OBJECTIVES:
+        raise ValueError(f'Unknown objective {objective}, use one of {", ".join(OBJECTIVES)}')
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(f'Unknown optimizer {optimizer}, use one of {", ".join(OPTIMIZERS)}')
+    tank = tank if tank is not None else WaterTank()
+    controllers_path = controllers_path or Path(__file__).resolve().parent / 'Controllers'
+    controller_class = {entry['name']: entry for entry in get_custom_controllers(controllers_path)}[controller]['class']
+
+    ultimate_gain = ultimate_period = np.nan
+    if initial_gains is None:
+        ultimate_gain, ultimate_period = relay_feedback(tank, control_point, ts, dt=dt)
+        initial_gains = ziegler_nichols(ultimate_gain, ultimate_period, rule)
+    x_initial = np.log(np.maximum([initial_gains[name] for name in GAINS], 1e-3))
+
+    settings = {'control_point': control_point, 'x0': x0, 'total_time': total_time, 'dt': dt, 'ts': ts,
+                'objective': objective, 'overshoot_weight': overshoot_weight, 'check_period': 0.5}
+    workers = workers if workers is not None else os.cpu_count()
+    history = []
+    last_percentage = 0
+
+    def on_iteration(point, cost):
+        nonlocal last_percentage
+        history.append(float(cost))
+        percentage = min(100, int(100 * evaluator.evaluations / max_evaluations))
+        if percentage > last_percentage:
+            last_percentage = percentage
+            if progressCallback:
+                progress_args = (percentage,) + (callbackArgs if callbackArgs is not None else ())
+                progressCallback(*progress_args)
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(tank, controller, controllers_path, settings))
+    try:
+        evaluator = _Evaluator(tank, controller_class, settings, executor, workers)
+        if optimizer == 'nelder-mead':
+            point, cost = _nelder_mead(evaluator, x_initial, step, max_evaluations, workers >= 4, tol, on_iteration)
+        else:
+            point, cost = _cma(evaluator, x_initial, step, max_evaluations, abort_factor, seed, tol, on_iteration)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    gains = {name: float(value) for name, value in zip(GAINS, np.exp(point))}
+    results = tank.simulate(total_time, dt, x0, controller_class(ts=ts, **gains), control_point, returnValues=True,
+                            recording=RecordNone(), metrics=True)
+    return TuningResults(
+        gains=gains,
+        cost=float(cost),
+        metrics=results.metrics,
+        initial_gains=dict(initial_gains),
+        ultimate_gain=ultimate_gain,
+        ultimate_period=ultimate_period,
+        evaluations=evaluator.evaluations,
+        aborted=evaluator.aborted,
+        history=history
+    )